@@ -1,17 +1,205 @@
+import ast
+import struct
+
 import numpy as np
 
-from nearpy.utils import chunk
+from itertools import izip
+from nearpy.utils import chunk, perform_online_kmeans
+
+
+def object_array(items):
+    """ Returns a 1D array of objects (items can be sequences themselves). """
+    items = list(items)
+    array = np.empty(len(items), dtype=object)
+    for i, item in enumerate(items):
+        array[i] = item
+
+    return array
+
+
+# Stored elements start with the version of their format (one byte). Buckets
+# written by older versions (Python literals, evaluated) don't start with it.
+RECORD_FORMAT = b"\x01"
+
+# Records are encoded as a tag (one byte) followed by the content:
+#   None, True, False: no content
+#   int, float: int64 or float64
+#   str, unicode: length (uint32) followed by the bytes (UTF-8 for unicode)
+#   list, tuple, dict: number of items (uint32) followed by the items (keys and values for dicts)
+#   ndarray: dtype and shape (as a tuple record) followed by the raw bytes
+# Numbers are little-endian.
+_UINT32 = struct.Struct("<I")
+_INT64 = struct.Struct("<q")
+_FLOAT64 = struct.Struct("<d")
+
+
+def pack_record(value):
+    """ Encodes a Python value (made of None, bool, numbers, strings, lists, tuples, dicts and arrays). """
+    if value is None:
+        return b"N"
+    if value is True:
+        return b"T"
+    if value is False:
+        return b"F"
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, (int, long)):
+        return b"i" + _INT64.pack(value)
+    if isinstance(value, float):
+        return b"f" + _FLOAT64.pack(value)
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+        return b"u" + _UINT32.pack(len(value)) + value
+    if isinstance(value, bytes):
+        return b"s" + _UINT32.pack(len(value)) + value
+    if isinstance(value, (list, tuple)):
+        tag = b"l" if isinstance(value, list) else b"t"
+        return tag + _UINT32.pack(len(value)) + b"".join(pack_record(item) for item in value)
+    if isinstance(value, dict):
+        items = (pack_record(key) + pack_record(item) for key, item in value.items())
+        return b"d" + _UINT32.pack(len(value)) + b"".join(items)
+    if isinstance(value, np.ndarray):
+        data = np.ascontiguousarray(value).tostring()
+        return b"a" + pack_record((value.dtype.str, value.shape)) + _UINT32.pack(len(data)) + data
+
+    raise TypeError("Cannot encode values of type {}.".format(type(value).__name__))
+
+
+def unpack_record(buffer, position=0):
+    """ Decodes the value encoded at `position` in `buffer`. Returns the value and the position after it. """
+    tag = buffer[position:position+1]
+    position += 1
+    if tag == b"N":
+        return None, position
+    if tag == b"T":
+        return True, position
+    if tag == b"F":
+        return False, position
+    if tag == b"i":
+        return _INT64.unpack_from(buffer, position)[0], position + 8
+    if tag == b"f":
+        return _FLOAT64.unpack_from(buffer, position)[0], position + 8
+    if tag in (b"s", b"u"):
+        length, = _UINT32.unpack_from(buffer, position)
+        value = buffer[position+4:position+4+length]
+        return value.decode("utf-8") if tag == b"u" else value, position + 4 + length
+    if tag in (b"l", b"t", b"d"):
+        count, = _UINT32.unpack_from(buffer, position)
+        position += 4
+        items = []
+        for _ in range(count * (2 if tag == b"d" else 1)):
+            item, position = unpack_record(buffer, position)
+            items.append(item)
+
+        if tag == b"d":
+            return dict(izip(items[::2], items[1::2])), position
+        return items if tag == b"l" else tuple(items), position
+    if tag == b"a":
+        (dtype, shape), position = unpack_record(buffer, position)
+        length, = _UINT32.unpack_from(buffer, position)
+        data = buffer[position+4:position+4+length]
+        return np.frombuffer(data, dtype=np.dtype(str(dtype))).reshape(shape), position + 4 + length
+
+    raise ValueError("Invalid record tag {!r} at position {}.".format(tag, position - 1))
 
 
 class Data(object):
+    """
+    Attribute of the stored elements. Elements are serialized one by one
+    (`dumps`) and the content of a bucket, i.e. the concatenation of its
+    serialized elements, is deserialized at once (`loads`).
+
+    By default, elements are any Python values encoded as binary records
+    (see `pack_record`), each one preceded by `RECORD_FORMAT`. Buckets are
+    loaded as arrays of objects. Buckets stored by older versions of NearPy
+    (Python literals) are still loaded, with `ast.literal_eval`, including
+    when records were appended to them since.
+    """
+
     def __init__(self, name):
         self.name = name
 
     def dumps(self, data):
-        return data
+        return [RECORD_FORMAT + pack_record(value) for value in data]
+
+    def loads(self, txt):
+        txt = txt or b""
+        values = []
+        position = 0
+        if len(txt) > 0 and txt[:1] != RECORD_FORMAT:
+            # Legacy literal, possibly followed by the records appended since.
+            # Its strings are written with `repr`, which escapes RECORD_FORMAT.
+            position = txt.find(RECORD_FORMAT)
+            position = len(txt) if position < 0 else position
+            legacy = ast.literal_eval(txt[:position])
+            values.extend(legacy if isinstance(legacy, (list, tuple)) else [legacy])
+
+        while position < len(txt):
+            if txt[position:position+1] != RECORD_FORMAT:
+                raise ValueError("Unknown format of the element at position {}.".format(position))
+
+            value, position = unpack_record(txt, position + 1)
+            values.append(value)
+
+        return object_array(values)
+
+    def dumps_buckets(self, data, bounds):
+        """
+        Serializes data grouped by bucket (bucket i is `data[bounds[i]:bounds[i+1]]`).
+        Returns the serialized content of each bucket.
+        """
+        items = list(self.dumps(data))
+        return ["".join(items[start:end]) for start, end in izip(bounds[:-1], bounds[1:])]
+
+
+class StringData(Data):
+    """
+    Variable-length strings. Buckets are loaded as arrays of objects (unicode
+    strings if `encoding` is given).
+
+    Strings are stored by blocks: the number of strings, their lengths and
+    then their bytes. A block holds one element (`dumps`) or every element
+    stored at once in a bucket (`dumps_buckets`), so buckets are appended to
+    and the offsets of the strings are computed one block at a time.
+    """
+
+    def __init__(self, name, encoding=None):
+        super(StringData, self).__init__(name)
+        self.encoding = encoding
+
+    def _encode(self, data):
+        if self.encoding is None:
+            return list(data)
+
+        return [value.encode(self.encoding) for value in data]
+
+    def _block(self, values):
+        lengths = np.array([len(value) for value in values], dtype="<u4")
+        return _UINT32.pack(len(values)) + lengths.tostring() + b"".join(values)
+
+    def dumps(self, data):
+        return [self._block([value]) for value in self._encode(data)]
+
+    def dumps_buckets(self, data, bounds):
+        values = self._encode(data)
+        return [self._block(values[start:end]) for start, end in izip(bounds[:-1], bounds[1:])]
 
     def loads(self, txt):
-        return eval(txt)
+        txt = txt or b""
+
+        values = []
+        position = 0
+        while position < len(txt):
+            count, = _UINT32.unpack_from(txt, position)
+            lengths = np.frombuffer(txt, dtype="<u4", count=count, offset=position + 4)
+            offsets = position + 4 + 4*count + np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+            values.extend(txt[start:end] for start, end in izip(offsets[:-1], offsets[1:]))
+            position = int(offsets[-1])
+
+        if self.encoding is not None:
+            values = [value.decode(self.encoding) for value in values]
+
+        return object_array(values)
 
 
 class NumpyData(Data):
@@ -23,9 +211,158 @@ class NumpyData(Data):
     def dumps(self, data):
         return chunk(data.tostring(), n=int(np.prod(self.shape)*self.dtype.itemsize))
 
+    def dumps_buckets(self, data, bounds):
+        data = np.ascontiguousarray(data, dtype=self.dtype).tostring()
+        nbytes = int(np.prod(self.shape)*self.dtype.itemsize)
+        return [data[start*nbytes:end*nbytes] for start, end in izip(bounds[:-1], bounds[1:])]
+
     def loads(self, txt):
         if txt is None:
             txt = ""
 
         shape = (-1,) + self.shape
         return np.frombuffer(txt, self.dtype).reshape(shape)
+
+
+class StructData(NumpyData):
+    """
+    Fixed-width records, e.g. `StructData("info", [("x", "int32"), ("label", "S16")])`.
+    Elements are given as tuples (or as a structured array) and buckets are
+    loaded as structured arrays, without any copy.
+    """
+
+    def __init__(self, name, fields):
+        super(StructData, self).__init__(name, np.dtype(fields), ())
+
+    def dumps(self, data):
+        return super(StructData, self).dumps(np.asarray(data, dtype=self.dtype))
+
+
+class PQData(NumpyData):
+    """
+    Vectors compressed with product quantization: vectors are split in
+    `nb_subspaces` parts and each part is replaced by the index of its
+    nearest centroid (i.e. one byte per part with 256 centroids).
+
+    Codebooks are learned with k-means over the chunks of vectors yielded by
+    `trainset()`, unless given. Vectors are encoded with `encode` before
+    being stored, see `PQDistance` to compare queries to the codes.
+    """
+
+    def __init__(self, name, dimension, nb_subspaces, trainset=None, nb_centroids=256, nb_passes=5,
+                 rand_seed=None, codebooks=None):
+        if dimension % nb_subspaces != 0:
+            raise ValueError("The dimension ({}) must be a multiple of the number of subspaces ({})."
+                             .format(dimension, nb_subspaces))
+
+        dtype = np.dtype(np.uint8 if nb_centroids <= 2**8 else np.uint16)
+        super(PQData, self).__init__(name, dtype, (nb_subspaces,))
+        self.dimension = dimension
+        self.nb_subspaces = nb_subspaces
+        self.nb_centroids = nb_centroids
+
+        # Centroids of each subspace (nb_subspaces x nb_centroids x subspace dimension).
+        self.codebooks = codebooks
+        if self.codebooks is None:
+            self.codebooks = perform_online_kmeans(trainset, nb_centroids, nb_subspaces, nb_passes, rand_seed)
+
+        self.codebooks = self.codebooks.astype(np.float32)
+
+    def distance_tables(self, V):
+        """
+        Returns the squared distances between each part of the vectors and
+        every centroid of its subspace (vectors x subspaces x centroids).
+        """
+        V = np.asarray(V, dtype=np.float32).reshape((len(V), self.nb_subspaces, -1))
+        tables = np.einsum("nsd,skd->nsk", V, self.codebooks)
+        tables *= -2
+        tables += np.sum(V**2, axis=2)[:, :, None]
+        tables += np.sum(self.codebooks**2, axis=2)[None, :, :]
+        return np.maximum(tables, 0, out=tables)
+
+    def encode(self, V):
+        """ Returns the codes of the vectors (one row per vector). """
+        codes = np.empty((len(V), self.nb_subspaces), dtype=self.dtype)
+        for vectors in chunk(np.arange(len(V)), 2**14):
+            codes[vectors] = np.argmin(self.distance_tables(V[vectors]), axis=2)
+
+        return codes
+
+    def decode(self, codes):
+        """ Returns the vectors approximated by the codes. """
+        codes = np.asarray(codes).reshape((len(codes), self.nb_subspaces))
+        parts = [self.codebooks[subspace][codes[:, subspace]] for subspace in range(self.nb_subspaces)]
+        return np.concatenate(parts, axis=1)
+
+
+class QuantizedData(NumpyData):
+    """
+    Vectors stored with fewer bytes per value, either as float16 or as int8
+    codes with a per-dimension affine transformation (value = code * scale
+    + offset, learned by `fit`).
+
+    Vectors are encoded with `encode` before being stored. Distances decode
+    the stored codes by blocks (see `Distance.decode`). Scale and offset are
+    kept in the storage's infos by `save_info` and read back by `load_info`.
+    """
+
+    def __init__(self, name, shape, dtype="int8", scale=None, offset=None):
+        super(QuantizedData, self).__init__(name, np.dtype(dtype), shape)
+        if self.dtype not in (np.dtype(np.float16), np.dtype(np.int8)):
+            raise ValueError("Vectors can only be quantized as float16 or int8, not {}.".format(self.dtype))
+
+        self.scale = None if scale is None else np.asarray(scale, dtype=np.float32)
+        self.offset = None if offset is None else np.asarray(offset, dtype=np.float32)
+
+    @property
+    def affine(self):
+        return self.dtype == np.int8
+
+    def fit(self, trainset):
+        """
+        Learns the scale and offset of each dimension so that the range of the
+        vectors yielded by `trainset()` (chunks of vectors) maps to [-127, 127].
+        """
+        if not self.affine:
+            return
+
+        minimums = maximums = None
+        for V in trainset():
+            V = np.asarray(V, dtype=np.float32).reshape((-1,) + self.shape)
+            minimums = V.min(axis=0) if minimums is None else np.minimum(minimums, V.min(axis=0))
+            maximums = V.max(axis=0) if maximums is None else np.maximum(maximums, V.max(axis=0))
+
+        self.offset = (maximums + minimums) / 2
+        self.scale = (maximums - minimums) / 254
+        self.scale[self.scale == 0] = 1
+
+    def encode(self, V):
+        """ Returns the codes of the vectors. """
+        if not self.affine:
+            return np.asarray(V).astype(np.float16)
+
+        if self.scale is None:
+            raise ValueError("Scale and offset of '{}' are unknown, see `fit` and `load_info`.".format(self.name))
+
+        codes = np.round((np.asarray(V, dtype=np.float32) - self.offset) / self.scale)
+        return np.clip(codes, -127, 127).astype(np.int8)
+
+    def decode(self, codes):
+        """ Returns the vectors approximated by the codes (as float32). """
+        values = np.asarray(codes).astype(np.float32)
+        if self.affine:
+            values *= self.scale
+            values += self.offset
+
+        return values
+
+    def save_info(self, storage):
+        if self.affine:
+            storage.set_info(self.name + "_quantization", {"scale": self.scale.tolist(),
+                                                           "offset": self.offset.tolist()})
+
+    def load_info(self, storage):
+        infos = storage.get_info(self.name + "_quantization")
+        if self.affine and len(infos) > 0:
+            self.scale = np.asarray(infos["scale"], dtype=np.float32)
+            self.offset = np.asarray(infos["offset"], dtype=np.float32)
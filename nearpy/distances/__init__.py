@@ -26,3 +26,5 @@ from nearpy.distances.cosine import CosineDistance
 from nearpy.distances.euclidean import EuclideanDistance
 from nearpy.distances.manhattan import ManhattanDistance
 from nearpy.distances.correlation import CorrelationDistance
+from nearpy.distances.hamming import HammingDistance
+from nearpy.distances.pq import PQDistance
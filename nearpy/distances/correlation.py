@@ -1,16 +1,24 @@
 import numpy as np
 
-from nearpy.distances.distance import Distance
+from nearpy.distances.distance import Distance, BLOCK_SIZE
 
 
 class CorrelationDistance(Distance):
     """ Correlation distance """
 
     def __call__(self, query, patches):
-        axis = tuple(range(1, patches.ndim))
-        mean1 = np.mean(query)
-        mean2 = np.mean(patches, axis=axis, keepdims=True)
-        std1 = np.std(query)
-        std2 = np.std(patches, axis=axis, keepdims=True)
+        # Patches are decoded block by block by `pairwise`.
+        return self.pairwise(np.asarray(query)[None], patches)[0]
 
-        return np.mean( ((query - mean1) / std1) * ((patches - mean2) / std2), axis=axis)
+    def pairwise(self, queries, patches):
+        queries = queries.reshape((len(queries), int(np.prod(queries.shape[1:]))))
+        queries = (queries - np.mean(queries, axis=1, keepdims=True)) / np.std(queries, axis=1, keepdims=True)
+
+        # Patches are converted and normalized one block at a time.
+        distances = np.empty((len(queries), len(patches)), dtype=np.result_type(queries, np.float32))
+        for start in range(0, len(patches), BLOCK_SIZE):
+            block = self.decode(patches[start:start+BLOCK_SIZE]).reshape((-1, queries.shape[1]))
+            block = (block - np.mean(block, axis=1, keepdims=True)) / np.std(block, axis=1, keepdims=True)
+            distances[:, start:start+len(block)] = np.dot(queries, block.T)
+
+        return distances / queries.shape[1]
@@ -20,21 +20,27 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import numpy
-import scipy
+import numpy as np
 
-from nearpy.distances.distance import Distance
+from nearpy.distances.distance import Distance, BLOCK_SIZE
 
 
 class CosineDistance(Distance):
     """  Uses 1-cos(angle(x,y)) as distance measure. """
 
-    def distance(self, x, y):
-        """
-        Computes distance measure between vectors x and y. Returns float.
-        """
-        if scipy.sparse.issparse(x):
-            x = x.toarray().ravel()
-            y = y.toarray().ravel()
-        return 1.0 - numpy.dot(x, y) / (numpy.linalg.norm(x) *
-                                        numpy.linalg.norm(y))
+    def __call__(self, query, patches):
+        # Patches are decoded block by block by `pairwise`.
+        return self.pairwise(np.asarray(query)[None], patches)[0]
+
+    def pairwise(self, queries, patches):
+        queries = queries.reshape((len(queries), int(np.prod(queries.shape[1:])))).astype(np.float64)
+        queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+        # Patches are converted and normalized one block at a time.
+        distances = np.empty((len(queries), len(patches)), dtype=np.float64)
+        for start in range(0, len(patches), BLOCK_SIZE):
+            block = self.decode(patches[start:start+BLOCK_SIZE], np.float64).reshape((-1, queries.shape[1]))
+            block = block / np.linalg.norm(block, axis=1, keepdims=True)
+            distances[:, start:start+len(block)] = np.dot(queries, block.T)
+
+        return 1.0 - distances
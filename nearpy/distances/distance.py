@@ -20,6 +20,11 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import numpy as np
+
+# Number of patches decoded at once by the distances (see `Distance.decode`).
+BLOCK_SIZE = 2**12
+
 
 class Distance(object):
     """ Interface for distance functions. """
@@ -32,3 +37,22 @@ class Distance(object):
         Computes distance measure between a query patch and a list of patches. Returns float.
         """
         raise NotImplementedError
+
+    def pairwise(self, queries, patches):
+        """
+        Computes distance measure between every query patch and every patch of a list.
+        Returns a matrix of floats (one row per query).
+        """
+        return np.array([self(query, patches) for query in queries]).reshape((len(queries), len(patches)))
+
+    def decode(self, patches, dtype=None):
+        """
+        Returns the values of patches stored encoded by their attribute (e.g.
+        `QuantizedData`), cast to `dtype` if given. Kernels call it block by
+        block so that a whole bucket is never converted at once.
+        """
+        decode = getattr(self.attribute, "decode", None)
+        if decode is not None:
+            patches = decode(patches)
+
+        return patches if dtype is None else patches.astype(dtype)
@@ -20,28 +20,44 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-# import theano
-# import theano.tensor as T
 import numpy as np
 
-from nearpy.distances.distance import Distance
+from nearpy.distances.distance import Distance, BLOCK_SIZE
+from nearpy.utils import get_backend
 
 
 class EuclideanDistance(Distance):
     """ Euclidean distance """
 
-    # def __init__(self, *args, **kwargs):
-    #     super(EuclideanDistance, self).__init__(*args, **kwargs)
-    #     patches = T.matrix()
-    #     query = T.vector()
-    #     distances = T.sqrt(T.mean((patches - query) ** 2, axis=1))
-    #     #self.dist = theano.function([patches, query], distances)
-
-    #     self.dist = theano.function([patches, query], T.argsort(distances)[:100])
-
-    #     theano.printing.pydotprint(self.dist)
-
     def __call__(self, query, patches):
-        return np.sqrt(np.mean((patches - query) ** 2, axis=tuple(range(1, patches.ndim))))
+        # Patches are decoded block by block by `pairwise`.
+        return self.pairwise(np.asarray(query)[None], patches)[0]
         #return np.sqrt(np.sum((patches - query) ** 2, axis=tuple(range(1, patches.ndim))))
-        #return self.dist(patches.reshape((-1, 9)), query.flatten())
+
+    def pairwise(self, queries, patches):
+        # Uses ||q-p||^2 = ||q||^2 - 2q.p + ||p||^2, so the bulk of the work is done
+        # by matrix products. Computed in float64 to limit the cancellation, one
+        # block of patches at a time (i.e. patches are converted by blocks, see `set_backend`).
+        backend = get_backend()
+        queries = queries.reshape((len(queries), int(np.prod(queries.shape[1:])))).astype(np.float64)
+        queries_sq_norms = backend.sq_norms(queries)
+
+        distances = np.empty((len(queries), len(patches)), dtype=np.float64)
+
+        def block_distances(start, end):
+            block = self.decode(patches[start:end], np.float64).reshape((-1, queries.shape[1]))
+            block_sq_norms = backend.sq_norms(block)
+            dots = np.dot(queries, block.T)
+            sq_distances = backend.sq_distances(dots, queries_sq_norms, block_sq_norms)
+
+            # Distances lost in the rounding errors of the norms (e.g. identical
+            # vectors) are computed from the differences instead.
+            tolerance = 16 * np.finfo(np.float64).eps * (queries_sq_norms[:, None] + block_sq_norms[None, :])
+            rows, cols = np.nonzero(sq_distances <= tolerance)
+            sq_distances[rows, cols] = np.sum((queries[rows] - block[cols]) ** 2, axis=1)
+            distances[:, start:end] = sq_distances
+
+        backend.map_chunks(block_distances, len(patches), BLOCK_SIZE)
+        np.maximum(distances, 0, out=distances)
+        distances /= queries.shape[1]
+        return np.sqrt(distances, out=distances)
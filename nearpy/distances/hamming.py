@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 Ole Krause-Sparmann
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import numpy as np
+
+from nearpy.distances.distance import Distance
+from nearpy.utils import popcount
+
+
+class HammingDistance(Distance):
+    """
+    Number of different bits between binary codes packed in uint64 words
+    (see `Hashing.codes`), e.g. to cheaply rank the candidates before
+    computing a more expensive distance on the best ones only.
+
+    Query patches are hashed with `hashing` to get their codes. Without it,
+    the queries given are expected to be codes already.
+    """
+
+    def __init__(self, attribute, hashing=None):
+        super(HammingDistance, self).__init__(attribute)
+        self.hashing = hashing
+
+    def _codes(self, queries):
+        if self.hashing is not None:
+            return self.hashing.codes(queries)
+
+        return np.asarray(queries, dtype=np.uint64).reshape((len(queries), -1))
+
+    def __call__(self, query, codes):
+        return self.pairwise(np.array([query]), codes)[0]
+
+    def pairwise(self, queries, codes):
+        queries = self._codes(queries)
+        codes = np.asarray(codes, dtype=np.uint64).reshape((len(codes), -1))
+
+        # One word at a time, to only hold (queries x codes) words in memory.
+        distances = np.zeros((len(queries), len(codes)), dtype=np.int32)
+        for word in range(queries.shape[1]):
+            distances += popcount(queries[:, word, None] ^ codes[None, :, word])
+
+        return distances
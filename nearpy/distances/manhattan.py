@@ -20,21 +20,27 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import numpy
-import scipy
+import numpy as np
 
-from nearpy.distances.distance import Distance
+from nearpy.distances.distance import Distance, BLOCK_SIZE
 
 
 class ManhattanDistance(Distance):
     """ Manhattan distance """
 
-    def distance(self, x, y):
-        """
-        Computes the Manhattan distance between vectors x and y. Returns float.
-        """
-        if scipy.sparse.issparse(x):
-            return numpy.sum(numpy.absolute((x-y).toarray().ravel()))
-        else:
-            return numpy.sum(numpy.absolute(x-y))
+    def __call__(self, query, patches):
+        # Patches are decoded block by block by `pairwise`.
+        return self.pairwise(np.asarray(query)[None], patches)[0]
 
+    def pairwise(self, queries, patches):
+        queries = queries.reshape((len(queries), int(np.prod(queries.shape[1:])))).astype(np.float64)
+
+        # Patches are converted one block at a time, queries taken one by one
+        # to only hold a block of differences in memory.
+        distances = np.empty((len(queries), len(patches)), dtype=np.float64)
+        for start in range(0, len(patches), BLOCK_SIZE):
+            block = self.decode(patches[start:start+BLOCK_SIZE], np.float64).reshape((-1, queries.shape[1]))
+            for i, query in enumerate(queries):
+                distances[i, start:start+len(block)] = np.sum(np.absolute(block - query), axis=1)
+
+        return distances
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 Ole Krause-Sparmann
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import numpy as np
+
+from nearpy.distances.distance import Distance
+
+
+class PQDistance(Distance):
+    """
+    Euclidean distance (same scale as `EuclideanDistance`) between query
+    vectors and vectors compressed by a `PQData` attribute, computed from
+    the codes: the distances between the parts of a query and every centroid
+    are computed once (distance tables), then summed over the code of each
+    candidate (asymmetric distance computation).
+
+    Used as `prefilter_distance` of the engine, only the best candidates are
+    compared to the original vectors.
+    """
+
+    def __call__(self, query, codes):
+        return self.pairwise(np.array([query]), codes)[0]
+
+    def pairwise(self, queries, codes):
+        tables = self.attribute.distance_tables(queries.reshape((len(queries), -1)))
+        codes = np.asarray(codes).reshape((len(codes), self.attribute.nb_subspaces))
+
+        distances = np.zeros((len(queries), len(codes)), dtype=np.float32)
+        for subspace in range(self.attribute.nb_subspaces):
+            distances += tables[:, subspace, codes[:, subspace]]
+
+        distances /= self.attribute.dimension
+        return np.sqrt(distances, out=distances)
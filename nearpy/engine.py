@@ -10,15 +10,77 @@ import numpy as np
 #from nearpy.filters import NearestFilter
 #from nearpy.distances import EuclideanDistance
 from nearpy.storage import storage_factory
+from nearpy.filters.nearestfilter import TopK
+from nearpy.filters.filterchain import FilterChain
 #from itertools import islice, izip, izip_longest, chain
-from nearpy.utils import chunk, Timer
-#from nearpy.data import NumpyData
+from nearpy.utils import chunk, bounded_imap, Timer
+from nearpy.data import NumpyData
 from collections import defaultdict
+from functools import partial
+from itertools import chain, izip, islice, repeat
+from heapq import heappush, heappop, merge
+from threading import Lock
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
 from time import time
 
+# Maximum number of distances computed at once (i.e. queries x candidates).
+DISTANCES_BUFFER_SIZE = 2**22
 
-def flip(bits, no_bit):
-    return np.bitwise_xor(np.uint64(bits), np.left_shift(np.uint64(1), np.uint64(no_bit)))
+# Key of the candidates giving the (table, bucket code) each array was retrieved from.
+SOURCES = "__sources__"
+
+# Attribute holding the hash code of each element (adaptive mode only).
+CODE_ATTRIBUTE = NumpyData("__code__", np.dtype(np.uint64), ())
+
+
+def probe_sequence(bucketcode, margins):
+    """
+    Yields (score, bucketcode) of the neighboring buckets of `bucketcode` in
+    increasing order of score. The score of a bucket is the sum of the
+    squared margins of the bits that were flipped to get it, i.e. buckets on
+    the other side of the hyperplanes closest to the query come first. Only
+    the first 64 bits are flipped (the bits kept in the hash codes).
+
+    References
+    ----------
+    .. [Lv2007] Lv, Q., Josephson, W., Wang, Z., Charikar, M., & Li, K. (2007).
+                Multi-probe LSH: efficient indexing for high-dimensional similarity search. VLDB.
+    """
+    margins = margins[:64]
+    order = np.argsort(margins)
+    scores = margins[order].astype(np.float64)**2
+    bits = np.left_shift(np.uint64(1), order.astype(np.uint64))
+
+    # Perturbation sets (indices in `order`) are generated from the smallest
+    # one using the "shift" and "expand" operations of [Lv2007].
+    heap = [(scores[0], (0,))]
+    while len(heap) > 0:
+        score, flipped = heappop(heap)
+        yield score, np.bitwise_xor(np.uint64(bucketcode), np.bitwise_or.reduce(bits[list(flipped)]))
+
+        last = flipped[-1]
+        if last+1 < len(scores):
+            heappush(heap, (score - scores[last] + scores[last+1], flipped[:-1] + (last+1,)))
+            heappush(heap, (score + scores[last+1], flipped + (last+1,)))
+
+
+# State of the processes used by `Engine.neighbors_parallel`.
+_worker = {}
+
+
+def _init_worker(engine, V, patches, bucketcodes, attributes):
+    # Each worker uses its own read-only handle on the storage.
+    engine.storage = engine.storage.reopen()
+    engine._storage_lock = None if getattr(engine.storage, "thread_safe", False) else Lock()
+    _worker.update(engine=engine, V=V, patches=patches, bucketcodes=bucketcodes, attributes=attributes)
+
+
+def _neighbors_shard(patch_ids):
+    engine = _worker['engine']
+    neighbors = engine._neighbors(_worker['V'][patch_ids], _worker['patches'][patch_ids],
+                                  _worker['bucketcodes'][patch_ids], _worker['attributes'])
+    return [(patch_ids[i], neighbors_i) for i, neighbors_i in neighbors]
 
 
 class Engine(object):
@@ -47,20 +109,195 @@ class Engine(object):
                 tuples.
     """
 
-    def __init__(self, lshashes=None, distance=None, filters=[], storage=None):
+    def __init__(self, lshashes=None, distance=None, filters=[], storage=None, id_attribute=None,
+                 max_probes=None, fetch_window=1000, fetch_workers=1, prefetch_windows=2, lazy=False,
+                 prefilter_distance=None, shortlist=100, max_bucket_size=None, min_bits=8):
+        if lshashes is not None and not isinstance(lshashes, (list, tuple)):
+            raise TypeError("`lshashes` must be a list of hashes, not {}.".format(type(lshashes).__name__))
+
         self.lshashes = lshashes
         self.distance = distance
         self.filters = filters
 
+        # Maximum number of neighboring buckets to probe (over all hashes) when the
+        # buckets of a query hold too few candidates. By default, as many as there are bits.
+        self.max_probes = max_probes
+        if self.max_probes is None:
+            self.max_probes = sum(min(lshash.nbits, 64) for lshash in self.lshashes or [])
+
+        # Number of unique buckets retrieved at once from the storage while querying.
+        # Windows are fetched (and deserialized) in background by `fetch_workers` threads
+        # while the current one is processed. At most `prefetch_windows` windows are
+        # fetched ahead, which bounds the memory used.
+        self.fetch_window = fetch_window
+        self.fetch_workers = fetch_workers
+        self.prefetch_windows = prefetch_windows
+
+        # When using more than one hash (i.e. multi-table LSH), a vector can be
+        # retrieved from several tables. This attribute is used to remove duplicates.
+        self.id_attribute = id_attribute
+
+        # When the filters keep the K nearest, only the attributes needed for scoring
+        # are retrieved with the buckets. The other ones are retrieved afterwards for
+        # the selected candidates only (see `Storage.retrieve_rows`).
+        self.lazy = lazy
+
+        # Candidates can first be ranked with a cheap distance (e.g. `HammingDistance`
+        # between binary codes stored with the vectors), then `distance` is only
+        # computed for the `shortlist` best candidates of each query.
+        self.prefilter_distance = prefilter_distance
+        self.shortlist = shortlist
+
+        # Adaptive mode: buckets are made of the `min_bits` first bits of the hash codes,
+        # and a bucket holding more than `max_bucket_size` elements is split using one
+        # more bit (up to every bit of the hash). Queries go to the deepest bucket matching
+        # their hash code. Split buckets (the prefix tree) are kept in the storage's infos.
+        self.max_bucket_size = max_bucket_size
+        self.min_bits = min_bits
+
         self.storage = storage
         if self.storage is None:
             self.storage = storage_factory("memory")
 
+        # Storage backends are not all thread-safe (see `Storage.thread_safe`).
+        self._storage_lock = None if getattr(self.storage, "thread_safe", False) else Lock()
+
+        self._splits = None
+        if self.max_bucket_size is not None:
+            if any(lshash.nbits > 63 for lshash in self.lshashes):
+                raise ValueError("Hashes can't have more than 63 bits in adaptive mode.")
+
+            # Buckets are split by removing them and storing their elements again,
+            # split buckets being kept in the infos.
+            if not all(hasattr(self.storage, method) for method in ["remove", "get_info", "set_info"]):
+                raise ValueError("Adaptive mode needs a storage able to remove buckets and keep infos, not {}."
+                                 .format(type(self.storage).__name__))
+
+            self._splits = [self._load_splits(table) for table in range(len(self.lshashes))]
+
     # def set_metadata(self, attribute, metadata):
     #     for lshash in self.lshashes:
     #         self.storage.add_attribute(lshash.name, attribute)
     #         self.storage.set_metadata(lshash.name + "_" + attribute, metadata)
 
+    def _hash_codes(self, V):
+        """
+        Returns the uint64 hash codes of `V`, one column per hash (table).
+        """
+        codes = []
+        for lshash in self.lshashes:
+            with Timer("  Hashing"):
+                codes.append(lshash.hash_vector(V).view(np.uint64))
+
+        return np.column_stack(codes)
+
+    def _load_splits(self, table):
+        """ Returns the prefixes of the split buckets of hash number `table`, by depth. """
+        infos = self.storage.get_info(self._keyprefix(table) + "splits")
+        return {int(depth): np.array(prefixes, dtype=np.uint64) for depth, prefixes in dict(infos).items()}
+
+    def _save_splits(self, table):
+        infos = {str(depth): [int(prefix) for prefix in prefixes] for depth, prefixes in self._splits[table].items()}
+        self.storage.set_info(self._keyprefix(table) + "splits", infos)
+
+    def _route(self, table, codes):
+        """
+        Returns the codes of the deepest buckets of hash number `table` matching
+        the given hash codes, and their depths. The code of a bucket of depth d
+        is made of the first d bits of the hash code, plus bit d set to tell
+        apart the depths.
+        """
+        codes = np.asarray(codes, dtype=np.uint64)
+        depths = np.full(len(codes), self.min_bits, dtype=np.int64)
+        splits = self._splits[table]
+        depth = self.min_bits
+        while depth in splits:
+            prefixes = codes & np.uint64(2**depth - 1)
+            depths[(depths == depth) & np.in1d(prefixes, splits[depth])] += 1
+            depth += 1
+
+        bits = np.left_shift(np.uint64(1), depths.astype(np.uint64))
+        return (codes & (bits - np.uint64(1))) | bits, depths
+
+    def _bucket_codes(self, codes):
+        """
+        Returns the bucket codes matching hash codes (one column per hash).
+        """
+        if self._splits is None:
+            return codes
+
+        return np.column_stack([self._route(table, codes[:, table])[0] for table in range(len(self.lshashes))])
+
+    def _split(self, table, bucketcodes, depths, attributes):
+        """
+        Splits buckets of hash number `table` in two using one more bit of the
+        hash codes. Buckets are split together, i.e. removed and stored again
+        at once. Returns the codes and depths of the new buckets.
+        """
+        bucketcodes = np.asarray(bucketcodes, dtype=np.uint64)
+        bucketvalues = {attribute: self._retrieve(table, bucketcodes, attribute) for attribute in attributes}
+        bucketvalues = {attribute: np.concatenate(buckets) for attribute, buckets in bucketvalues.items()}
+        self.storage.remove(bucketcodes, prefix=self._keyprefix(table))
+
+        splits = self._splits[table]
+        for bucketcode, depth in izip(bucketcodes, depths):
+            prefix = np.uint64(bucketcode) ^ np.uint64(2**depth)
+            splits[depth] = np.union1d(splits.get(depth, np.zeros(0, dtype=np.uint64)), [prefix]).astype(np.uint64)
+
+        self._save_splits(table)
+
+        codes, depths = self._route(table, bucketvalues[CODE_ATTRIBUTE])
+        self.storage.store(codes, bucketvalues, prefix=self._keyprefix(table))
+        codes, indices = np.unique(codes, return_index=True)
+        return codes, depths[indices]
+
+    def _store_codes(self, codes, data):
+        """
+        Stores elements given their hash codes (one column per hash). In adaptive
+        mode, buckets getting too big are split. Returns the bucket codes.
+        """
+        for table, lshash in enumerate(self.lshashes):
+            if hasattr(lshash, "insert"):
+                # Hashes counting their vectors (e.g. `RandomBinaryProjectionTree`).
+                lshash.insert(codes[:, table])
+
+        if self._splits is None:
+            for table in range(len(self.lshashes)):
+                self.storage.store(codes[:, table], data, prefix=self._keyprefix(table))
+
+            return codes
+
+        for table in range(len(self.lshashes)):
+            table_data = dict(data)
+            table_data[CODE_ATTRIBUTE] = codes[:, table]
+            bucketcodes, depths = self._route(table, codes[:, table])
+            self.storage.store(bucketcodes, table_data, prefix=self._keyprefix(table))
+
+            # Split the buckets stored to until none of them is too big.
+            bucketcodes, indices = np.unique(bucketcodes, return_index=True)
+            depths = depths[indices]
+            while len(bucketcodes) > 0:
+                counts = self._count(table, bucketcodes)
+                overfull = (counts > self.max_bucket_size) & (depths < self.lshashes[table].nbits)
+                if not overfull.any():
+                    break
+
+                bucketcodes, depths = self._split(table, bucketcodes[overfull], depths[overfull], table_data.keys())
+
+        return self._bucket_codes(codes)
+
+    def _keyprefix(self, table):
+        """
+        Returns the prefix of the storage keys of hash number `table`.
+
+        When using multiple hashes, each of them has its own key namespace
+        in the storage, i.e. its keys are prefixed with the hash's name.
+        """
+        if len(self.lshashes) == 1:
+            return ""
+
+        return self.lshashes[table].name + "_"
+
     def store(self, v, **datum):
         """
         Parameters
@@ -88,24 +325,84 @@ class Engine(object):
         data: iterable of JSON-serializable object
             each datum will be stored in a bucket using the hash key
 
+        Returns
+        -------
+        bucketcodes: ndarray of uint64
+            bucket code of each element (one column per hash if there are many)
+        """
+        codes = self._hash_codes(V)
+
+        #data[NumpyData("patch", V.dtype, V.shape[1:])] = V
+        codes = self._store_codes(codes, data)
+
+        if len(self.lshashes) == 1:
+            return codes[:, 0]
+
+        return codes
+
+    def _hash_chunk(self, chunk):
+        V, data = chunk
+        return self._hash_codes(V), data
+
+    def _flush(self, buffer):
+        """
+        Stores the buffered chunks all at once (the storage groups the values
+        of each bucket together).
+        """
+        if len(buffer) == 0:
+            return
+
+        codes = np.concatenate([chunk_codes for chunk_codes, _ in buffer])
+        data = {attribute: np.concatenate([chunk_data[attribute] for _, chunk_data in buffer])
+                for attribute in buffer[0][1]}
+
+        self._store_codes(codes, data)
+
+    def store_stream(self, chunks, n_workers=None, buffer_bytes=2**30):
+        """
+        Stores vectors coming by chunks, e.g. when they don't all fit in memory.
+
+        Chunks are hashed in background by a pool of threads. Hashed chunks are
+        buffered and written to the storage, grouped by bucket, every time the
+        buffer holds more than `buffer_bytes` (at most twice that amount of
+        memory is needed while writing).
+
+        Parameters
+        ----------
+        chunks: iterable of tuples (V_chunk, data_chunk)
+            vectors and their data, as given to `store_batch`
+        n_workers: int, optional
+            number of hashing threads (default: number of CPUs)
+        buffer_bytes: int, optional
+            size of the buffer of hashed chunks
+
         Returns
         -------
         count:
             number of elements stored
         """
-        lshash = self.lshashes[0]
+        n_workers = n_workers or cpu_count()
 
-        # position = [v for k, v in data.items() if k.name == "position"]
-        # if len(position) == 1:
-        #     bucketkeys = lshash.hash_vector_with_pos(V, position[0])
-        # else:
-        with Timer("  Hashing"):
-            bucketkeys = lshash.hash_vector(V)
+        count = 0
+        buffer = []
+        buffered_bytes = 0
+        pool = ThreadPool(n_workers)
+        try:
+            for codes, data in bounded_imap(pool, self._hash_chunk, chunks, 2 * n_workers):
+                buffer.append((codes, data))
+                buffered_bytes += codes.nbytes + sum(values.nbytes for values in data.values())
+                count += len(codes)
 
-        #data[NumpyData("patch", V.dtype, V.shape[1:])] = V
-        bucketkeys = list(chunk(bucketkeys.tostring(), bucketkeys.itemsize))
-        self.storage.store(bucketkeys, data)
-        return bucketkeys
+                if buffered_bytes >= buffer_bytes:
+                    self._flush(buffer)
+                    buffer = []
+                    buffered_bytes = 0
+
+            self._flush(buffer)
+        finally:
+            pool.terminate()
+
+        return count
 
     # def store_batch_with_pos(self, V, positions, data={}):
     #     """
@@ -156,27 +453,429 @@ class Engine(object):
         neighbors = self.neighbors_batch(V, *attributes)
         return {k: v[0] for k, v in neighbors.items()}
 
-    def neighbors_batch(self, V, patches, *attributes):
+    def _union(self, buckets):
+        """
+        Concatenates the content of many buckets, removing the vectors
+        that were retrieved from more than one table.
+        """
+        candidates = {name: bucket[0] if len(bucket) == 1 else np.concatenate(bucket)
+                      for name, bucket in buckets.items() if name != SOURCES}
+
+        if len(self.lshashes) > 1:
+            _, indices_to_keep = np.unique(candidates[self.id_attribute.name].ravel(), return_index=True)
+            indices_to_keep.sort()
+            candidates = {name: values[indices_to_keep] for name, values in candidates.items()}
+
+        return candidates
+
+    def _nb_candidates(self, buckets):
+        """
+        Returns the number of distinct vectors in many buckets.
+        """
+        if len(self.lshashes) > 1:
+            return len(np.unique(np.concatenate([ids.ravel() for ids in buckets[self.id_attribute.name]])))
+
+        return sum(len(values) for values in buckets[self.distance.attribute.name])
+
+    def _retrieve(self, table, bucketcodes, attribute):
+        """
+        Retrieves buckets of hash number `table` from the storage, making sure
+        it is not used by two threads at the same time unless it is thread-safe.
+        """
+        if self._storage_lock is None:
+            return self.storage.retrieve(bucketcodes, attribute, prefix=self._keyprefix(table))
+
+        with self._storage_lock:
+            return self.storage.retrieve(bucketcodes, attribute, prefix=self._keyprefix(table))
+
+    def _count(self, table, bucketcodes):
+        """
+        Returns the number of elements of buckets of hash number `table`. In
+        adaptive mode, every element has a `CODE_ATTRIBUTE`, whose elements are
+        counted (storages don't all count the same attribute by default).
+        """
+        if self._splits is None:
+            return np.array(self.storage.count(bucketcodes, prefix=self._keyprefix(table)), dtype=np.int64)
+
+        return np.array(self.storage.count(bucketcodes, prefix=self._keyprefix(table), attribute=CODE_ATTRIBUTE),
+                        dtype=np.int64)
+
+    def _retrieve_rows(self, table, bucketcodes, attribute, rows):
+        """
+        Same as `_retrieve` but only for the elements at offsets `rows` of each bucket.
+        """
+        if self._storage_lock is None:
+            return self.storage.retrieve_rows(bucketcodes, attribute, rows, prefix=self._keyprefix(table))
+
+        with self._storage_lock:
+            return self.storage.retrieve_rows(bucketcodes, attribute, rows, prefix=self._keyprefix(table))
+
+    def _retrieve_candidates(self, bucketcodes, attributes):
+        """
+        Retrieves the content of many buckets at once. `bucketcodes` has one row
+        per group of buckets to retrieve and one column per hash.
+
+        Returns a list with the buckets of each row ({attribute name: list of arrays}).
+        """
+        buckets = [defaultdict(lambda: []) for _ in bucketcodes]
+        for table in range(bucketcodes.shape[1]):
+            # The same bucket of a table can be part of many groups.
+            unique_codes, indices = np.unique(bucketcodes[:, table], return_inverse=True)
+            for bucket, bucketcode in izip(buckets, bucketcodes[:, table]):
+                bucket[SOURCES].append((table, bucketcode))
+
+            for attribute in attributes:
+                results = self._retrieve(table, unique_codes, attribute)
+                for bucket, idx in izip(buckets, indices):
+                    bucket[attribute.name].append(results[idx])
+
+        return [dict(bucket) for bucket in buckets]
+
+    def _fetch(self, bucketcodes, attributes):
+        """
+        Yields the candidates of every group of buckets in `bucketcodes`, fetching
+        them by windows of `fetch_window` groups.
+
+        Windows are fetched in background by a pool of `fetch_workers` threads
+        while the current one is being consumed (storage I/O and deserialization
+        mostly release the GIL). Windows are yielded in order and at most
+        `prefetch_windows` of them are fetched ahead.
+        """
+        if len(bucketcodes) <= self.fetch_window:
+            # Nothing to overlap with.
+            for candidates in self._retrieve_candidates(bucketcodes, attributes):
+                yield candidates
+            return
+
+        windows = chunk(bucketcodes, self.fetch_window)
+        pool = ThreadPool(self.fetch_workers)
+        try:
+            retrieve = partial(self._retrieve_candidates, attributes=attributes)
+            for results in bounded_imap(pool, retrieve, windows, self.prefetch_windows):
+                for candidates in results:
+                    yield candidates
+        finally:
+            pool.terminate()
+
+    def _probes(self, v, bucketcodes):
+        """
+        Yields (table, bucketcode) of the buckets to probe for query `v` (a row,
+        dense or sparse), merging the probing sequences of every hash.
+
+        Hashes that do not expose their projections are probed by increasing
+        Hamming distance (i.e. all one-bit flips, then all two-bit flips, ...),
+        unless they give their own probing sequence (see `RandomBinaryProjectionTree`).
+
+        In adaptive mode, a bucket can be yielded many times (e.g. flipping
+        bits not used by the bucket matching `v`).
+        """
+        sequences = []
+        for table, lshash in enumerate(self.lshashes):
+            if hasattr(lshash, "probes"):
+                sequences.append(izip(lshash.probes(v, bucketcodes[table]), repeat(table)))
+                continue
+
+            try:
+                margins = np.abs(lshash.project(v)[0])
+            except NotImplementedError:
+                margins = np.ones(lshash.nbits)
+
+            sequences.append(izip(probe_sequence(bucketcodes[table], margins), repeat(table)))
+
+        for (score, bucketcode), table in merge(*sequences):
+            if self._splits is not None:
+                bucketcode = self._route(table, [bucketcode])[0][0]
+
+            yield table, bucketcode
+
+    def _guaranteed_ranges(self, bucketcodes):
+        """
+        Returns, for every hash guaranteeing a minimum number of results (see
+        `RandomBinaryProjectionTree`), the ranges of its leaves to probe for
+        each query, by table.
+        """
+        return {table: lshash.guaranteed_ranges(bucketcodes[:, table])
+                for table, lshash in enumerate(self.lshashes) if hasattr(lshash, "guaranteed_ranges")}
+
+    def _guaranteed_probes(self, bucketcodes, ranges, patch_id):
+        """
+        Yields (table, bucketcode) of the buckets guaranteed by the hashes to
+        query `patch_id`, given the ranges of the batch (see `_guaranteed_ranges`).
+        """
+        for table, (starts, ends) in ranges.items():
+            codes = self.lshashes[table].range_codes(bucketcodes[patch_id, table], starts[patch_id], ends[patch_id])
+            if self._splits is not None:
+                codes = self._route(table, codes)[0]
+
+            for bucketcode in codes:
+                yield table, bucketcode
+
+    def _probe_candidates(self, v, bucketcodes, buckets, attributes, min_nb_neighbours, cache, guaranteed=()):
+        """
+        Adds to `buckets` the content of the neighboring buckets of query `v` (a row) until
+        there are at least `min_nb_neighbours` candidates or `max_probes` is reached.
+        The buckets of `guaranteed` (see `_guaranteed_probes`) are probed first
+        and don't count in `max_probes`.
+
+        Probed buckets are kept in `cache`, so queries sharing the same buckets
+        only fetch them once.
+        """
+        buckets = {name: list(values) for name, values in buckets.items()}
+        probed = set((table, int(bucketcode)) for table, bucketcode in buckets[SOURCES])
+
+        for table, bucketcode in chain(guaranteed, islice(self._probes(v, bucketcodes), self.max_probes)):
+            if self._nb_candidates(buckets) >= min_nb_neighbours:
+                break
+
+            key = (table, int(bucketcode))
+            if key in probed:
+                continue
+
+            probed.add(key)
+            if key not in cache:
+                bucketcodes_probed = np.array([bucketcode], dtype=np.uint64)
+                cache[key] = {attribute.name: self._retrieve(table, bucketcodes_probed, attribute)[0]
+                              for attribute in attributes}
+
+            for name, values in cache[key].items():
+                buckets[name].append(values)
+
+            buckets[SOURCES].append(key)
+
+        return buckets
+
+    def _nearest(self, chain, patch_ids, patches, buckets, attributes):
+        """
+        Yields the neighbors among the content of `buckets` of every query patch
+        when the filters keep the K nearest. Distances are computed bucket by
+        bucket, keeping only the K nearest candidates seen so far (see `TopK`),
+        then the attributes are gathered once for those candidates only.
+        """
+        parts = buckets[self.distance.attribute.name]
+        keys = buckets[self.id_attribute.name] if len(self.lshashes) > 1 else [None] * len(parts)
+        starts = np.cumsum([0] + [len(part) for part in parts])
+
+        nb_queries_per_block = max(1, DISTANCES_BUFFER_SIZE // (chain.K + max(len(part) for part in parts)))
+        for block in chunk(patch_ids, nb_queries_per_block):
+            topk = TopK(chain.K, len(block))
+            for part, part_keys in izip(parts, keys):
+                if len(part) > 0:
+                    distances = self.distance.pairwise(patches[block], part)
+                    topk.push(distances, part_keys, chain.mask(distances))
+
+            distances, indices = topk.result()
+            valid = indices >= 0
+
+            # Gather the attributes of the selected candidates, bucket by bucket.
+            selected = indices[valid]
+            part_ids = np.searchsorted(starts, selected, side="right") - 1
+            columns = {}
+            for attribute in attributes:
+                values = buckets.get(attribute.name)
+                if values is None:
+                    values = self._materialize(buckets[SOURCES], attribute, selected - starts[part_ids], part_ids)
+                first = next(value for value in values if value is not None)
+                column = np.empty((len(selected),) + first.shape[1:], dtype=first.dtype)
+                for j in np.unique(part_ids):
+                    mask = part_ids == j
+                    column[mask] = values[j][selected[mask] - starts[j]]
+
+                columns[attribute.name] = column
+
+            bounds = np.concatenate([[0], np.cumsum(valid.sum(axis=1))])
+            for i, patch_id in enumerate(block):
+                neighbors = {'dist': distances[i][valid[i]]}
+                for name, column in columns.items():
+                    neighbors[name] = column[bounds[i]:bounds[i+1]]
+
+                yield patch_id, neighbors
+
+    def _materialize(self, sources, attribute, rows, part_ids):
+        """
+        Retrieves an attribute that was not retrieved with the buckets, only for
+        the elements at offsets `rows` of the buckets `part_ids`. Returns the
+        values as a list of arrays (one per bucket, only the ones needed filled).
+        """
+        values = [None] * len(sources)
+        unique_part_ids = np.unique(part_ids) if len(part_ids) > 0 else [0]  # At least one, for the dtype.
+        for table in set(sources[j][0] for j in unique_part_ids):
+            table_part_ids = [j for j in unique_part_ids if sources[j][0] == table]
+            bucketcodes = np.array([sources[j][1] for j in table_part_ids], dtype=np.uint64)
+            bucket_rows = [np.unique(rows[part_ids == j]) for j in table_part_ids]
+            results = self._retrieve_rows(table, bucketcodes, attribute, bucket_rows)
+
+            # Buckets are indexed by element offset, only the ones retrieved are set.
+            for j, bucket_row, result in izip(table_part_ids, bucket_rows, results):
+                size = bucket_row[-1] + 1 if len(bucket_row) > 0 else 0
+                bucket = np.empty((size,) + result.shape[1:], dtype=result.dtype)
+                bucket[bucket_row] = result
+                values[j] = bucket
+
+        return values
+
+    def _rerank(self, chain, patch_ids, patches, buckets, attributes):
+        """
+        Yields the filtered neighbors among the content of `buckets` of every query
+        patch, computing the distance only for the candidates shortlisted by
+        `prefilter_distance`.
+        """
+        candidates = self._union(buckets)
+        codes = candidates[self.prefilter_distance.attribute.name]
+        nb_candidates = len(codes)
+        shortlist = min(self.shortlist, nb_candidates)
+
+        nb_queries_per_block = max(1, DISTANCES_BUFFER_SIZE // max(1, nb_candidates))
+        for block in chunk(patch_ids, nb_queries_per_block):
+            prefilter_distances = self.prefilter_distance.pairwise(patches[block], codes)
+            if shortlist < nb_candidates:
+                shortlists = np.argpartition(prefilter_distances, shortlist - 1, axis=1)[:, :shortlist]
+            else:
+                shortlists = np.tile(np.arange(nb_candidates), (len(block), 1))
+
+            # Distances to the candidates shortlisted by any query of the block are computed at once.
+            shortlisted, positions = np.unique(shortlists, return_inverse=True)
+            distances = self.distance.pairwise(patches[block], candidates[self.distance.attribute.name][shortlisted])
+            distances = distances[np.arange(len(block))[:, None], positions.reshape(shortlists.shape)]
+
+            indices = chain.filter_batch(distances)
+            for patch_id, dist, rows, indices_to_keep in izip(block, distances, shortlists, indices):
+                neighbors = {'dist': dist[indices_to_keep]}
+                for attribute in attributes:
+                    neighbors[attribute.name] = candidates[attribute.name][rows[indices_to_keep]]
+
+                yield patch_id, neighbors
+
+    def _score(self, patch_ids, patches, buckets, attributes):
+        """
+        Yields the filtered neighbors among the content of `buckets` of every query patch.
+        """
+        chain = FilterChain(self.filters)
+        if self.prefilter_distance is not None:
+            for patch_id, neighbors in self._rerank(chain, patch_ids, patches, buckets, attributes):
+                yield patch_id, neighbors
+            return
+
+        if chain.fused and chain.K is not None:
+            for patch_id, neighbors in self._nearest(chain, patch_ids, patches, buckets, attributes):
+                yield patch_id, neighbors
+            return
+
+        candidates = self._union(buckets)
+        #Patches.set_value(buckets[self.distance.attribute.name].reshape((-1, 9)))
+        #start_loop = time()
+        nb_candidates = len(candidates[self.distance.attribute.name])
+        nb_queries_per_block = max(1, DISTANCES_BUFFER_SIZE // max(1, nb_candidates))
+        for block in chunk(patch_ids, nb_queries_per_block):
+            # Distances between every query of the block and every candidate
+            #with Timer("    Distance "):
+            distances = self.distance.pairwise(patches[block], candidates[self.distance.attribute.name])
+
+            # The whole chain of filters is applied to the block at once.
+            indices = chain.filter_batch(distances)
+
+            for patch_id, dist, indices_to_keep in izip(block, distances, indices):
+                neighbors = {'dist': dist[indices_to_keep]}
+                for attribute in attributes:
+                    neighbors[attribute.name] = candidates[attribute.name][indices_to_keep]
+
+                yield patch_id, neighbors
+        #print "Looping:  {:.2f} ({} x {})".format(time()-start_loop, len(patch_ids), nb_candidates)
+
+    def _query_attributes(self, attributes):
+        """
+        Returns the attributes to retrieve, including the ones needed by the engine.
+        """
         if self.distance is not None:
             if self.distance.attribute not in attributes:
                 attributes += (self.distance.attribute,)
 
-        start = time()
-        lshash = self.lshashes[0]
-        nbits_range = range(lshash.nbits)
+        if self.prefilter_distance is not None:
+            if self.prefilter_distance.attribute not in attributes:
+                attributes += (self.prefilter_distance.attribute,)
+
+        if len(self.lshashes) > 1:
+            if self.id_attribute is None:
+                raise ValueError("An `id_attribute` is needed to query multiple hashes.")
+
+            if self.id_attribute not in attributes:
+                attributes += (self.id_attribute,)
 
-        with Timer("  Hashing"):
-            bucketkeys = lshash.hash_vector(V)
+        return attributes
 
+    def _group_queries(self, bucketcodes):
+        """
+        Groups the queries falling in the same bucket of every hash.
+
+        Returns the bucket codes of each group and the group of each query.
+        """
+        rows = np.ascontiguousarray(bucketcodes).view(np.dtype((np.void, bucketcodes.itemsize * bucketcodes.shape[1])))
+        _, unique_indices, patch2bucket_indices = np.unique(rows.ravel(), return_index=True, return_inverse=True)
+        return bucketcodes[unique_indices], patch2bucket_indices
+
+    def neighbors_batch(self, V, patches, *attributes):
+        attributes = self._query_attributes(attributes)
+        bucketcodes = self._hash_codes(V)
+
+        for patch_id, neighbors in self._neighbors(V, patches, bucketcodes, attributes):
+            yield patch_id, neighbors
+
+    def neighbors_parallel(self, V, patches, *attributes, **kwargs):
+        """
+        Same as `neighbors_batch` but queries are processed by a pool of processes,
+        the neighbors of the queries of a shard being yielded as soon as it is done.
+
+        Queries are split into shards so that the queries falling in the same
+        buckets are processed by the same worker (i.e. each bucket is fetched
+        only once). Each worker uses its own read-only handle on the storage.
+
+        Parameters
+        ----------
+        V: ndarray
+            each row will be used to generate an hash key
+        patches: ndarray
+            query patches given to the distance
+        n_workers: int, optional
+            number of processes (default: number of CPUs)
+
+        Return
+        ------
+        neighbors: iterator of (int, dict)
+            index of a query in `V` and its neighbors (in no particular order)
+        """
+        n_workers = kwargs.get("n_workers") or cpu_count()
+        attributes = self._query_attributes(attributes)
+        bucketcodes = self._hash_codes(V)
+
+        # Sort queries by group, then cut shards of about the same number of
+        # queries without splitting any group.
+        _, patch2bucket_indices = self._group_queries(self._bucket_codes(bucketcodes))
+        order = np.argsort(patch2bucket_indices, kind="mergesort")
+        sorted_groups = patch2bucket_indices[order]
+        nb_shards = min(len(order), 4 * n_workers)
+        cuts = np.linspace(0, len(order), nb_shards+1)[1:-1].astype(int)
+        cuts = np.unique(np.searchsorted(sorted_groups, sorted_groups[cuts]))
+        shards = [shard for shard in np.split(order, cuts) if len(shard) > 0]
+
+        pool = Pool(n_workers, _init_worker, (self, V, patches, bucketcodes, attributes))
+        try:
+            for shard_results in pool.imap_unordered(_neighbors_shard, shards):
+                for patch_id, neighbors in shard_results:
+                    yield patch_id, neighbors
+        finally:
+            pool.terminate()
+
+    def _neighbors(self, V, patches, bucketcodes, attributes):
+        """
+        Yields the neighbors of every query given the hash codes of the queries.
+        """
+        start = time()
         with Timer("  Uniquifying"):
-            # Fetch only buckets that are unique
-            unique_bucketkeys, patch2bucket_indices = np.unique(bucketkeys, return_inverse=True)
-            #unique_bucketkeys, patch2bucket_indices = np.unique(bucketkeys.view("int64"), return_inverse=True)
-            #unique_bucketkeys = unique_bucketkeys.view("|S8")
+            # Fetch only buckets that are unique (i.e. same bucket in every table)
+            unique_bucketcodes, patch2bucket_indices = self._group_queries(self._bucket_codes(bucketcodes))
 
-            bucket2patch_indices = defaultdict(lambda: [])
-            for i, idx in enumerate(patch2bucket_indices):
-                bucket2patch_indices[idx] += [i]
+            # Queries of group i are `order[bounds[i]:bounds[i+1]]`.
+            order = np.argsort(patch2bucket_indices, kind="mergesort")
+            bounds = np.concatenate([[0], np.cumsum(np.bincount(patch2bucket_indices))])
 
         # with Timer("  Counting"):
         #     bucketcounts = np.array(self.storage.count(unique_bucketkeys))
@@ -186,61 +885,39 @@ class Engine(object):
         #indices_sorted = np.argsort(bucketcounts)[::-1]
         #sorted_bucketcounts = bucketcounts[indices_sorted]
 
-        #import theano
-        #import theano.tensor as T
-        # Patches = theano.shared(np.zeros((1, 9), dtype="float32"))
-        # query = T.vector()
-        # distances = T.sqrt(T.mean((Patches - query) ** 2, axis=1))
-        # f_dist = theano.function([query], T.argsort(distances)[:100])
+        min_nb_neighbours = max([f.K for f in self.filters if hasattr(f, "K")] or [0])
 
-        min_nb_neighbours = max([f.K for f in self.filters if hasattr(f, "K")])
+        # Leaves of the tree hashes to probe for each query, computed for the whole batch.
+        guaranteed = self._guaranteed_ranges(bucketcodes) if self.max_probes != 0 else {}
+
+        # Attributes retrieved with the buckets, the other ones are retrieved once scored.
+        fetched_attributes = attributes
+        chain = FilterChain(self.filters)
+        if self.lazy and chain.fused and chain.K is not None and self.prefilter_distance is None:
+            needed = [self.distance.attribute] + ([self.id_attribute] if len(self.lshashes) > 1 else [])
+            fetched_attributes = tuple(attribute for attribute in attributes if attribute in needed)
 
-        buckets = {}
         start = time()
-        for i, bucketkey in enumerate(chunk(unique_bucketkeys.tostring(), unique_bucketkeys.itemsize)):
+        candidates_iter = self._fetch(unique_bucketcodes, fetched_attributes)
+        for i, candidates in enumerate(candidates_iter):
             if i % 1000 == 0:
-                print("{:,}/{:,} ({:.2f} sec.)".format(i, len(unique_bucketkeys), time()-start))
+                print("{:,}/{:,} ({:.2f} sec.)".format(i, len(unique_bucketcodes), time()-start))
                 start = time()
 
-            #with Timer("  Fetching"):
-            for attribute in attributes:
-                buckets[attribute.name] = self.storage.retrieve([bucketkey], attribute)[0]
-
-            # TODO: Generalize to more than one bit flipping
-            #with Timer("  Checking bucket's neighbors"):
-            if len(buckets[self.distance.attribute.name]) < min_nb_neighbours:
-                newkeys_str = flip(np.fromstring(bucketkey, dtype=np.uint64), nbits_range).tostring()
-                newkeys = list(chunk(newkeys_str, unique_bucketkeys.itemsize))
-
-                for attribute in attributes:
-                    buckets[attribute.name] = np.vstack([buckets[attribute.name]] + self.storage.retrieve(newkeys, attribute))
-
-            #Patches.set_value(buckets[self.distance.attribute.name].reshape((-1, 9)))
-            #start_loop = time()
-            for j, patch_id in enumerate(bucket2patch_indices[i]):
-                neighbors = {}
-
-                # Distance
-                #with Timer("    Distance "):
-                neighbors['dist'] = self.distance(patches[patch_id], buckets[self.distance.attribute.name])
-
-                # Apply filters
-                for k, f in enumerate(self.filters):
-                    #with Timer("    Filtering"):
-                    indices_to_keep = list(f(neighbors['dist']))
-                    #indices_to_keep = f_dist(patches[patch_id].flatten())
-                    neighbors['dist'] = neighbors['dist'][indices_to_keep]
-
-                    for attribute in attributes:
-                        # If the it's the first filter we take our data from the bucket.
-                        # Otherwise, we use the previously filtered neighbours.
-                        if k == 0:
-                            neighbors[attribute.name] = buckets[attribute.name][indices_to_keep]
-                        else:
-                            neighbors[attribute.name] = neighbors[attribute.name][indices_to_keep]
-
-                yield patch_id, neighbors
-            #print "Looping:  {:.2f} ({} x {})".format(time()-start_loop, len(bucket2patch_indices[i]), len(buckets[self.distance.attribute.name]))
+            if self.max_probes == 0 or self._nb_candidates(candidates) >= min_nb_neighbours:
+                groups = [(order[bounds[i]:bounds[i+1]], candidates)]
+            else:
+                # Not enough candidates, each query probes neighboring buckets
+                # following its own sequence (query-directed probing).
+                cache = {}
+                groups = (([patch_id], self._probe_candidates(
+                               V[patch_id:patch_id+1], bucketcodes[patch_id], candidates, fetched_attributes,
+                               min_nb_neighbours, cache, self._guaranteed_probes(bucketcodes, guaranteed, patch_id)))
+                          for patch_id in order[bounds[i]:bounds[i+1]])
+
+            for patch_ids, candidates in groups:
+                for patch_id, neighbors in self._score(patch_ids, patches, candidates, attributes):
+                    yield patch_id, neighbors
 
     def neighbors_batch_with_pos(self, V, positions, radius, *attributes):
         if self.distance is not None:
@@ -326,6 +1003,9 @@ class Engine(object):
         count is 1000 or something you have to change the hash so that each bucket
         has less entries (increase projection count for example).
 
+        When using multiple hashes, the counts of every table are summed up
+        (i.e. vectors retrieved from more than one table are counted many times).
+
         Parameters
         ----------
         V: iterable of ndarrays
@@ -336,10 +1016,12 @@ class Engine(object):
         counts: list of int
             candidate count of each element in `V`
         """
-        lshash = self.lshashes[0]
-        bucketkeys = lshash.hash_vector(V)
-        counts = self.storage.count(bucketkeys)
-        return counts
+        codes = self._bucket_codes(self._hash_codes(V))
+        counts = np.zeros(len(codes), dtype=np.int64)
+        for table in range(len(self.lshashes)):
+            counts += self._count(table, codes[:, table])
+
+        return list(counts)
 
     def buckets_size(self):
         bucketkeys = self.storage.bucketkeys()
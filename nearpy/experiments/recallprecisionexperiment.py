@@ -28,8 +28,12 @@ import sys
 
 from scipy.spatial.distance import cdist
 
+from nearpy.data import NumpyData
 from nearpy.utils import numpy_array_from_list_or_numpy_array
 
+# Index of the stored vectors, retrieved with the neighbours.
+INDEX_ATTRIBUTE = NumpyData("index", numpy.dtype("int64"), ())
+
 
 class RecallPrecisionExperiment(object):
     """
@@ -58,19 +62,12 @@ class RecallPrecisionExperiment(object):
         as columns OR a python array containing the individual
         numpy vectors.
         """
-        # We need a dict from vector string representation to index
-        self.vector_dict = {}
         self.N = N
         self.coverage_ratio = coverage_ratio
 
         # Get numpy array representation of input
         self.vectors = numpy_array_from_list_or_numpy_array(vectors)
 
-        # Build map from vector string representation to vector
-        for index in range(self.vectors.shape[1]):
-            self.vector_dict[self.__vector_to_string(
-                self.vectors[:, index])] = index
-
         # Get transposed version of vector matrix, so that the rows
         # are the vectors (needed by cdist)
         vectors_t = numpy.transpose(self.vectors)
@@ -112,6 +109,9 @@ class RecallPrecisionExperiment(object):
         Performs nearest neighbour recall experiments with custom vector data
         for all engines in the specified list.
 
+        Each engine needs a distance: the vectors are stored under its
+        attribute, along with their index (`INDEX_ATTRIBUTE`).
+
         Returns self.result contains list of (recall, precision, search_time)
         tuple. All are the averaged values over all request vectors.
         search_time is the average retrieval/search time compared to the
@@ -120,6 +120,10 @@ class RecallPrecisionExperiment(object):
         # We will fill this array with measures for all the engines.
         result = []
 
+        # One vector per row, as the engines expect them.
+        vectors_t = numpy.ascontiguousarray(self.vectors.T, dtype=numpy.float32)
+        queries = vectors_t[self.query_indices]
+
         # For each engine, first index vectors and then retrieve neighbours
         for engine in engine_list:
             print('Engine %d / %d' % (engine_list.index(engine),
@@ -127,40 +131,33 @@ class RecallPrecisionExperiment(object):
 
             # Clean storage
             engine.clean_all_buckets()
+
+            # Index all vectors and store them
+            engine.store_batch(vectors_t, {engine.distance.attribute: vectors_t,
+                                           INDEX_ATTRIBUTE: numpy.arange(len(vectors_t))})
+
+            # Look for N nearest neighbours of every query vector at once
+            search_time_start = time.time()
+            neighbors = dict(engine.neighbors_batch(queries, queries, INDEX_ATTRIBUTE))
+            avg_search_time = (time.time() - search_time_start) / float(len(queries))
+
             # Use this to compute average recall
             avg_recall = 0.0
             # Use this to compute average precision
             avg_precision = 0.0
-            # Use this to compute average search time
-            avg_search_time = 0.0
-
-            # Index all vectors and store them
-            for index in range(self.vectors.shape[1]):
-                engine.store_vector(self.vectors[:, index],
-                                    'data_%d' % index)
 
-            # Look for N nearest neighbours for query vectors
-            for index in self.query_indices:
+            for query_id, index in enumerate(self.query_indices):
                 # Get indices of the real nearest as set
                 real_nearest = set(self.closest[index])
 
-                # We have to time the search
-                search_time_start = time.time()
-
-                # Get nearest N according to engine
-                nearest = engine.neighbours(self.vectors[:, index])
-
-                # Get search time
-                search_time = time.time() - search_time_start
-
                 # For comparance we need their indices (as set)
-                nearest = set([self.__index_of_vector(x[0]) for x in nearest])
+                nearest = set(neighbors[query_id][INDEX_ATTRIBUTE.name].ravel()) if query_id in neighbors else set()
 
                 # Remove query index from search result to make sure that
                 # recall and precision make sense in terms of "neighbours".
                 # If ONLY the query vector is retrieved, we want recall to be
                 # zero!
-                nearest.remove(index)
+                nearest.discard(index)
 
                 # If the result list is empty, recall and precision are 0.0
                 if len(nearest) == 0:
@@ -183,18 +180,12 @@ class RecallPrecisionExperiment(object):
                 # Add to accumulator
                 avg_precision += precision
 
-                # Add to accumulator
-                avg_search_time += search_time
-
             # Normalize recall over query set
             avg_recall = avg_recall / float(len(self.query_indices))
 
             # Normalize precision over query set
             avg_precision = avg_precision / float(len(self.query_indices))
 
-            # Normalize search time over query set
-            avg_search_time = avg_search_time / float(len(self.query_indices))
-
             # Normalize search time with respect to exact search
             avg_search_time /= self.exact_search_time_per_vector
 
@@ -206,11 +197,3 @@ class RecallPrecisionExperiment(object):
 
         # Return (recall, precision, search_time) tuple
         return result
-
-    def __vector_to_string(self, vector):
-        """ Returns string representation of vector. """
-        return numpy.array_str(vector)
-
-    def __index_of_vector(self, vector):
-        """ Returns index of specified vector from test data set. """
-        return self.vector_dict[self.__vector_to_string(vector)]
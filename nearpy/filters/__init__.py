@@ -23,6 +23,7 @@ from __future__ import absolute_import
 
 from nearpy.filters.vectorfilter import VectorFilter
 from nearpy.filters.distancethresholdfilter import DistanceThresholdFilter
-from nearpy.filters.nearestfilter import NearestFilter
+from nearpy.filters.nearestfilter import NearestFilter, TopK
 from nearpy.filters.uniquefilter import UniqueFilter
 from nearpy.filters.sortedfilter import SortedFilter
+from nearpy.filters.filterchain import FilterChain
@@ -39,4 +39,10 @@ class DistanceThresholdFilter(VectorFilter):
         """
         Returns subset of specified input list.
         """
-        return np.where(distances < self.threshold)[0]
+        return np.where(self.mask(distances))[0]
+
+    def mask(self, distances):
+        """
+        Returns which distances (any shape) are kept.
+        """
+        return distances < self.threshold
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 Ole Krause-Sparmann
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import numpy as np
+
+from nearpy.filters.nearestfilter import NearestFilter
+from nearpy.filters.sortedfilter import SortedFilter
+
+
+class FilterChain(object):
+    """
+    Filters applied one after the other, compiled into a single plan when
+    possible: thresholds (filters having a `mask` method) are combined into one
+    boolean mask and nearest/sorted filters into one final selection, since
+    these filters commute (e.g. the K nearest under a threshold are the K
+    nearest filtered by the threshold). The chain is then applied at once and
+    the attributes of the neighbors only need to be gathered once.
+
+    Chains with other filters are applied sequentially (`fused` is False).
+    """
+
+    def __init__(self, filters):
+        self.filters = list(filters)
+        self.thresholds = [f for f in self.filters if hasattr(f, "mask")]
+        Ks = [f.K for f in self.filters if isinstance(f, NearestFilter)]
+        self.K = min(Ks) if len(Ks) > 0 else None
+        self.sort = any(isinstance(f, (NearestFilter, SortedFilter)) for f in self.filters)
+        self.fused = all(hasattr(f, "mask") or isinstance(f, (NearestFilter, SortedFilter))
+                         for f in self.filters)
+
+    def mask(self, distances):
+        """
+        Returns which distances are kept by the thresholds (None if there are none).
+        """
+        mask = None
+        for f in self.thresholds:
+            mask = f.mask(distances) if mask is None else mask & f.mask(distances)
+
+        return mask
+
+    def filter_batch(self, distances):
+        """
+        Returns, for every row of a matrix of distances, the indices to keep.
+        """
+        if not self.fused:
+            indices = [np.arange(distances.shape[1])] * len(distances)
+            for f in self.filters:
+                indices = [row_indices[f(row[row_indices])] for row, row_indices in zip(distances, indices)]
+
+            return indices
+
+        mask = self.mask(distances)
+        if self.K is not None:
+            if mask is not None:
+                distances = np.where(mask, distances, np.inf)
+
+            indices = NearestFilter(self.K).filter_batch(distances)
+            if mask is None:
+                return indices
+
+            rows = np.arange(len(distances))[:, None]
+            return [row_indices[row_mask] for row_indices, row_mask in zip(indices, mask[rows, indices])]
+
+        if mask is None:
+            indices = [np.arange(distances.shape[1])] * len(distances)
+        else:
+            indices = [np.flatnonzero(row_mask) for row_mask in mask]
+
+        if self.sort:
+            indices = [row_indices[np.argsort(row[row_indices])] for row, row_indices in zip(distances, indices)]
+
+        return indices
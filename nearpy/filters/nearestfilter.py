@@ -39,4 +39,86 @@ class NearestFilter(VectorFilter):
         """
         Returns subset of specified input list.
         """
-        return np.argsort(distances)[:self.K]
+        if len(distances) <= self.K:
+            return np.argsort(distances)
+
+        # Only the K nearest are sorted.
+        indices = np.argpartition(distances, self.K-1)[:self.K]
+        return indices[np.argsort(distances[indices])]
+
+    def filter_batch(self, distances):
+        """
+        Returns, for every row of a matrix of distances, the indices of the
+        N nearest sorted with respect to distance.
+        """
+        if distances.shape[1] > self.K:
+            indices = np.argpartition(distances, self.K-1, axis=1)[:, :self.K]
+        else:
+            indices = np.tile(np.arange(distances.shape[1]), (len(distances), 1))
+
+        rows = np.arange(len(distances))[:, None]
+        return indices[rows, np.argsort(distances[rows, indices], axis=1)]
+
+
+class TopK(object):
+    """
+    Running selection of the K nearest candidates of a batch of queries, for
+    candidates coming by parts (e.g. from many buckets). Only the K nearest
+    seen so far are kept after each part.
+
+    Candidates are identified by their index in the concatenation of the parts.
+    When `keys` are given, candidates having the same key (e.g. the same vector
+    retrieved from many tables) are kept only once.
+    """
+
+    def __init__(self, K, nb_queries):
+        self.K = K
+        self.nb_candidates = 0
+        self.distances = np.zeros((nb_queries, 0))
+        self.indices = np.zeros((nb_queries, 0), dtype=np.int64)
+        self.keys = None
+
+    def push(self, distances, keys=None, mask=None):
+        """
+        Adds a part of candidates given their distances to every query. If
+        given, `mask` tells which candidates can be kept for each query.
+        """
+        nb_queries, nb_candidates = distances.shape
+        indices = np.tile(np.arange(self.nb_candidates, self.nb_candidates + nb_candidates), (nb_queries, 1))
+        self.nb_candidates += nb_candidates
+
+        if mask is not None:
+            distances = np.where(mask, distances, np.inf)
+            indices[~mask] = -1
+
+        self.distances = np.hstack([self.distances, distances])
+        self.indices = np.hstack([self.indices, indices])
+        rows = np.arange(nb_queries)[:, None]
+
+        if keys is not None:
+            keys = np.tile(np.asarray(keys).ravel(), (nb_queries, 1))
+            self.keys = keys if self.keys is None else np.hstack([self.keys, keys])
+
+            # Duplicates have the same distance, only one of them is kept (not one already discarded).
+            order = np.lexsort((self.indices < 0, self.keys), axis=1)
+            sorted_keys = self.keys[rows, order]
+            duplicates = np.zeros(sorted_keys.shape, dtype=bool)
+            duplicates[:, 1:] = sorted_keys[:, 1:] == sorted_keys[:, :-1]
+            self.distances[rows, order] = np.where(duplicates, np.inf, self.distances[rows, order])
+            self.indices[rows, order] = np.where(duplicates, -1, self.indices[rows, order])
+
+        if self.distances.shape[1] > self.K:
+            kept = np.argpartition(self.distances, self.K-1, axis=1)[:, :self.K]
+            self.distances = self.distances[rows, kept]
+            self.indices = self.indices[rows, kept]
+            if self.keys is not None:
+                self.keys = self.keys[rows, kept]
+
+    def result(self):
+        """
+        Returns the distances and indices of the K nearest candidates of every
+        query, sorted with respect to distance. Missing ones have index -1.
+        """
+        rows = np.arange(len(self.distances))[:, None]
+        order = np.argsort(self.distances, axis=1, kind="mergesort")
+        return self.distances[rows, order], self.indices[rows, order]
@@ -10,3 +10,6 @@ class SortedFilter(VectorFilter):
 
     def __call__(self, distances):
         return np.argsort(distances)
+
+    def filter_batch(self, distances):
+        return np.argsort(distances, axis=1)
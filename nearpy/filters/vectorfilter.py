@@ -54,3 +54,9 @@ class VectorFilter(object):
         Returns subset of specified input list.
         """
         raise NotImplementedError
+
+    def filter_batch(self, distances):
+        """
+        Returns, for every row of a matrix of distances, the indices to keep.
+        """
+        return [self(row) for row in distances]
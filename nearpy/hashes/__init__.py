@@ -3,13 +3,13 @@
 from __future__ import absolute_import
 
 from nearpy.hashes.hashing import Hashing
-from nearpy.hashes.randompcabinaryprojections import RandomPCABinaryProjections
+#from nearpy.hashes.randompcabinaryprojections import RandomPCABinaryProjections
 
 from nearpy.hashes.locality_sensitive_hashing import LocalitySensitiveHashing
 from nearpy.hashes.pca_hashing import PCAHashing
 from nearpy.hashes.spectral_hashing import SpectralHashing
+from nearpy.hashes.randombinaryprojectiontree import RandomBinaryProjectionTree
 
-#from nearpy.hashes.randomdiscretizedprojections import RandomDiscretizedProjections
-#from nearpy.hashes.pcadiscretizedprojections import PCADiscretizedProjections
-#from nearpy.hashes.randombinaryprojectiontree import RandomBinaryProjectionTree
+from nearpy.hashes.randomdiscretizedprojections import DiscretizedProjections, RandomDiscretizedProjections
+from nearpy.hashes.pcadiscretizedprojections import PCADiscretizedProjections
 from nearpy.hashes.unibucket import UniBucket
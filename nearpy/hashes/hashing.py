@@ -2,6 +2,8 @@
 
 import numpy as np
 
+from nearpy.utils import pack_bits
+
 
 class Hashing(object):
     """ Interface for hashing functions. """
@@ -15,7 +17,8 @@ class Hashing(object):
         self.nbits = nbits
 
         # It's more efficient to store uint than bitcodes represented as string.
-        self.bits_to_int = np.array([np.uint(2**i) for i in range(self.nbits)])
+        # Bucket codes hold (at most) the first 64 bits, see `codes` for longer ones.
+        self.bits_to_int = np.array([np.uint(2**i) for i in range(min(self.nbits, 64))])
 
     def hash_vector(self, V):
         """
@@ -26,6 +29,22 @@ class Hashing(object):
         """
         raise NotImplementedError
 
+    def project(self, V):
+        """
+        Returns the projections of the vectors, one column per bit. The sign
+        of a projection gives the bit and its magnitude how far the vector
+        is from flipping it (this is used for multi-probing).
+        """
+        raise NotImplementedError
+
+    def codes(self, V):
+        """
+        Returns the full binary codes of the vectors (the signs of all their
+        projections) packed in uint64 words, one row per vector. Unlike bucket
+        codes, they can be longer than 64 bits. See `HammingDistance`.
+        """
+        return pack_bits(self.project(V) > 0)
+
     def __getstate__(self):
         state = {}
         state.update(self.__dict__)
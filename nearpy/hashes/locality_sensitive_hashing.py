@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
+import scipy.sparse
 
 import nearpy.utils.utils as utils
 from nearpy.hashes.hashing import Hashing
@@ -26,11 +27,11 @@ class LocalitySensitiveHashing(Hashing):
         Hashes the vector and returns the binary bucket key as string.
         """
         with utils.Timer("    Projecting"):
-            projections = np.dot(V, self.normals)
+            projections = self.project(V)
 
         # Convert bitcode to uint
         with utils.Timer("    Thresholding"):
-            projections = np.dot(projections > 0, self.bits_to_int)
+            projections = np.dot(projections[:, :len(self.bits_to_int)] > 0, self.bits_to_int)
 
         # Return the hashcode view as a string
         with utils.Timer("    Stringifying"):
@@ -38,6 +39,12 @@ class LocalitySensitiveHashing(Hashing):
 
         return projections
 
+    def project(self, V):
+        if scipy.sparse.issparse(V):
+            return np.asarray(V.dot(self.normals))
+
+        return np.dot(V, self.normals)
+
     # def hash_vector_with_pos(self, V, positions, querying=False):
     #     """
     #     Hashes the vector and returns the binary bucket key as string.
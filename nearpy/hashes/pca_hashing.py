@@ -2,12 +2,16 @@
 
 import pickle
 import numpy as np
+import scipy.sparse
 from itertools import izip
 
 import nearpy.utils.utils as utils
 
 from nearpy.hashes.hashing import Hashing
-from nearpy.utils import perform_online_pca
+from nearpy.utils import perform_online_pca, perform_online_itq, get_backend
+
+# Vectors are projected by chunks of that many vectors (bounds the temporaries).
+CHUNK_SIZE = 2**16
 
 
 class PCAHashing(Hashing):
@@ -17,9 +21,13 @@ class PCAHashing(Hashing):
     divides the data set by each principal component hyperplane and
     generates a binary hash value in string form, which is being
     used as a bucket key for storage.
+
+    If `itq_iterations` > 0, the principal components are rotated to
+    minimize the quantization error (ITQ, see `perform_online_itq`), which
+    balances the variance across bits (i.e. the sizes of the buckets).
     """
 
-    def __init__(self, name, dimension, trainset, nbits, pca_pkl=None):
+    def __init__(self, name, dimension, trainset, nbits, pca_pkl=None, itq_iterations=0, rand_seed=None):
         super(PCAHashing, self).__init__(name, nbits)
         self.dimension = dimension
         self.npca = min(self.nbits, self.dimension)  # Number of principal components to keep.
@@ -30,57 +38,63 @@ class PCAHashing(Hashing):
             self.mean, (self.eigenvalues, self.eigenvectors) = perform_online_pca(trainset(), dimension)
             pickle.dump((self.mean, (self.eigenvalues, self.eigenvectors)), open("pca.pkl", 'w'))
 
+        # Subclasses precompute their projections once fitted.
+        self.rotation = None
+        PCAHashing._precompute(self)
+
+        if itq_iterations > 0:
+            self.rotation = perform_online_itq(trainset, lambda V: np.dot(V, self.components) - self.offsets,
+                                               itq_iterations, rand_seed)
+            PCAHashing._precompute(self)
+
         #variance_explanation = np.cumsum(eigenvalues/eigenvalues.sum())
         #self.projection_count = np.sum(variance_explanation <= max_explanation)
 
-        try:
-            # GPU version is ~100x faster (requires Theano)
-            self.hash_func = self._build_hash_function()
-        except:
-            self.hash_func = None
+    def _precompute(self):
+        """
+        Precomputes the projection matrix and offsets (when fitted or unpickled).
+        """
+        # Keep the first `self.npca` principal components.
+        self.components = np.real(self.eigenvectors[:, :self.npca]).astype(np.float32)
+        if self.rotation is not None:
+            self.components = np.dot(self.components, self.rotation)
 
-    def _build_hash_function(self):
-        import theano
-        import theano.tensor as T
+        self.offsets = np.dot(self.mean, self.components).astype(np.float32)
+        self.nprojections = self.npca
 
-        # Make sure everything is in float32 (i.e. GPU compatible)
-        eigenvectors = self.eigenvectors.astype(np.float32)
-        mean = self.mean.astype(np.float32)
-        V = T.matrix()
+    def _project_chunk(self, V, out):
+        """ Writes the projections of a chunk of (float32) vectors in `out`. """
+        np.dot(V, self.components, out=out)
+        out -= self.offsets
 
-        # Keep the first `self.npca` principal components.
-        proj = eigenvectors[:, :self.npca]
-        projections = T.dot(V-mean, proj)
-        f = theano.function([V], projections)
-        return f
+    def project(self, V):
+        """
+        Returns the projections of the vectors (dense or sparse, one row per
+        vector) on the principal components (after removing the mean),
+        evaluated by chunks of `CHUNK_SIZE` vectors (see `set_backend`).
+        """
+        sparse = scipy.sparse.issparse(V)
+        V = scipy.sparse.csr_matrix(V) if sparse else np.asarray(V).reshape((-1, self.dimension))
+        projections = np.empty((V.shape[0], self.nprojections), dtype=np.float32)
+
+        def project_chunk(start, end):
+            chunk = V[start:end].toarray() if sparse else V[start:end]
+            self._project_chunk(chunk.astype(np.float32, copy=False), projections[start:end])
+
+        get_backend().map_chunks(project_chunk, V.shape[0], CHUNK_SIZE)
+        return projections
 
     def hash_vector(self, V):
         """
         Hashes the vector and returns the binary bucket key as string.
         """
-        projections = V.reshape((-1, self.dimension)) - self.mean
-        projections = np.dot(projections, self.normals.T)
-
-        # Return binary key as a string
-        projections = (projections > 0.0).astype(np.int8).astype('S1')
-        return [''.join(projection) for projection in projections]
-
         with utils.Timer("    Projecting"):
-            if self.hash_func is not None:
-                # Use GPU (~100x faster)
-                projections = []
-                for chunk in utils.chunk(V, 200000):
-                    projections.append(self.hash_func(chunk))
-
-                projections = np.concatenate(projections, axis=0)
-            else:
-                # Keep the first `self.npca` principal components.
-                proj = self.eigenvectors[:, :self.npca]
-                projections = np.dot(V-self.mean, proj)
+            projections = self.project(V)
 
         # Convert bitcode to uint
         with utils.Timer("    Thresholding"):
-            projections = np.dot(projections > 0, self.bits_to_int)
+            bits_to_int = self.bits_to_int[:projections.shape[1]]
+            projections = np.dot(projections[:, :len(bits_to_int)] > 0, bits_to_int)
 
         # Return the hashcode view as a string
         with utils.Timer("    Stringifying"):
@@ -100,14 +114,12 @@ class PCAHashing(Hashing):
 
     def __setstate__(self, state):
         super(PCAHashing, self).__setstate__(state)
+        self.__dict__.pop("hash_func", None)  # Theano function of older versions.
+        if "rotation" not in state:
+            self.rotation = None
 
         if "PCAHashing_version" not in state:
             if 'projection_count' in state:
                 self.nbits = state['projection_count']
-        else:
-            if state["PCAHashing_version"] >= 1:
-                try:
-                    # GPU version is ~100x faster (requires Theano)
-                    self.hash_func = self._build_hash_function()
-                except:
-                    self.hash_func = None
+
+        self._precompute()
@@ -20,199 +20,132 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import numpy
-import scipy
-import scipy.sparse
+import numpy as np
 
-from nearpy.hashes.lshash import LSHash
+from nearpy.hashes.hashing import Hashing
 
 
-class RandomBinaryProjectionTreeNode(object):
-
-    def __init__(self):
-        # Count of vectors stored in this subtree
-        self.vector_count = 0
-        # Dict containing the two childs (one for '0', one for '1')
-        self.childs = {}
-        self.bucket_key = None
-
-    def insert_entry_for_bucket(self, bucket_key, tree_depth):
-        """
-        Increases counter for specified bucket_key (leaf of tree) and
-        also increases counters along the way from the root to the leaf.
-        """
+class RandomBinaryProjectionTree(Hashing):
+    """
+    Projects a vector on n random hyperplane normals and assigns
+    a binary value to each projection depending on the sign. This
+    divides the data set by each hyperplane and generates a binary
+    hash code, which is being used as a bucket key for storage.
 
-        # First increase vector count of this subtree
-        self.vector_count = self.vector_count + 1
+    Almost same as LocalitySensitiveHashing. Difference is that this hash
+    counts the vectors stored in each bucket (see `insert`) in a binary tree
+    whose level d splits on bit d, in order to guarantee to always be able to
+    retrieve N results. Use minimum_result_size to set this N.
 
-        if tree_depth < len(bucket_key):
-            hash_char = bucket_key[tree_depth]
+    The tree is kept flat: the codes of the non-empty buckets sorted in
+    tree order (i.e. bit-reversed) and the cumulative counts of vectors, so
+    the buckets below any node are a range of the sorted codes and its count
+    is a difference of cumulative counts.
+    """
 
-            # This is not the leaf so continue down into the tree towards the leafes
+    def __init__(self, name, dimension, nbits, minimum_result_size, rand_seed=None):
+        super(RandomBinaryProjectionTree, self).__init__(name, nbits)
+        if self.nbits > 63:
+            raise ValueError("A projection tree can't have more than 63 bits.")
 
-            #print 'hash_char=%c' % hash_char
+        self.dimension = dimension
+        self.minimum_result_size = minimum_result_size
+        self.rand = np.random.RandomState(rand_seed)
+        self.normals = self.rand.randn(self.dimension, self.nbits).astype(np.float32)
 
-            # If child node for this character ('0' or '1') is not existing yet, create it
-            if not hash_char in self.childs:
-                #print 'Creating child for %c' % hash_char
-                self.childs[hash_char] = RandomBinaryProjectionTreeNode()
+        self.leaves = np.zeros(0, dtype=np.uint64)  # Bit-reversed codes of the non-empty buckets, sorted.
+        self.cumcounts = np.zeros(1, dtype=np.int64)  # Number of vectors in the buckets before each leaf.
 
-            # Continue on the child
-            self.childs[hash_char].insert_entry_for_bucket(bucket_key, tree_depth+1)
-        else:
-            # This is a leaf, so keep the bucket key
-            #print 'Inserting leaf %s(%s, %d), count is %d' % (bucket_key, self.bucket_key, tree_depth, self.vector_count)
-            if not self.bucket_key is None:
-                if self.bucket_key != bucket_key:
-                    raise AttributeError
-            self.bucket_key = bucket_key
+    def project(self, V):
+        return np.dot(V, self.normals)
 
-    def collect_all_bucket_keys(self):
+    def hash_vector(self, V):
         """
-        Just collects all buckets keys from subtree
+        Hashes the vectors and returns the binary bucket keys as strings.
         """
-        if len(self.childs) == 0:
-            # This is a leaf so just return the bucket key (we reached the bucket leaf)
-            #print 'Returning (collect) leaf bucket key %s with %d vectors' % (self.bucket_key, self.vector_count)
-            return [self.bucket_key]
-
-        # Not leaf, return results of childs
-        result = []
-        for child in self.childs.values():
-            result = result + child.collect_all_bucket_keys()
-
-        return result
-
-    def bucket_keys_to_guarantee_result_set_size(self, bucket_key, N, tree_depth):
+        codes = np.dot(self.project(V) > 0, self.bits_to_int)
+        return codes.view("|S8")
+
+    def _reverse(self, codes):
+        """ Reverses the `nbits` bits of the codes, i.e. the first bit becomes the most significant. """
+        codes = np.asarray(codes, dtype=np.uint64)
+        reversed_codes = np.zeros_like(codes)
+        for bit in range(self.nbits):
+            reversed_codes |= ((codes >> np.uint64(bit)) & np.uint64(1)) << np.uint64(self.nbits - 1 - bit)
+
+        return reversed_codes
+
+    def _subtree(self, reversed_codes, depth):
+        """ Returns the ranges [start, end) of leaves below the nodes of given depth holding the codes. """
+        shift = np.uint64(self.nbits - depth)
+        first = (reversed_codes >> shift) << shift
+        start = np.searchsorted(self.leaves, first)
+        end = np.searchsorted(self.leaves, first + (np.uint64(1) << shift))
+        return start, end
+
+    def insert(self, codes):
         """
-        Returns list of bucket keys based on the specified bucket key
-        and minimum result size N.
+        Counts vectors stored in the buckets of the given codes.
         """
+        leaves = np.concatenate([self.leaves, self._reverse(codes)])
+        counts = np.concatenate([np.diff(self.cumcounts), np.ones(len(codes), dtype=np.int64)])
+        self.leaves, indices = np.unique(leaves, return_inverse=True)
+        counts = np.bincount(indices, weights=counts).astype(np.int64)
+        self.cumcounts = np.concatenate([[0], np.cumsum(counts)])
 
-        if tree_depth == len(bucket_key):
-            #print 'Returning leaf bucket key %s with %d vectors' % (self.bucket_key, self.vector_count)
-            # This is a leaf so just return the bucket key (we reached the bucket leaf)
-            return [self.bucket_key]
-
-        # If not leaf, this is a subtree node.
-
-        hash_char = bucket_key[tree_depth]
-        if hash_char == '0':
-            other_hash_char = '1'
-        else:
-            other_hash_char = '0'
-
-        # Check if child has enough results
-        if hash_char in self.childs:
-            if self.childs[hash_char].vector_count < N:
-                # If not combine buckets of both child subtrees
-                listA = self.childs[hash_char].collect_all_bucket_keys()
-                listB = self.childs[other_hash_char].collect_all_bucket_keys()
-                return listA + listB
-            else:
-                # Child subtree has enough results, so call method on child
-                return self.childs[hash_char].bucket_keys_to_guarantee_result_set_size(bucket_key, N, tree_depth+1)
-        else:
-            # That subtree is not existing, so just follow the other side
-            return self.childs[other_hash_char].bucket_keys_to_guarantee_result_set_size(bucket_key, N, tree_depth+1)
-
-
-class RandomBinaryProjectionTree(LSHash):
-    """
-    Projects a vector on n random hyperplane normals and assigns
-    a binary value to each projection depending on the sign. This
-    divides the data set by each hyperplane and generates a binary
-    hash value in string form, which is being used as a bucket key
-    for storage.
-
-    Almost same as RandomBinaryProjections. Difference is that
-    this hash constructs a binary tree in order to guarantee to
-    always be able to retrieve N results. Use minimum_result_size
-    to set this N.
-    """
-
-    def __init__(self, hash_name, projection_count, minimum_result_size, rand_seed=None):
+    def guaranteed_ranges(self, codes, N=None):
         """
-        Creates projection_count random vectors, that are used for projections
-        thus working as normals of random hyperplanes. Each random vector /
-        hyperplane will result in one bit of hash.
-
-        So if you for example decide to use projection_count=10, the bucket
-        keys will have 10 digits and will look like '1010110011'.
+        Returns, for every code, the range [start, end) of leaves below the
+        deepest node of its path holding at least N vectors (the root if none).
         """
-        super(RandomBinaryProjectionTree, self).__init__(hash_name)
-        self.projection_count = projection_count
-        self.dim = None
-        self.normals = None
-        self.rand = numpy.random.RandomState(rand_seed)
-        self.normals_csr = None
-        self.tree_root = None
-        self.minimum_result_size = minimum_result_size
+        N = self.minimum_result_size if N is None else N
+        reversed_codes = self._reverse(codes)
+        starts = np.zeros(len(reversed_codes), dtype=np.int64)
+        ends = np.full(len(reversed_codes), len(self.leaves), dtype=np.int64)
 
-    def reset(self, dim):
-        """ Resets / Initializes the hash for the specified dimension. """
-        if self.dim != dim:
-            self.dim = dim
-            self.normals = self.rand.randn(self.projection_count, dim)
-            self.tree_root = RandomBinaryProjectionTreeNode()
+        # Counts only decrease along a path, the last node big enough is the deepest.
+        for depth in range(1, self.nbits + 1):
+            start, end = self._subtree(reversed_codes, depth)
+            big_enough = self.cumcounts[end] - self.cumcounts[start] >= N
+            starts[big_enough] = start[big_enough]
+            ends[big_enough] = end[big_enough]
 
-    def hash_vector(self, v, querying=False):
+        return starts, ends
+
+    def bucket_codes_to_guarantee(self, V, N=None):
         """
-        Hashes the vector and returns the binary bucket key as string.
+        Returns, for every vector, the codes of the buckets holding together
+        at least N vectors (if there are that many).
         """
-        if scipy.sparse.issparse(v):
-            # If vector is sparse, make sure we have the CSR representation
-            # of the projection matrix
-            if self.normals_csr == None:
-                self.normals_csr = scipy.sparse.csr_matrix(self.normals)
-            # Make sure that we are using CSR format for multiplication
-            if not scipy.sparse.isspmatrix_csr(v):
-                v = scipy.sparse.csr_matrix(v)
-            # Project vector onto all hyperplane normals
-            projection = self.normals_csr.dot(v)
-        else:
-            # Project vector onto all hyperplane normals
-            projection = numpy.dot(self.normals, v)
-
-        # Build binary key
-        binary_key = ''.join(['1' if x > 0.0 else '0' for x in projection])
-
-        if querying:
-            #print 'Querying...'
-            # Make sure returned buckets keys contain at least N results
-            return self.tree_root.bucket_keys_to_guarantee_result_set_size(binary_key, self.minimum_result_size, 0)
-        else:
-            # We are indexing, so adapt bucket key counter in binary tree
-            self.tree_root.insert_entry_for_bucket(binary_key, 0)
-
-            # Return binary key
-            return [binary_key]
-
-    def get_config(self):
+        codes = self.hash_vector(V).view(np.uint64)
+        starts, ends = self.guaranteed_ranges(codes, N)
+        return [self.range_codes(code, start, end) for code, start, end in zip(codes, starts, ends)]
+
+    def range_codes(self, bucketcode, start, end):
         """
-        Returns pickle-serializable configuration struct for storage.
+        Returns the codes of the leaves in range [start, end), in the order they
+        are probed for a vector in bucket `bucketcode` (see `probes`).
         """
-        # Fill this dict with config data
-        return {
-            'hash_name': self.hash_name,
-            'dim': self.dim,
-            'projection_count': self.projection_count,
-            'normals': self.normals,
-            'tree_root': self.tree_root,
-            'minimum_result_size': self.minimum_result_size
-        }
-
-    def apply_config(self, config):
+        leaves = self.leaves[start:end]
+        # The longer the common path with the bucket, the smaller the xor of the reversed codes.
+        order = np.argsort(leaves ^ self._reverse([bucketcode])[0], kind="mergesort")
+        return self._reverse(leaves[order])
+
+    def probes(self, v, bucketcode):
         """
-        Applies config
+        Yields (score, bucketcode) of the non-empty buckets to probe for a vector
+        in bucket `bucketcode`: the buckets of the sibling subtree at the deepest
+        level first, then at the level above, and so on (score is the height).
         """
-        self.hash_name = config['hash_name']
-        self.dim = config['dim']
-        self.projection_count = config['projection_count']
-        self.normals = config['normals']
-        self.tree_root = config['tree_root']
-        self.minimum_result_size = config['minimum_result_size']
-
-
-
-
+        reversed_code = self._reverse([bucketcode])
+        for depth in reversed(range(self.nbits)):
+            shift = np.uint64(self.nbits - depth - 1)
+            sibling = ((reversed_code >> shift) ^ np.uint64(1)) << shift
+            start, end = self._subtree(sibling, depth + 1)
+            for code in self._reverse(self.leaves[start[0]:end[0]]):
+                yield self.nbits - depth, code
+
+    def __str__(self):
+        text = ""
+        text += self.name + ": " + str(self.nbits)
+        return text
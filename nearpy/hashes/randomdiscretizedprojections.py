@@ -20,86 +20,143 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import numpy
-import scipy
+import numpy as np
 import scipy.sparse
 
-from nearpy.hashes.lshash import LSHash
+from heapq import heappush, heappop
+from nearpy.hashes.hashing import Hashing
 
 
-class RandomDiscretizedProjections(LSHash):
+def bins_probe_sequence(bins, positions):
     """
-    Projects a vector on n random vectors and assigns
-    a discrete value to each projection depending on the location on the
-    random vector using a bin width.
+    Yields (score, bins) of the neighboring bins of `bins` in increasing order
+    of score. `positions` gives where the query is in each of its bins (in
+    [0, 1)). Each coordinate can be moved to the previous or next bin, the
+    score of a perturbation being the sum of the squared distances from the
+    query to the boundaries crossed.
+
+    References
+    ----------
+    .. [Lv2007] Lv, Q., Josephson, W., Wang, Z., Charikar, M., & Li, K. (2007).
+                Multi-probe LSH: efficient indexing for high-dimensional similarity search. VLDB.
+    """
+    # The 2k single moves, sorted by score: coordinate i to the previous bin (-1) or the next one (+1).
+    distances = np.concatenate([positions, 1 - positions])**2
+    coordinates = np.concatenate([np.arange(len(bins)), np.arange(len(bins))])
+    moves = np.concatenate([-np.ones(len(bins), dtype=np.int64), np.ones(len(bins), dtype=np.int64)])
+    order = np.argsort(distances)
+    scores, coordinates, moves = distances[order], coordinates[order], moves[order]
+
+    # Perturbation sets (indices of single moves) are generated from the smallest
+    # one using the "shift" and "expand" operations. Sets moving a coordinate
+    # twice are invalid but are still expanded.
+    heap = [(scores[0], (0,))]
+    while len(heap) > 0:
+        score, perturbation = heappop(heap)
+        if len(set(coordinates[list(perturbation)])) == len(perturbation):
+            perturbed_bins = bins.copy()
+            perturbed_bins[coordinates[list(perturbation)]] += moves[list(perturbation)]
+            yield score, perturbed_bins
+
+        last = perturbation[-1]
+        if last+1 < len(scores):
+            heappush(heap, (score - scores[last] + scores[last+1], perturbation[:-1] + (last+1,)))
+            heappush(heap, (score + scores[last+1], perturbation + (last+1,)))
+
+
+class DiscretizedProjections(Hashing):
     """
+    Projects vectors on some directions and assigns a discrete value to each
+    projection depending on the bin (of width `bin_width`) it falls in.
 
-    def __init__(self, hash_name, projection_count, bin_width, rand_seed=None):
-        """
-        Creates projection_count random vectors, that are used for projections.
-        Each random vector will result in one discretized coordinate.
+    The bin coordinates are packed in a uint64 bucket code, each coordinate
+    taking `bits_per_projection` bits (i.e. coordinates are kept modulo
+    2**bits_per_projection, far away bins may share a bucket).
+    """
 
-        So if you for example decide to use projection_count=3, the bucket
-        keys will have 3 coordinates and look like '14_4_1' or '-4_18_-1'.
-        """
-        super(RandomDiscretizedProjections, self).__init__(hash_name)
+    def __init__(self, name, projection_count, bin_width, bits_per_projection=None):
+        if bits_per_projection is None:
+            bits_per_projection = 64 // projection_count
+
+        if projection_count * bits_per_projection > 64:
+            raise ValueError("Bin coordinates of {} projections don't fit in 64 bits with {} bits each."
+                             .format(projection_count, bits_per_projection))
+
+        super(DiscretizedProjections, self).__init__(name, projection_count * bits_per_projection)
         self.projection_count = projection_count
-        self.dim = None
-        self.normals = None
         self.bin_width = bin_width
-        self.rand = numpy.random.RandomState(rand_seed)
-        self.normals_csr = None
+        self.bits_per_projection = bits_per_projection
 
-    def reset(self, dim):
-        """ Resets / Initializes the hash for the specified dimension. """
-        if self.dim != dim:
-            self.dim = dim
-            self.normals = self.rand.randn(self.projection_count, dim)
+    def _project(self, V):
+        """ Returns the projections of `V` (dense or sparse, one row per vector). """
+        raise NotImplementedError
 
-    def hash_vector(self, v, querying=False):
+    def project(self, V):
         """
-        Hashes the vector and returns the binary bucket key as string.
+        Returns the position of the vectors along each projection, in bin
+        widths (the integer part is the bin coordinate).
         """
-        if scipy.sparse.issparse(v):
-            # If vector is sparse, make sure we have the CSR representation
-            # of the projection matrix
-            if self.normals_csr == None:
-                self.normals_csr = scipy.sparse.csr_matrix(self.normals)
-            # Make sure that we are using CSR format for multiplication
-            if not scipy.sparse.isspmatrix_csr(v):
-                v = scipy.sparse.csr_matrix(v)
-            # Project vector onto all hyperplane normals
-            projection = (self.normals_csr.dot(v) / self.bin_width).floor().toarray()
-        else:
-            # Project vector onto all hyperplane normals
-            projection = numpy.dot(self.normals, v)
-            projection = numpy.floor(projection / self.bin_width)
-        # Return key
-        return ['_'.join([str(int(x)) for x in projection])]
-
-    def get_config(self):
+        if scipy.sparse.issparse(V):
+            V = scipy.sparse.csr_matrix(V)
+
+        return np.asarray(self._project(V)) / self.bin_width
+
+    def pack(self, bins):
+        """ Returns the bucket codes of the given bin coordinates (one row per vector). """
+        # Negative coordinates wrap around (two's complement), as with a modulo.
+        mask = np.uint64(2**self.bits_per_projection - 1)
+        codes = np.zeros(len(bins), dtype=np.uint64)
+        for projection in range(self.projection_count):
+            shift = np.uint64(projection * self.bits_per_projection)
+            codes |= (bins[:, projection].astype(np.int64).astype(np.uint64) & mask) << shift
+
+        return codes
+
+    def hash_vector(self, V):
+        """
+        Hashes the vectors and returns the bucket keys as strings.
         """
-        Returns pickle-serializable configuration struct for storage.
+        bins = np.floor(self.project(V)).astype(np.int64)
+        return self.pack(bins).view("|S8")
+
+    def codes(self, V):
         """
-        # Fill this dict with config data
-        return {
-            'hash_name': self.hash_name,
-            'dim': self.dim,
-            'bin_width': self.bin_width,
-            'projection_count': self.projection_count,
-            'normals': self.normals
-        }
-
-    def apply_config(self, config):
+        Bin coordinates aren't bits: there are no binary codes to compare
+        with `HammingDistance`.
+        """
+        raise TypeError("{} has no binary codes, its buckets are bins.".format(type(self).__name__))
+
+    def probes(self, v, bucketcode):
         """
-        Applies config
+        Yields (score, bucketcode) of the neighboring bins to probe for vector `v`
+        (a row, dense or sparse) in bucket `bucketcode` (multi-probe LSH), the
+        score being a squared distance in bin widths.
         """
-        self.hash_name = config['hash_name']
-        self.dim = config['dim']
-        self.bin_width = config['bin_width']
-        self.projection_count = config['projection_count']
-        self.normals = config['normals']
+        projections = self.project(v)[0]
+        bins = np.floor(projections).astype(np.int64)
+        for score, perturbed_bins in bins_probe_sequence(bins, projections - bins):
+            yield score, self.pack(perturbed_bins[None])[0]
 
+    def __str__(self):
+        text = ""
+        text += self.name + ": " + str(self.projection_count) + "x" + str(self.bits_per_projection)
+        return text
 
 
+class RandomDiscretizedProjections(DiscretizedProjections):
+    """
+    Projects a vector on n random vectors and assigns
+    a discrete value to each projection depending on the location on the
+    random vector using a bin width (i.e. Euclidean LSH). Bins are shifted
+    by a random offset.
+    """
+
+    def __init__(self, name, dimension, projection_count, bin_width, bits_per_projection=None, rand_seed=None):
+        super(RandomDiscretizedProjections, self).__init__(name, projection_count, bin_width, bits_per_projection)
+        self.dimension = dimension
+        self.rand = np.random.RandomState(rand_seed)
+        self.normals = self.rand.randn(self.dimension, self.projection_count).astype(np.float32)
+        self.offsets = self.rand.uniform(0, bin_width, self.projection_count).astype(np.float32)
 
+    def _project(self, V):
+        return V.dot(self.normals) + self.offsets
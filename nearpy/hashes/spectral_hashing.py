@@ -2,9 +2,9 @@
 
 import pickle
 import numpy as np
-import nearpy.utils.utils as utils
 
 from nearpy.hashes import PCAHashing
+from nearpy.utils import get_backend
 
 
 class SpectralHashing(PCAHashing):
@@ -24,12 +24,9 @@ class SpectralHashing(PCAHashing):
             bounds = [np.inf * np.ones(self.npca, dtype="float32"),
                       -np.inf * np.ones(self.npca, dtype="float32")]
 
-            # Keep the first `self.npca` principal components.
-            proj = self.eigenvectors[:, :self.npca]
-
             # Find optimal bounds by going through a trainset.
             for V in kwargs['trainset']():
-                projV = np.dot(V, proj)  # According to Weiss, no need to remove the mean.
+                projV = np.dot(V, self.components)  # According to Weiss, no need to remove the mean.
                 bounds[0] = np.minimum(bounds[0], np.min(projV, axis=0))
                 bounds[1] = np.maximum(bounds[1], np.max(projV, axis=0))
 
@@ -42,7 +39,7 @@ class SpectralHashing(PCAHashing):
 
         R = bounds[1] - bounds[0]
 
-        maxMode = np.ceil((self.nbits+1)*R/max(R))
+        maxMode = np.ceil((self.nbits+1)*R/max(R)).astype(int)
         nModes = np.sum(maxMode)-len(maxMode)+1
         modes = np.ones((nModes, self.npca))
 
@@ -59,69 +56,31 @@ class SpectralHashing(PCAHashing):
         modes = modes[ii[1:(self.nbits+1)], :]
 
         self.modes = modes
-
-        try:
-            # GPU version is ~100x faster (requires Theano)
-            self.hash_func = self.build_hash_function()
-        except:
-            self.hash_func = None
-
-    def _build_hash_function(self):
-        import theano
-        import theano.tensor as T
-
-        # Make sure everything is in float32 (i.e. GPU compatible)
-        modes = self.modes.astype(np.float32)
-        eigenvectors = self.eigenvectors.astype(np.float32)
-        bounds = (self.bounds[0].astype(np.float32), self.bounds[1].astype(np.float32))
-
-        V = T.matrix()
-
-        # Keep the first `self.npca` principal components.
-        proj = eigenvectors[:, :self.npca]
-        projV = T.dot(V, proj)[:, None, :]  # According to Weiss, no need to remove the mean.
-
-        pi = np.float32(np.pi)
-        half_pi = np.float32(np.pi/2.)
-        omega0 = pi / (bounds[1] - bounds[0])
-        omegas = omega0 * modes
-        projections = T.prod(T.sin(omegas*(projV-bounds[0])+half_pi), axis=2)
-        f = theano.function([V], projections)
-        return f
-
-    def hash_vector(self, V):
-        """
-        Hashes the vector and returns the binary bucket key as string.
-        """
-        with utils.Timer("    Projecting"):
-            if self.hash_func is not None:
-                # Use GPU (~100x faster)
-                # or theano CPU (~10x faster)
-                projections = []
-                for chunk in utils.chunk(V, 100000):
-                    projections.append(self.hash_func(chunk))
-
-                projections = np.concatenate(projections, axis=0)
-            else:
-                # Keep the first `self.npca` principal components.
-                proj = self.eigenvectors[:, :self.npca]
-                projV = np.dot(V, proj)[:, None, :]  # According to Weiss, no need to remove the mean.
-
-                pi = np.float32(np.pi)
-                half_pi = np.float32(np.pi/2.)
-                omega0 = pi / (self.bounds[1] - self.bounds[0])
-                omegas = omega0 * self.modes
-                projections = np.prod(np.sin(omegas*(projV-self.bounds[0])+half_pi), axis=2)
-
-        # Convert bitcode to uint
-        with utils.Timer("    Thresholding"):
-            projections = np.dot(projections > 0, self.bits_to_int)
-
-        # Return the hashcode view as a string
-        with utils.Timer("    Stringifying"):
-            projections = projections.view("|S8")
-
-        return projections
+        self._precompute()
+
+    def _precompute(self):
+        super(SpectralHashing, self)._precompute()
+        self.offsets = np.zeros(self.npca, dtype=np.float32)  # According to Weiss, no need to remove the mean.
+        self.nprojections = self.nbits
+
+        # Each bit is the product over the principal components of
+        # sin(omega*(x - bound) + pi/2) = cos(omega*x - omega*bound), where
+        # factors having a null omega are 1. Components thus only contribute
+        # to the bits whose mode uses them (a single one per bit).
+        omegas = np.pi / (self.bounds[1] - self.bounds[0]) * self.modes
+        self.factors = []
+        for i in range(self.npca):
+            bits = np.flatnonzero(omegas[:, i])
+            if len(bits) > 0:
+                phases = omegas[bits, i] * self.bounds[0][i]
+                self.factors.append((i, bits, omegas[bits, i].astype(np.float32), phases.astype(np.float32)))
+
+    def _project_chunk(self, V, out):
+        backend = get_backend()
+        projV = np.dot(V, self.components)
+        out.fill(1)
+        for i, bits, omegas, phases in self.factors:
+            out[:, bits] *= backend.cos(projV[:, i], omegas, phases)
 
     def __str__(self):
         text = ""
@@ -20,45 +20,29 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import numpy
+import numpy as np
 
-from nearpy.hashes.lshash import LSHash
+from nearpy.hashes.hashing import Hashing
 
 
-class UniBucket(LSHash):
+class UniBucket(Hashing):
     """
     Puts alls vectors in one bucket. This is used for testing
     the engines and experiments.
     """
 
-    def __init__(self, hash_name):
-        """ Just keeps the name. """
-        super(UniBucket, self).__init__(hash_name)
-        self.dim = None
+    def __init__(self, name):
+        """ Just keeps the name, there are no bits. """
+        super(UniBucket, self).__init__(name, 0)
 
-    def reset(self, dim):
-        """ Resets / Initializes the hash for the specified dimension. """
-        self.dim = dim
+    def project(self, V):
+        return np.zeros((V.shape[0], 0), dtype=np.float32)
 
-    def hash_vector(self, v, querying=False):
+    def hash_vector(self, V):
         """
-        Hashes the vector and returns the bucket key as string.
+        Hashes the vectors and returns the bucket keys as strings (the same one).
         """
-        # Return bucket key identical to vector string representation
-        return [self.hash_name+'']
+        return np.zeros(V.shape[0], dtype=np.uint64).view("|S8")
 
-    def get_config(self):
-        """
-        Returns pickle-serializable configuration struct for storage.
-        """
-        return {
-            'hash_name': self.hash_name,
-            'dim': self.dim
-        }
-
-    def apply_config(self, config):
-        """
-        Applies config
-        """
-        self.hash_name = config['hash_name']
-        self.dim = config['dim']
+    def __str__(self):
+        return self.name
@@ -6,10 +6,19 @@ def storage_factory(name, keyprefix="", **kwargs):
     if name.lower() == "memory":
         from nearpy.storage.storage_memory import MemoryStorage
         storage = MemoryStorage(keyprefix=keyprefix)
+    elif name.lower() == "columnar":
+        from nearpy.storage.storage_columnar import ColumnarStorage
+        storage = ColumnarStorage(keyprefix=keyprefix,
+                                  delta_fraction=kwargs.get("delta_fraction", 0.125))
+    elif name.lower() == "mmap":
+        from nearpy.storage.storage_mmap import MMapStorage
+        storage = MMapStorage(name=keyprefix,
+                              root=kwargs.get("dir", "./db"))
     elif name.lower() == "file":
         from nearpy.storage.storage_file import FileStorage
         storage = FileStorage(name=keyprefix,
-                              root=kwargs.get("dir", "./db"))
+                              root=kwargs.get("dir", "./db"),
+                              max_segments=kwargs.get("max_segments", 16))
     elif name.lower() == "redis":
         from nearpy.storage.storage_credis import CRedisStorage
         storage = CRedisStorage(keyprefix=keyprefix,
@@ -25,4 +34,12 @@ def storage_factory(name, keyprefix="", **kwargs):
         raise ValueError("Unknown storage: {}".format(name))
 
     storage.name = name.lower()
+
+    if kwargs.get("cache_bytes"):
+        from nearpy.storage.storage_cache import CachedStorage
+        storage = CachedStorage(storage,
+                                cache_bytes=kwargs["cache_bytes"],
+                                policy=kwargs.get("cache_policy", "lru"))
+        storage.name = name.lower()
+
     return storage
@@ -1,9 +1,100 @@
 # -*- coding: utf-8 -*-
 
+import numpy as np
+
+from collections import defaultdict
+
+
+def group_by_bucket(bucketcodes):
+    """
+    Sorts elements by bucket.
+
+    Parameters
+    ----------
+    bucketcodes: ndarray of uint64
+        bucket code of each element
+
+    Returns
+    -------
+    order: ndarray
+        indices sorting the elements by bucket (stable)
+    unique_codes: ndarray of uint64
+        code of each bucket
+    bounds: ndarray
+        elements of bucket i are `order[bounds[i]:bounds[i+1]]`
+    """
+    order = np.argsort(bucketcodes, kind="mergesort")
+    unique_codes, counts = np.unique(bucketcodes[order], return_counts=True)
+    bounds = np.concatenate([[0], np.cumsum(counts)])
+    return order, unique_codes, bounds
+
+
+def encode_bucketkeys(bucketkeys, prefix="", suffix=""):
+    """
+    Returns the storage keys of buckets, i.e. `prefix + bucketkey + suffix`.
+
+    Bucket codes (ndarray of uint64) are encoded all at once, each code being
+    written as its 8 bytes. Otherwise, `bucketkeys` are expected to be already
+    encoded strings.
+    """
+    if not isinstance(bucketkeys, np.ndarray) or bucketkeys.dtype.kind not in "ui":
+        return [prefix + bucketkey + suffix for bucketkey in bucketkeys]
+
+    codes = np.ascontiguousarray(bucketkeys, dtype=np.uint64)
+    start, end = len(prefix), len(prefix) + codes.itemsize
+    width = end + len(suffix)
+    keys = np.empty((len(codes), width), dtype=np.uint8)
+    keys[:, :start] = np.frombuffer(prefix, dtype=np.uint8)
+    keys[:, start:end] = codes.view(np.uint8).reshape((-1, codes.itemsize))
+    keys[:, end:] = np.frombuffer(suffix, dtype=np.uint8)
+
+    keys = keys.tostring()
+    return [keys[i:i+width] for i in xrange(0, len(keys), width)]
+
+
+def split_bucketkeys(bucketkeys, prefix=""):
+    """
+    Inverse of `encode_bucketkeys`. Yields (prefix, codes, indices) for each
+    prefix found in the given buckets, `indices` being the positions of the
+    buckets in `bucketkeys`.
+    """
+    if isinstance(bucketkeys, np.ndarray) and bucketkeys.dtype.kind in "ui":
+        yield prefix, np.asarray(bucketkeys, dtype=np.uint64), np.arange(len(bucketkeys))
+        return
+
+    # Encoded keys, e.g. listed by `bucketkeys`: the prefix followed by the 8 bytes of the code.
+    keys = [prefix + bucketkey for bucketkey in bucketkeys]
+    groups = defaultdict(lambda: [])
+    for i, key in enumerate(keys):
+        groups[key[:-8]].append(i)
+
+    for key_prefix, indices in groups.items():
+        codes = np.frombuffer("".join(keys[i][-8:] for i in indices), dtype=np.uint64)
+        yield key_prefix, codes, np.array(indices)
+
 
 class Storage(object):
     """ Interface for storage adapters. """
 
+    # Whether `retrieve` can be called by many threads at the same time.
+    thread_safe = False
+
+    def reopen(self):
+        """
+        Returns a new read-only handle on this storage, e.g. to be used by
+        another process. Storages without connections return themselves.
+        """
+        return self
+
+    def retrieve_rows(self, bucketkeys, attribute, rows, prefix=""):
+        """
+        Retrieves only some elements of buckets, `rows` giving the offsets of
+        the elements to retrieve in each bucket. Storages able to read parts
+        of buckets (e.g. ranges) avoid reading and deserializing the others.
+        """
+        buckets = self.retrieve(bucketkeys, attribute, prefix=prefix)
+        return [bucket[bucket_rows] for bucket, bucket_rows in zip(buckets, rows)]
+
     def store_vector(self, hash_name, bucket_key, v, data):
         """
         Stores vector and JSON-serializable data in bucket with specified key.
@@ -0,0 +1,248 @@
+import sys
+
+import numpy as np
+
+from collections import OrderedDict, defaultdict
+from functools import partial
+from threading import Lock
+from nearpy.storage.storage import Storage, encode_bucketkeys
+
+
+def _nbytes(value):
+    return value.nbytes if isinstance(value, np.ndarray) else sys.getsizeof(value)
+
+
+class LRUPolicy(object):
+    """ Evicts the least recently used bucket first. """
+
+    def __init__(self):
+        self.keys = OrderedDict()
+
+    def add(self, key):
+        self.keys[key] = None
+
+    def touch(self, key):
+        del self.keys[key]
+        self.keys[key] = None
+
+    def discard(self, key):
+        self.keys.pop(key, None)
+
+    def victim(self):
+        return next(iter(self.keys))
+
+
+class LFUPolicy(object):
+    """ Evicts the least frequently used bucket first (least recently used among them). """
+
+    def __init__(self):
+        self.frequencies = {}
+        self.keys = defaultdict(OrderedDict)  # Keys by frequency.
+        self.min_frequency = 0
+
+    def add(self, key):
+        self.frequencies[key] = 1
+        self.keys[1][key] = None
+        self.min_frequency = 1
+
+    def touch(self, key):
+        frequency = self.frequencies[key]
+        self.discard(key)
+        self.frequencies[key] = frequency + 1
+        self.keys[frequency + 1][key] = None
+        if self.min_frequency == frequency and len(self.keys.get(frequency, ())) == 0:
+            self.min_frequency = frequency + 1
+
+    def discard(self, key):
+        frequency = self.frequencies.pop(key, None)
+        if frequency is None:
+            return
+
+        del self.keys[frequency][key]
+        if len(self.keys[frequency]) == 0:
+            del self.keys[frequency]
+
+    def victim(self):
+        if self.min_frequency not in self.keys:
+            self.min_frequency = min(self.keys)
+
+        return next(iter(self.keys[self.min_frequency]))
+
+
+POLICIES = {"lru": LRUPolicy, "lfu": LFUPolicy}
+
+
+class CachedStorage(Storage):
+    """
+    Keeps the retrieved buckets (deserialized, per attribute) of another storage
+    in memory, using at most `cache_bytes` bytes. Buckets are evicted following
+    `policy` ("lru" or "lfu") and invalidated when stored to or removed.
+
+    Cached buckets are shared between queries and are thus read-only.
+    """
+
+    def __init__(self, storage, cache_bytes, policy="lru"):
+        self.storage = storage
+        self.cache_bytes = cache_bytes
+        self.policy_name = policy
+        self.policy = POLICIES[policy]()
+        self.cache = {}
+        self.nbytes = 0
+        self.attributes = set()  # Names of the attributes having cached buckets.
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = Lock()
+        self._generation = 0  # Incremented by invalidations.
+
+    @property
+    def thread_safe(self):
+        return getattr(self.storage, "thread_safe", False)
+
+    def __getattr__(self, name):
+        # Everything else (e.g. infos, counts) is handled by the storage.
+        if name == "storage":
+            raise AttributeError(name)
+
+        return getattr(self.storage, name)
+
+    def reopen(self):
+        # Each process has its own cache.
+        storage = CachedStorage(self.storage.reopen(), self.cache_bytes, self.policy_name)
+        storage.name = getattr(self, "name", None)  # Set by `storage_factory`.
+        return storage
+
+    def _add(self, key, value):
+        nbytes = _nbytes(value)
+        if nbytes > self.cache_bytes or key in self.cache:
+            return
+
+        while self.nbytes + nbytes > self.cache_bytes:
+            self._discard(self.policy.victim())
+            self.evictions += 1
+
+        if isinstance(value, np.ndarray):
+            value.flags.writeable = False
+
+        self.cache[key] = value
+        self.nbytes += nbytes
+        self.policy.add(key)
+
+    def _discard(self, key):
+        value = self.cache.pop(key, None)
+        if value is not None:
+            self.nbytes -= _nbytes(value)
+            self.policy.discard(key)
+
+    def _invalidate(self, keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                for name in self.attributes:
+                    self._discard((key, name))
+
+    def _lookup(self, keys):
+        """ Returns the cached buckets (None if missing), the indices of the missing ones and the generation. """
+        results = [None] * len(keys)
+        missing = []
+        with self._lock:
+            for i, key in enumerate(keys):
+                if key in self.cache:
+                    results[i] = self.cache[key]
+                    self.policy.touch(key)
+                else:
+                    missing.append(i)
+
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+            return results, missing, self._generation
+
+    def _subset(self, bucketkeys, indices):
+        if isinstance(bucketkeys, np.ndarray):
+            return bucketkeys[indices]
+
+        bucketkeys = list(bucketkeys)
+        return [bucketkeys[i] for i in indices]
+
+    def retrieve(self, bucketkeys, attribute, prefix=""):
+        keys = [(key, attribute.name) for key in encode_bucketkeys(bucketkeys, prefix)]
+        results, missing, generation = self._lookup(keys)
+
+        if len(missing) > 0:
+            buckets = self.storage.retrieve(self._subset(bucketkeys, missing), attribute, prefix=prefix)
+            with self._lock:
+                self.attributes.add(attribute.name)
+                for i, bucket in zip(missing, buckets):
+                    results[i] = bucket
+                    if self._generation == generation:  # Otherwise, buckets may be outdated.
+                        self._add(keys[i], bucket)
+
+        return results
+
+    def retrieve_rows(self, bucketkeys, attribute, rows, prefix=""):
+        # Rows of the cached buckets are taken from the cache, the other ones
+        # are read by the storage (parts of buckets aren't cached).
+        keys = [(key, attribute.name) for key in encode_bucketkeys(bucketkeys, prefix)]
+        results, missing, _ = self._lookup(keys)
+        for i, bucket in enumerate(results):
+            if bucket is not None:
+                results[i] = bucket[rows[i]]
+
+        if len(missing) > 0:
+            buckets = self.storage.retrieve_rows(self._subset(bucketkeys, missing), attribute,
+                                                 [rows[i] for i in missing], prefix=prefix)
+            for i, bucket in zip(missing, buckets):
+                results[i] = bucket
+
+        return results
+
+    def store(self, bucketcodes, bucketvalues, prefix=""):
+        # Invalidated before and after the write, so that buckets retrieved
+        # while it is in progress aren't cached.
+        keys = encode_bucketkeys(np.unique(bucketcodes), prefix)
+        self._invalidate(keys)
+        try:
+            return self.storage.store(bucketcodes, bucketvalues, prefix=prefix)
+        finally:
+            self._invalidate(keys)
+
+    def remove(self, bucketkeys, *args, **kwargs):
+        if isinstance(bucketkeys, np.ndarray):
+            keys = encode_bucketkeys(bucketkeys, kwargs.get("prefix", ""))
+            invalidate = partial(self._invalidate, keys)
+        else:
+            # Keys are specific to the storage (e.g. RocksDB's include the attribute).
+            invalidate = self.clear_cache
+
+        invalidate()
+        try:
+            return self.storage.remove(bucketkeys, *args, **kwargs)
+        finally:
+            invalidate()
+
+    def clear(self, *args, **kwargs):
+        self.clear_cache()
+        try:
+            return self.storage.clear(*args, **kwargs)
+        finally:
+            self.clear_cache()
+
+    def clear_cache(self):
+        with self._lock:
+            self._generation += 1
+            self.cache = {}
+            self.nbytes = 0
+            self.policy = POLICIES[self.policy_name]()
+
+    def cache_stats(self):
+        """
+        Returns the number of hits, misses and evictions, the hit rate and
+        the memory used by the cache since its creation.
+        """
+        lookups = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / float(lookups) if lookups > 0 else 0.,
+                "nbytes": self.nbytes,
+                "nb_buckets": len(self.cache)}
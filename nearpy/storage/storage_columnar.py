@@ -0,0 +1,237 @@
+import numpy as np
+
+from collections import defaultdict
+from nearpy.storage.storage import group_by_bucket, encode_bucketkeys, split_bucketkeys
+from nearpy.storage.storage_memory import MemoryStorage
+
+# The delta segment is merged once it holds that many elements (or a fraction of the main segment).
+MIN_DELTA_SIZE = 2**16
+
+
+class Segment(object):
+    """
+    Buckets stored as columns: every attribute is one contiguous array sorted
+    by bucket code and `offsets` delimits the buckets (CSR-style), i.e. the
+    elements of bucket `codes[i]` are `columns[name][offsets[i]:offsets[i+1]]`.
+    """
+
+    def __init__(self, codes=None, offsets=None, columns=None):
+        self.codes = np.zeros(0, dtype=np.uint64) if codes is None else codes
+        self.offsets = np.zeros(1, dtype=np.int64) if offsets is None else offsets
+        self.columns = {} if columns is None else columns
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @classmethod
+    def build(cls, bucketcodes, columns):
+        """ Builds a segment from the (unsorted) bucket code of each element. """
+        order, unique_codes, bounds = group_by_bucket(bucketcodes)
+        columns = {name: values[order] for name, values in columns.items()}
+        return cls(unique_codes, bounds.astype(np.int64), columns)
+
+    def element_codes(self):
+        """ Returns the bucket code of each element. """
+        return np.repeat(self.codes, np.diff(self.offsets))
+
+    def merge(self, other):
+        """
+        Returns a segment with the elements of both segments (the ones of `self`
+        first). Raises a ValueError if they don't have the same attributes.
+        """
+        if len(self) == 0:
+            return other
+        if len(other) == 0:
+            return self
+
+        names = set(self.columns) | set(other.columns)
+        if len(names) != len(self.columns) or len(names) != len(other.columns):
+            raise ValueError("Every element must have the same attributes, got {} and {}."
+                             .format(sorted(self.columns), sorted(other.columns)))
+
+        bucketcodes = np.concatenate([self.element_codes(), other.element_codes()])
+        columns = {name: np.concatenate([self.columns[name], other.columns[name]])
+                   for name in names}
+        return Segment.build(bucketcodes, columns)
+
+    def remove(self, bucketcodes):
+        """ Returns a segment without the given buckets. """
+        keep = np.logical_not(np.in1d(self.element_codes(), bucketcodes))
+        if keep.all():
+            return self
+
+        columns = {name: values[keep] for name, values in self.columns.items()}
+        return Segment.build(self.element_codes()[keep], columns)
+
+    def lookup(self, bucketcodes):
+        """ Returns the bounds [start, end) of the given buckets (empty if missing). """
+        if len(self.codes) == 0:
+            empty = np.zeros(len(bucketcodes), dtype=np.int64)
+            return empty, empty
+
+        indices = np.minimum(np.searchsorted(self.codes, bucketcodes), len(self.codes) - 1)
+        found = self.codes[indices] == bucketcodes
+        starts = np.where(found, self.offsets[indices], 0)
+        ends = np.where(found, self.offsets[indices+1], 0)
+        return starts, ends
+
+
+class ColumnarStorage(MemoryStorage):
+    """
+    Storage in memory where each attribute is kept as contiguous NumPy arrays
+    (see `Segment`), one set per key prefix (i.e. per hash).
+
+    Buckets are retrieved as views on the columns (no copy). Stored elements
+    first go to a small delta segment which is merged into the main segment
+    once it holds more than `delta_fraction` of it (if None, only when calling
+    `merge`).
+    """
+
+    def __init__(self, keyprefix="", delta_fraction=0.125):
+        super(ColumnarStorage, self).__init__(keyprefix)
+        self.delta_fraction = delta_fraction
+        self.segments = defaultdict(lambda: [Segment(), Segment()])  # Main and delta segments per prefix.
+
+    def _column(self, attribute, values=None):
+        # Attributes that aren't `NumpyData` are kept as arrays of objects.
+        dtype = getattr(attribute, "dtype", object)
+        shape = getattr(attribute, "shape", ())
+        if values is None:
+            return np.zeros((0,) + shape, dtype=dtype)
+
+        return np.asarray(values, dtype=dtype).reshape((-1,) + shape)
+
+    def store(self, bucketcodes, bucketvalues, prefix=""):
+        columns = {attribute.name: self._column(attribute, values) for attribute, values in bucketvalues.items()}
+
+        main, delta = self.segments[prefix]
+        delta = delta.merge(Segment.build(np.asarray(bucketcodes, dtype=np.uint64), columns))
+        if self.delta_fraction is not None and len(delta) >= max(MIN_DELTA_SIZE, self.delta_fraction * len(main)):
+            main, delta = main.merge(delta), Segment()
+
+        self.segments[prefix] = [main, delta]
+        return len(bucketcodes)
+
+    def merge(self):
+        """ Merges every delta segment into its main segment. """
+        for prefix, (main, delta) in self.segments.items():
+            self.segments[prefix] = [main.merge(delta), Segment()]
+
+    def retrieve(self, bucketkeys, attribute, prefix=""):
+        if not isinstance(bucketkeys, np.ndarray):
+            bucketkeys = list(bucketkeys)
+
+        results = [None] * len(bucketkeys)
+        for key_prefix, codes, indices in split_bucketkeys(bucketkeys, prefix):
+            main, delta = self.segments.get(key_prefix, [Segment(), Segment()])
+            main_starts, main_ends = main.lookup(codes)
+            delta_starts, delta_ends = delta.lookup(codes)
+
+            for i, main_start, main_end, delta_start, delta_end in zip(indices, main_starts, main_ends,
+                                                                       delta_starts, delta_ends):
+                parts = []
+                if main_end > main_start:
+                    parts.append(main.columns[attribute.name][main_start:main_end])
+                if delta_end > delta_start:
+                    parts.append(delta.columns[attribute.name][delta_start:delta_end])
+
+                if len(parts) == 0:
+                    results[i] = self._column(attribute)
+                elif len(parts) == 1:
+                    results[i] = parts[0]  # View, no copy.
+                else:
+                    results[i] = np.concatenate(parts)
+
+        return results
+
+    def retrieve_rows(self, bucketkeys, attribute, rows, prefix=""):
+        if not isinstance(bucketkeys, np.ndarray):
+            bucketkeys = list(bucketkeys)
+
+        results = [None] * len(bucketkeys)
+        for key_prefix, codes, indices in split_bucketkeys(bucketkeys, prefix):
+            main, delta = self.segments.get(key_prefix, [Segment(), Segment()])
+            main_starts, main_ends = main.lookup(codes)
+            delta_starts, _ = delta.lookup(codes)
+
+            for i, main_start, main_end, delta_start in zip(indices, main_starts, main_ends, delta_starts):
+                bucket_rows = np.asarray(rows[i], dtype=np.int64)
+                in_main = bucket_rows < main_end - main_start  # Elements of the delta segment come after.
+                if in_main.all():
+                    if len(bucket_rows) == 0:
+                        results[i] = self._column(attribute)
+                    else:
+                        results[i] = main.columns[attribute.name][main_start + bucket_rows]
+                    continue
+
+                delta_rows = delta_start + bucket_rows[~in_main] - (main_end - main_start)
+                delta_values = delta.columns[attribute.name][delta_rows]
+                values = np.empty((len(bucket_rows),) + delta_values.shape[1:], dtype=delta_values.dtype)
+                values[~in_main] = delta_values
+                if in_main.any():
+                    values[in_main] = main.columns[attribute.name][main_start + bucket_rows[in_main]]
+
+                results[i] = values
+
+        return results
+
+    def remove(self, bucketkeys, prefix=""):
+        """
+        Parameters
+        ----------
+        bucketkeys: ndarray of uint64 or iterable of string
+            codes or keys of the buckets to delete (every attributes)
+        prefix: string
+            prefix of the keys (i.e. namespace)
+
+        Return
+        ------
+        count: int
+            number of buckets removed
+        """
+        count = 0
+        for key_prefix, codes, _ in split_bucketkeys(bucketkeys, prefix):
+            if key_prefix not in self.segments:
+                continue
+
+            found = np.zeros(len(codes), dtype=bool)
+            for segment in self.segments[key_prefix]:
+                starts, ends = segment.lookup(codes)
+                found |= ends > starts
+
+            count += int(found.sum())
+            self.segments[key_prefix] = [segment.remove(codes) for segment in self.segments[key_prefix]]
+
+        return count
+
+    def clear(self, bucketkeys=None):
+        """ Removes the given buckets (default: every buckets). """
+        if bucketkeys is not None:
+            return self.remove(bucketkeys)
+
+        count = len(self.bucketkeys())
+        self.segments.clear()
+        return count
+
+    def count(self, bucketkeys, prefix="", attribute=None):
+        # Every attribute has the same number of elements.
+        if not isinstance(bucketkeys, np.ndarray):
+            bucketkeys = list(bucketkeys)
+
+        counts = np.zeros(len(bucketkeys), dtype=np.int64)
+        for key_prefix, codes, indices in split_bucketkeys(bucketkeys, prefix):
+            for segment in self.segments.get(key_prefix, []):
+                starts, ends = segment.lookup(codes)
+                counts[indices] += ends - starts
+
+        return list(counts)
+
+    def bucketkeys(self, pattern=None, as_generator=False):
+        keys = []
+        for prefix, (main, delta) in self.segments.items():
+            keys += encode_bucketkeys(np.union1d(main.codes, delta.codes).astype(np.uint64), prefix)
+
+        return iter(keys) if as_generator else keys
+
+    def bucketkeys_all_attributes(self, pattern=None, as_generator=False):
+        return self.bucketkeys(pattern, as_generator)
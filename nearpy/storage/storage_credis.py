@@ -1,10 +1,12 @@
 import json
+import numpy as np
 import redis
 import credis
 import types
 
+from threading import local
 from itertools import izip, chain
-from nearpy.storage.storage import Storage
+from nearpy.storage.storage import Storage, group_by_bucket, encode_bucketkeys
 from nearpy.utils import chunk, ichunk
 
 BUFFER_SIZE = 100000
@@ -13,12 +15,34 @@ BUFFER_SIZE = 100000
 class CRedisStorage(Storage):
     """ Storage using credis. """
 
+    # Each thread uses its own credis connection (redis-py ones are pooled).
+    thread_safe = True
+
     def __init__(self, host='localhost', port=6379, db=0, keyprefix=""):
         """ Uses specified redis object for storage. """
-        self.credis = credis.Connection(host=host, port=port)
+        self.host = host
+        self.port = port
+        self.db = db
+        self._local = local()
         self.redis = redis.Redis(host=host, port=port, db=db)
         self.keyprefix = keyprefix
         self.infos_key = "infos"
+        self.attributes_key = self.keyprefix + "_attributes"  # Set of the names of the stored attributes.
+
+    @property
+    def credis(self):
+        """ Connection of the current thread, created on first use. """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = credis.Connection(host=self.host, port=self.port)
+
+        return connection
+
+    def reopen(self):
+        # Connections can't be shared between processes.
+        storage = CRedisStorage(host=self.host, port=self.port, db=self.db, keyprefix=self.keyprefix)
+        storage.name = getattr(self, "name", None)  # Set by `storage_factory`.
+        return storage
 
     @property
     def infos(self):
@@ -57,38 +81,51 @@ class CRedisStorage(Storage):
 
         self.infos = infos
 
-    def store(self, bucketkeys, bucketvalues):
-        keys = [self.keyprefix + "_" + bucketkey for bucketkey in bucketkeys]
-        commands = []
+    def store(self, bucketcodes, bucketvalues, prefix=""):
+        order, unique_codes, bounds = group_by_bucket(bucketcodes)
+        commands = [("sadd", self.attributes_key) + tuple(attribute.name for attribute in bucketvalues)]
         for attribute, values in bucketvalues.items():
-            for key, value in izip(keys, attribute.dumps(values)):
-                commands.append(("rpush", key + "_" + attribute.name, value))
-                #self.credis.execute("rpush", key + "_" + attribute.name, value)
+            keys = encode_bucketkeys(unique_codes, self.keyprefix + "_" + prefix, "_" + attribute.name)
+            items = list(attribute.dumps(values[order]))
+            for key, start, end in izip(keys, bounds[:-1], bounds[1:]):
+                # A single command pushes every value of the bucket.
+                commands.append(("rpush", key) + tuple(items[start:end]))
 
-        self.credis.execute_pipeline(*commands)
-        return len(bucketkeys)
+        if len(bucketvalues) > 0:
+            self.credis.execute_pipeline(*commands)
 
-    def retrieve_batch(self, bucketkeys, attribute):
-        keys = [self.keyprefix + "_" + bucketkey + '_' + attribute.name for bucketkey in bucketkeys]
-        commands = [("lrange", key, 0, -1) for key in keys]
-        results = self.credis.execute_pipeline(*commands)
+        return len(bucketcodes)
 
-        # for bucketkeys_chunk in ichunk(bucketkeys, n=BUFFER_SIZE):
-        #     keys = [self.keyprefix + "_" + bucketkey + '_' + attribute.name for bucketkey in bucketkeys_chunk]
-        #     commands = [("lrange", key, 0, -1) for key in keys]
-        #     results += self.credis.execute_pipeline(*commands)
+    def retrieve_batch(self, bucketkeys, attribute, prefix=""):
+        return self.retrieve(bucketkeys, attribute, prefix)
 
+    def retrieve(self, bucketkeys, attribute, prefix=""):
+        # All buckets are fetched in a single round trip.
+        keys = encode_bucketkeys(bucketkeys, self.keyprefix + "_" + prefix, "_" + attribute.name)
+        commands = [("lrange", key, 0, -1) for key in keys]
+        results = self.credis.execute_pipeline(*commands) if len(commands) > 0 else []
         return [attribute.loads("".join(result)) for result in results]
 
-    def retrieve(self, bucketkeys, attribute):
-        keys = [self.keyprefix + "_" + bucketkey + '_' + attribute.name for bucketkey in bucketkeys]
-        results = [self.credis.execute("lrange", key, 0, -1) for key in keys]
-        return [attribute.loads("".join(result)) for result in results]
+    def retrieve_rows(self, bucketkeys, attribute, rows, prefix=""):
+        # Only the range of elements spanned by the rows of each bucket is read.
+        keys = encode_bucketkeys(bucketkeys, self.keyprefix + "_" + prefix, "_" + attribute.name)
+        rows = [np.asarray(bucket_rows, dtype=np.int64) for bucket_rows in rows]
+        commands = [("lrange", key, int(bucket_rows.min()), int(bucket_rows.max()))
+                    for key, bucket_rows in izip(keys, rows) if len(bucket_rows) > 0]
+        results = iter(self.credis.execute_pipeline(*commands) if len(commands) > 0 else [])
+
+        buckets = []
+        for bucket_rows in rows:
+            items = next(results) if len(bucket_rows) > 0 else []
+            first = bucket_rows.min() if len(bucket_rows) > 0 else 0
+            buckets.append(attribute.loads("".join(items[row - first] for row in bucket_rows)))
+
+        return buckets
 
     def retrieve_all(self, bucketkeys, attribute):
         results = []
         for bucketkeys_chunk in ichunk(bucketkeys, n=BUFFER_SIZE):
-            keys = [self.keyprefix + "_" + bucketkey + '_' + attribute.name for bucketkey in bucketkeys_chunk]
+            keys = encode_bucketkeys(bucketkeys_chunk, self.keyprefix + "_", "_" + attribute.name)
             commands = [("lrange", key, 0, -1) for key in keys]
             results += self.credis.execute_pipeline(*commands)
 
@@ -118,12 +155,44 @@ class CRedisStorage(Storage):
 
         return count
 
-    def count(self, bucketkeys):
+    def remove(self, bucketkeys, prefix=""):
         """
         Parameters
         ----------
-        bucketkeys: iterable of string
-            keys from which to retrieve values
+        bucketkeys: ndarray of uint64 or iterable of string
+            codes or keys of the buckets to delete (every attributes)
+        prefix: string
+            prefix of the keys (i.e. namespace)
+
+        Return
+        ------
+        count: int
+            number of buckets removed
+        """
+        names = sorted(self.credis.execute("smembers", self.attributes_key))
+        if len(names) == 0:
+            return 0
+
+        count = 0
+        chunks = chunk if isinstance(bucketkeys, np.ndarray) else ichunk  # Keep codes as arrays.
+        for bucketkeys_chunk in chunks(bucketkeys, n=BUFFER_SIZE):
+            # One "del" per bucket, removing the keys of every attribute.
+            keys = [encode_bucketkeys(bucketkeys_chunk, self.keyprefix + "_" + prefix, "_" + name) for name in names]
+            results = self.credis.execute_pipeline(*[("del",) + bucket_keys for bucket_keys in izip(*keys)])
+            count += sum(result > 0 for result in results)
+
+        return count
+
+    def count(self, bucketkeys, prefix="", attribute=None):
+        """
+        Parameters
+        ----------
+        bucketkeys: ndarray of uint64 or iterable of string
+            codes or keys of buckets to count
+        prefix: string
+            prefix of the keys (i.e. namespace)
+        attribute: Data, optional
+            attribute whose elements are counted (default: "patch")
 
         Return
         ------
@@ -131,9 +200,11 @@ class CRedisStorage(Storage):
             size of each given bucket
         """
         counts = []
-        suffix = "_patch"
-        for bucketkeys_chunk in ichunk(bucketkeys, n=BUFFER_SIZE):
-            commands = [("llen", self.keyprefix + "_" + bucketkey + suffix) for bucketkey in bucketkeys_chunk]
+        suffix = "_" + (attribute.name if attribute is not None else "patch")
+        chunks = chunk if isinstance(bucketkeys, np.ndarray) else ichunk  # Keep codes as arrays.
+        for bucketkeys_chunk in chunks(bucketkeys, n=BUFFER_SIZE):
+            keys = encode_bucketkeys(bucketkeys_chunk, self.keyprefix + "_" + prefix, suffix)
+            commands = [("llen", key) for key in keys]
             counts += self.credis.execute_pipeline(*commands)
 
         return counts
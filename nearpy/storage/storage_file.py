@@ -1,35 +1,125 @@
-import re
-import types
-
 import os
-from time import time
+import threading
+
+import numpy as np
 
-from collections import defaultdict
 from itertools import izip
-from nearpy.storage.storage import Storage
+from nearpy.storage.storage import Storage, group_by_bucket, encode_bucketkeys, split_bucketkeys
+from nearpy.storage.storage_mmap import write_arrays, map_arrays
 from os.path import join as pjoin
 from nearpy.utils.utils import load_dict_from_json, save_dict_to_json
 
 
+def _merge_tables(tables, exclude=None):
+    """
+    Merges the buckets of many segment tables (in order), dropping the buckets
+    whose code is in `exclude`. Returns the merged table.
+    """
+    if len(tables) == 0:
+        return None
+
+    codes = np.concatenate([table["codes"] for table in tables])
+    counts = np.concatenate([np.diff(table["bounds"]) for table in tables])
+    keep = np.ones(len(codes), dtype=bool) if exclude is None else np.logical_not(np.in1d(codes, exclude))
+    order = np.argsort(codes, kind="mergesort")  # Stable, i.e. older elements first.
+    order = order[keep[order]]
+
+    unique_codes, starts = np.unique(codes[order], return_index=True)
+    merged = {"codes": unique_codes, "bounds": np.zeros(len(unique_codes)+1, dtype=np.int64), "attributes": {}}
+    if len(order) > 0:
+        merged["bounds"][1:] = np.cumsum(np.add.reduceat(counts[order], starts))
+
+    for name in tables[0]["attributes"]:
+        # Bytes of every piece of bucket, gathered in the merged order at once.
+        data = np.concatenate([table["attributes"][name]["data"] for table in tables])
+        bases = np.cumsum([0] + [len(table["attributes"][name]["data"]) for table in tables])[:-1]
+        piece_starts = np.concatenate([table["attributes"][name]["offsets"][:-1] + base
+                                       for table, base in izip(tables, bases)])[order]
+        piece_sizes = np.concatenate([np.diff(table["attributes"][name]["offsets"]) for table in tables])[order]
+
+        indices = np.arange(piece_sizes.sum()) + np.repeat(piece_starts - (np.cumsum(piece_sizes) - piece_sizes),
+                                                           piece_sizes)
+        offsets = np.zeros(len(unique_codes)+1, dtype=np.int64)
+        if len(order) > 0:
+            offsets[1:] = np.cumsum(np.add.reduceat(piece_sizes, starts))
+
+        merged["attributes"][name] = {"offsets": offsets, "data": data[indices]}
+
+    return merged
+
+
 class FileStorage(Storage):
-    """ Storage using files and folders. """
+    """
+    Storage using append-only segment files.
 
-    def __init__(self, name, root="./"):
+    Each call to `store` writes one segment file holding, for each key prefix,
+    the sorted bucket codes, the bounds of the elements of each bucket and,
+    for each attribute, the serialized buckets one after the other with their
+    offsets (see `write_arrays`). A manifest lists the segments in order.
+
+    Removing buckets writes a segment holding only their codes (a tombstone,
+    `removed`), which hides their elements stored by older segments.
+
+    Segments are memory-mapped for retrieval. Once there are more than
+    `max_segments` segments, they are merged into one by a background thread
+    (applying the tombstones).
+    """
+
+    # Retrieval can be done concurrently by many threads.
+    thread_safe = True
+
+    def __init__(self, name, root="./", max_segments=16):
+        self.keyprefix = name
         self.root = root
         self.infos_filename = pjoin(root, "infos.json")
+        self.max_segments = max_segments
 
         #Create repository structure
         if not os.path.isdir(root):
             os.makedirs(root)
 
-        if name != "":
-            self.buckets_dir = pjoin(root, name)
-            if not os.path.isdir(self.buckets_dir):
-                os.makedirs(self.buckets_dir)
+        self.buckets_dir = pjoin(root, name)
+        if not os.path.isdir(self.buckets_dir):
+            os.makedirs(self.buckets_dir)
 
         if not os.path.isfile(self.infos_filename):
             save_dict_to_json(self.infos_filename, {})
 
+        self.manifest_filename = pjoin(self.buckets_dir, "manifest.json")
+        self._lock = threading.Lock()  # Protects the manifest and the list of segments.
+        self._compaction = None
+        self._load_manifest()
+
+    def _load_manifest(self):
+        manifest = {"segments": [], "next_id": 0}
+        if os.path.isfile(self.manifest_filename):
+            manifest = load_dict_from_json(self.manifest_filename)
+
+        self.next_id = manifest["next_id"]
+        # Segments are replaced (never modified) so readers can use them without locking.
+        self.segments = [(str(filename), map_arrays(pjoin(self.buckets_dir, filename))[0])
+                         for filename in manifest["segments"]]
+
+    def _save_manifest(self):
+        manifest = {"segments": [filename for filename, _ in self.segments], "next_id": self.next_id}
+        save_dict_to_json(self.manifest_filename + ".tmp", manifest)
+        os.rename(self.manifest_filename + ".tmp", self.manifest_filename)
+
+    def _write_segment(self, tables):
+        """ Writes a new segment file, returns it (not yet listed in the manifest). """
+        with self._lock:
+            filename = "segment-{:08d}.idx".format(self.next_id)
+            self.next_id += 1
+
+        write_arrays(pjoin(self.buckets_dir, filename), tables)
+        return filename, map_arrays(pjoin(self.buckets_dir, filename))[0]
+
+    def reopen(self):
+        # Segments are mapped again by the new handle.
+        storage = FileStorage(self.keyprefix, self.root, self.max_segments)
+        storage.name = getattr(self, "name", None)  # Set by `storage_factory`.
+        return storage
+
     def get_info(self, key):
         infos = load_dict_from_json(self.infos_filename)
         return infos.get(key, [])
@@ -56,111 +146,227 @@ class FileStorage(Storage):
 
         save_dict_to_json(self.infos_filename, infos)
 
-    def store(self, bucketkeys, bucketvalues):
-        buf = defaultdict(lambda: [])
-        start = time()
+    def store(self, bucketcodes, bucketvalues, prefix=""):
+        """
+        Raises a ValueError if the attributes differ from the ones already
+        stored under this prefix (the segments could not be merged).
+        """
+        names = sorted(attribute.name for attribute in bucketvalues)
+        for _, tables in self.segments:
+            table = tables.get(prefix)
+            if table is not None and "removed" not in table and sorted(table["attributes"]) != names:
+                raise ValueError("Every element must have the same attributes, got {} and {}."
+                                 .format(sorted(table["attributes"]), names))
+
+        order, unique_codes, bounds = group_by_bucket(bucketcodes)
+        table = {"codes": unique_codes, "bounds": bounds.astype(np.int64), "attributes": {}}
         for attribute, values in bucketvalues.items():
-            for key, value in izip(bucketkeys, attribute.dumps(values)):
-                filename = pjoin(self.buckets_dir, key + "_" + attribute.name + ".npy")
-                buf[filename].append(value)
-
-        print "buffering: {:.2f} ({:,} buckets)".format(time()-start, len(buf)/len(bucketvalues))
-
-        start = time()
-        for filename, values in buf.items():
-            # with open(filename, 'ab') as f:
-            #     f.write("".join(values))
-
-            data = ""
-            if os.path.isfile(filename):
-                data = open(filename, 'rb').read()
-            open(filename, 'wb').write(data + "".join(values))
+            buckets = attribute.dumps_buckets(values[order], bounds)
+            offsets = np.zeros(len(buckets)+1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(bucket) for bucket in buckets])
+            table["attributes"][attribute.name] = {"offsets": offsets,
+                                                   "data": np.frombuffer("".join(buckets), dtype=np.uint8)}
+
+        self._append_segment({prefix: table})
+        return len(bucketcodes)
+
+    def _append_segment(self, tables):
+        """ Writes a new segment after the others, compacting in background if there are too many. """
+        segment = self._write_segment(tables)
+        with self._lock:
+            self.segments = self.segments + [segment]
+            self._save_manifest()
+
+        if len(self.segments) > self.max_segments:
+            self.compact(background=True)
+
+    def _lookup(self, bucketkeys, prefix):
+        """
+        Yields (table, indices, positions) for each segment table holding some
+        of the given buckets, `indices` being their positions in `bucketkeys`
+        and `positions` their positions in the table.
+        """
+        segments = self.segments
+        for key_prefix, codes, indices in split_bucketkeys(bucketkeys, prefix):
+            # Elements of a bucket stored before its last removal are ignored.
+            first_segments = np.zeros(len(codes), dtype=np.int64)
+            for i, (_, tables) in enumerate(segments):
+                table = tables.get(key_prefix)
+                if table is not None and "removed" in table:
+                    first_segments[np.in1d(codes, table["removed"])] = i + 1
+
+            for i, (_, tables) in enumerate(segments):
+                table = tables.get(key_prefix)
+                if table is None or "codes" not in table or len(table["codes"]) == 0:
+                    continue
+
+                positions = np.minimum(np.searchsorted(table["codes"], codes), len(table["codes"]) - 1)
+                found = (table["codes"][positions] == codes) & (first_segments <= i)
+                yield table, indices[found], positions[found]
+
+    def retrieve(self, bucketkeys, attribute, prefix=""):
+        if not isinstance(bucketkeys, np.ndarray):
+            bucketkeys = list(bucketkeys)
+
+        results = [[] for _ in range(len(bucketkeys))]
+        for table, indices, positions in self._lookup(bucketkeys, prefix):
+            column = table["attributes"][attribute.name]
+            for i, position in izip(indices, positions):
+                start, end = column["offsets"][position:position+2]
+                results[i].append(column["data"][start:end].tostring())
 
-        print "writing: {:.2f}".format(time()-start)
-        return len(bucketkeys)
+        return [attribute.loads("".join(result)) for result in results]
 
-    def retrieve(self, bucketkeys, attribute):
-        filenames = [pjoin(self.buckets_dir, bucketkey + "_" + attribute.name + ".npy") for bucketkey in bucketkeys]
-
-        results = []
-        for filename in filenames:
-            if os.path.isfile(filename):
-                results.append(open(filename).read())
-            else:
-                results.append("")
+    def retrieve_rows(self, bucketkeys, attribute, rows, prefix=""):
+        if not hasattr(attribute, "dtype"):
+            return super(FileStorage, self).retrieve_rows(bucketkeys, attribute, rows, prefix)
+
+        if not isinstance(bucketkeys, np.ndarray):
+            bucketkeys = list(bucketkeys)
+
+        # Elements have a fixed size, only the ones needed are read from the mapped segments.
+        nbytes = int(np.prod(attribute.shape)) * attribute.dtype.itemsize
+        rows = [np.asarray(bucket_rows, dtype=np.int64) for bucket_rows in rows]
+        results = [[None] * len(bucket_rows) for bucket_rows in rows]
+        firsts = np.zeros(len(bucketkeys), dtype=np.int64)  # Offset of the bucket's first element in the segment.
+        for table, indices, positions in self._lookup(bucketkeys, prefix):
+            column = table["attributes"][attribute.name]
+            for i, position in izip(indices, positions):
+                size = table["bounds"][position+1] - table["bounds"][position]
+                start = column["offsets"][position]
+                for j in np.flatnonzero((rows[i] >= firsts[i]) & (rows[i] < firsts[i] + size)):
+                    offset = start + (rows[i][j] - firsts[i]) * nbytes
+                    results[i][j] = column["data"][offset:offset+nbytes].tostring()
+
+                firsts[i] += size
 
         return [attribute.loads("".join(result)) for result in results]
 
-    def clear(self, bucketkeys):
+    def count(self, bucketkeys, prefix="", attribute=None):
         """
         Parameters
         ----------
-        bucket_keys: iterable of string
-            keys of the buckets to delete
+        bucketkeys: ndarray of uint64 or iterable of string
+            codes or keys of buckets to count
         prefix: string
-            if set, clear every buckets having this prefix
+            prefix of the keys (i.e. namespace)
+        attribute: Data, optional
+            ignored, every attribute has the same number of elements
 
         Return
         ------
-        count: int
-            number of buckets cleared
+        counts: list of int
+            size of each given bucket
         """
-        if not isinstance(bucketkeys, types.ListType) and not isinstance(bucketkeys, types.GeneratorType):
-            bucketkeys = [bucketkeys]
+        if not isinstance(bucketkeys, np.ndarray):
+            bucketkeys = list(bucketkeys)
 
-        count = 0
-        for bucketkey in bucketkeys:
-            filename = pjoin(self.buckets_dir, bucketkey + ".npy")
-            if os.path.isfile(filename):
-                os.remove(filename)
-                count += 1
+        counts = np.zeros(len(bucketkeys), dtype=np.int64)
+        for table, indices, positions in self._lookup(bucketkeys, prefix):
+            np.add.at(counts, indices, table["bounds"][positions+1] - table["bounds"][positions])
 
-        return count
+        return list(counts)
 
-    def count(self, bucketkeys):
+    def compact(self, background=False):
+        """
+        Merges the current segments into a single one, applying the tombstones.
+        Segments stored meanwhile are kept as is.
+
+        Returns the compaction thread if `background` is True.
+        """
+        if background:
+            if self._compaction is not None and self._compaction.is_alive():
+                return self._compaction  # Already compacting.
+
+            self._compaction = threading.Thread(target=self.compact)
+            self._compaction.daemon = True
+            self._compaction.start()
+            return self._compaction
+
+        segments = self.segments
+        if len(segments) <= 1 and not any("removed" in table for _, tables in segments for table in tables.values()):
+            return None
+
+        prefixes = set(prefix for _, tables in segments for prefix in tables)
+        merged = {}
+        for prefix in prefixes:
+            tables = []
+            for _, segment_tables in segments:
+                table = segment_tables.get(prefix)
+                if table is None:
+                    continue
+
+                if "removed" in table:
+                    # Drops the buckets stored so far.
+                    merged_table = _merge_tables(tables, table["removed"])
+                    tables = [] if merged_table is None else [merged_table]
+                else:
+                    tables.append(table)
+
+            if len(tables) > 0:
+                merged[prefix] = _merge_tables(tables)
+
+        segment = self._write_segment(merged)
+        with self._lock:
+            compacted = set(filename for filename, _ in segments)
+            self.segments = [segment] + [s for s in self.segments if s[0] not in compacted]
+            self._save_manifest()
+
+        for filename in compacted:
+            os.remove(pjoin(self.buckets_dir, filename))
+
+        return None
+
+    def remove(self, bucketkeys, prefix=""):
         """
         Parameters
         ----------
-        bucketkeys: iterable of string
-            keys of buckets to count
+        bucketkeys: ndarray of uint64 or iterable of string
+            codes or keys of the buckets to delete (every attributes)
+        prefix: string
+            prefix of the keys (i.e. namespace)
 
         Return
         ------
-        counts: list of int
-            size of each given bucket
+        count: int
+            number of buckets removed
         """
-        counts = []
-        suffix = "_label"
-        for bucketkey in bucketkeys:
-            filename = pjoin(self.buckets_dir, bucketkey + suffix + ".npy")
-            nb_bytes = os.path.getsize(filename)
-            counts.append(nb_bytes)  # We suppose each label fits in a byte.
-
-        return counts
-
-    def bucketkeys(self, pattern=".*", as_generator=False):
-        suffix = "patch"
-        extension = ".npy"
-        pattern = "{pattern}_{suffix}{extension}".format(pattern=pattern, suffix=suffix, extension=extension)
-        regex = re.compile(pattern)
-        end = -(len(suffix) + len(extension) + 1)
-
-        filenames = os.listdir(self.buckets_dir)
-        keys = (filename[:end] for filename in filenames if regex.match(filename) is not None)
-        if not as_generator:
-            keys = list(keys)
-
-        return keys
-
-    def bucketkeys_all_attributes(self, pattern=".*", as_generator=False):
-        extension = ".npy"
-        pattern = "{pattern}{extension}".format(pattern=pattern, extension=extension)
-        regex = re.compile(pattern)
-        end = -len(extension)
-
-        filenames = os.listdir(self.buckets_dir)
-        keys = (filename[:end] for filename in filenames if regex.match(filename) is not None)
-        if not as_generator:
-            keys = list(keys)
-
-        return keys
+        if not isinstance(bucketkeys, np.ndarray):
+            bucketkeys = list(bucketkeys)
+
+        count = sum(np.array(self.count(bucketkeys, prefix)) > 0)
+        self._append_segment({key_prefix: {"removed": np.unique(codes).astype(np.uint64)}
+                              for key_prefix, codes, _ in split_bucketkeys(bucketkeys, prefix)})
+        return int(count)
+
+    def wait_compaction(self):
+        """ Waits for the background compaction, if any, to be done. """
+        if self._compaction is not None:
+            self._compaction.join()
+
+    def clear(self):
+        """ Removes every buckets. """
+        self.wait_compaction()
+        with self._lock:
+            filenames = [filename for filename, _ in self.segments]
+            self.segments = []
+            self._save_manifest()
+
+        for filename in filenames:
+            os.remove(pjoin(self.buckets_dir, filename))
+
+    def bucketkeys(self, deprecated_pattern=".*", as_generator=False):
+        codes = {}
+        for _, tables in self.segments:
+            for prefix, table in tables.items():
+                prefix_codes = codes.get(prefix, np.zeros(0, dtype=np.uint64))
+                if "removed" in table:
+                    codes[prefix] = np.setdiff1d(prefix_codes, table["removed"]).astype(np.uint64)
+                else:
+                    codes[prefix] = np.union1d(prefix_codes, table["codes"]).astype(np.uint64)
+
+        keys = [key for prefix in codes for key in encode_bucketkeys(codes[prefix], prefix)]
+        return iter(keys) if as_generator else keys
+
+    def bucketkeys_all_attributes(self, deprecated_pattern=".*", as_generator=False):
+        return self.bucketkeys(deprecated_pattern, as_generator)
@@ -3,16 +3,20 @@ import types
 
 from collections import defaultdict
 from itertools import izip
-from nearpy.storage.storage import Storage
+from nearpy.storage.storage import Storage, group_by_bucket, encode_bucketkeys
 
 
 class MemoryStorage(Storage):
     """ Storage in memory. """
 
+    # Retrieval can be done concurrently by many threads.
+    thread_safe = True
+
     def __init__(self, keyprefix=""):
         self.infos = defaultdict(lambda: [])
         self.buckets = defaultdict(lambda: [])
         self.keyprefix = keyprefix
+        self.attribute_names = set()  # Names of the stored attributes.
 
     def get_info(self, key):
         return self.infos[key]
@@ -29,19 +33,58 @@ class MemoryStorage(Storage):
         else:
             del self.infos[key]
 
-    def store(self, bucketkeys, bucketvalues):
-        keys = [self.keyprefix + "_" + bucketkey for bucketkey in bucketkeys]
+    def store(self, bucketcodes, bucketvalues, prefix=""):
+        order, unique_codes, bounds = group_by_bucket(bucketcodes)
         for attribute, values in bucketvalues.items():
-            for key, value in izip(keys, attribute.dumps(values)):
-                self.buckets[key + "_" + attribute.name].append(value)
+            self.attribute_names.add(attribute.name)
+            keys = encode_bucketkeys(unique_codes, self.keyprefix + "_" + prefix, "_" + attribute.name)
+            items = list(attribute.dumps(values[order]))
+            for key, start, end in izip(keys, bounds[:-1], bounds[1:]):
+                self.buckets[key].extend(items[start:end])
 
-        return len(bucketkeys)
+        return len(bucketcodes)
 
-    def retrieve(self, bucketkeys, attribute):
-        keys = [self.keyprefix + "_" + bucketkey + '_' + attribute.name for bucketkey in bucketkeys]
-        results = [self.credis.execute("lrange", key, 0, -1) for key in keys]
+    def retrieve(self, bucketkeys, attribute, prefix=""):
+        keys = encode_bucketkeys(bucketkeys, self.keyprefix + "_" + prefix, "_" + attribute.name)
+        results = [self.buckets.get(key, []) for key in keys]
         return [attribute.loads("".join(result)) for result in results]
 
+    def retrieve_rows(self, bucketkeys, attribute, rows, prefix=""):
+        keys = encode_bucketkeys(bucketkeys, self.keyprefix + "_" + prefix, "_" + attribute.name)
+        results = []
+        for key, bucket_rows in izip(keys, rows):
+            items = self.buckets.get(key, [])
+            results.append(attribute.loads("".join(items[row] for row in bucket_rows)))
+
+        return results
+
+    def remove(self, bucketkeys, prefix=""):
+        """
+        Parameters
+        ----------
+        bucketkeys: ndarray of uint64 or iterable of string
+            codes or keys of the buckets to delete (every attributes), or keys
+            of a single attribute (see `bucketkeys_all_attributes`)
+        prefix: string
+            prefix of the keys (i.e. namespace)
+
+        Return
+        ------
+        count: int
+            number of buckets removed
+        """
+        count = 0
+        for key in encode_bucketkeys(bucketkeys, self.keyprefix + "_" + prefix):
+            if key in self.buckets:
+                del self.buckets[key]
+                count += 1
+                continue
+
+            removed = [self.buckets.pop(key + "_" + name, None) for name in self.attribute_names]
+            count += any(bucket is not None for bucket in removed)
+
+        return count
+
     def clear(self, bucketkeys):
         """
         Parameters
@@ -68,30 +111,30 @@ class MemoryStorage(Storage):
 
         return count
 
-    def count(self, bucketkeys):
+    def count(self, bucketkeys, prefix="", attribute=None):
         """
         Parameters
         ----------
-        bucketkeys: iterable of string
-            keys from which to retrieve values
+        bucketkeys: ndarray of uint64 or iterable of string
+            codes or keys of buckets to count
+        prefix: string
+            prefix of the keys (i.e. namespace)
+        attribute: Data, optional
+            attribute whose elements are counted (default: "patch")
 
         Return
         ------
         counts: list of int
             size of each given bucket
         """
-        counts = []
-        suffix = "_patch"
-        for bucketkey in bucketkeys:
-            key = self.keyprefix + "_" + bucketkey + suffix
-            counts.append(len(self.buckets[key]))
-
-        return counts
+        suffix = "_" + (attribute.name if attribute is not None else "patch")
+        keys = encode_bucketkeys(bucketkeys, self.keyprefix + "_" + prefix, suffix)
+        return [len(self.buckets.get(key, [])) for key in keys]
 
-    def bucketkeys(self, pattern=".", as_generator=False):
+    def bucketkeys(self, pattern=".*", as_generator=False):
         suffix = "patch"
-        pattern = "{prefix}_{pattern}_{suffix}".format(prefix=self.keyprefix, pattern=pattern, suffix=suffix)
-        regex = re.compile(pattern)
+        pattern = "{prefix}_{pattern}_{suffix}$".format(prefix=self.keyprefix, pattern=pattern, suffix=suffix)
+        regex = re.compile(pattern, re.DOTALL)  # Keys are binary.
         start = len(self.keyprefix) + 1
         end = -(len(suffix) + 1)
 
@@ -101,9 +144,9 @@ class MemoryStorage(Storage):
 
         return keys
 
-    def bucketkeys_all_attributes(self, pattern=".", as_generator=False):
+    def bucketkeys_all_attributes(self, pattern=".*", as_generator=False):
         pattern = "{prefix}_{pattern}".format(prefix=self.keyprefix, pattern=pattern)
-        regex = re.compile(pattern)
+        regex = re.compile(pattern, re.DOTALL)
         start = len(self.keyprefix) + 1
 
         keys = (key[start:] for key in self.buckets.keys() if regex.match(key) is not None)
@@ -0,0 +1,175 @@
+import json
+import os
+
+import numpy as np
+
+from os.path import join as pjoin
+from nearpy.storage.storage_columnar import ColumnarStorage, Segment
+
+MAGIC = b"NEARPYIX"
+VERSION = 2
+ALIGNMENT = 64  # Arrays start on cache line boundaries.
+
+# File layout:
+#   MAGIC | VERSION (uint64) | header size (uint64) | header (JSON) | arrays
+# The header describes nested dicts of arrays (e.g. for each key prefix, the
+# sorted uint64 bucket codes, the offsets delimiting the buckets and one column
+# per attribute). Each node is either {"dict": descriptions of its children}
+# or {"array": position, dtype and shape}, so that names (e.g. of attributes)
+# never clash with the description. Positions are
+# relative to the first array, which starts at the first aligned position
+# after the header.
+
+
+def _align(position):
+    return position + (-position % ALIGNMENT)
+
+
+def write_arrays(filename, arrays, infos={}):
+    """
+    Writes nested dicts of arrays in a single file. The file is replaced only
+    once complete.
+    """
+    chunks = []
+
+    def describe(arrays, position):
+        descriptions = {}
+        for name, array in arrays.items():
+            if isinstance(array, dict):
+                children, position = describe(array, position)
+                descriptions[name] = {"dict": children}
+                continue
+
+            position = _align(position)
+            descriptions[name] = {"array": {"position": position, "dtype": array.dtype.str, "shape": array.shape}}
+            chunks.append((position, array))
+            position += array.nbytes
+
+        return descriptions, position
+
+    descriptions, _ = describe(arrays, 0)
+    header = json.dumps({"arrays": descriptions, "infos": infos})
+    start = _align(len(MAGIC) + 16 + len(header))
+
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "wb") as f:
+        f.write(MAGIC)
+        f.write(np.array([VERSION, len(header)], dtype=np.uint64).tostring())
+        f.write(header)
+        for position, array in chunks:
+            f.write(b"\0" * (start + position - f.tell()))
+            f.write(np.ascontiguousarray(array).tostring())
+
+    os.rename(tmp_filename, filename)
+
+
+def map_arrays(filename):
+    """
+    Maps a file written by `write_arrays`. Returns the nested dicts of arrays
+    (views on the mapped file) and the infos.
+    """
+    with open(filename, "rb") as f:
+        magic = f.read(len(MAGIC))
+        version, header_size = np.frombuffer(f.read(16), dtype=np.uint64)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a NearPy index file (version {}): {}".format(VERSION, filename))
+
+        header = json.loads(f.read(int(header_size)))
+
+    start = _align(len(MAGIC) + 16 + int(header_size))
+    data = None
+    if os.path.getsize(filename) > start:
+        data = np.memmap(filename, dtype=np.uint8, mode="r", offset=start)
+
+    def view(descriptions):
+        arrays = {}
+        for name, description in descriptions.items():
+            if "dict" in description:
+                arrays[str(name)] = view(description["dict"])
+                continue
+
+            description = description["array"]
+            dtype = np.dtype(str(description["dtype"]))
+            shape = tuple(description["shape"])
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            if nbytes == 0:
+                arrays[str(name)] = np.zeros(shape, dtype=dtype)
+            else:
+                position = description["position"]
+                arrays[str(name)] = data[position:position+nbytes].view(dtype).reshape(shape)
+
+        return arrays
+
+    return view(header["arrays"]), header["infos"]
+
+
+class MMapStorage(ColumnarStorage):
+    """
+    Read-only index stored in a single file which is memory-mapped, i.e.
+    buckets are retrieved as views on the file without any deserialization
+    and processes reading the same file share the same pages in memory.
+
+    Stored elements are kept in memory (delta segments) until `save` writes
+    a new index file containing them.
+    """
+
+    def __init__(self, name, root="./"):
+        # Elements are merged only when saving.
+        super(MMapStorage, self).__init__(keyprefix=name, delta_fraction=None)
+        self.root = root
+        self.filename = pjoin(root, name + ".idx")
+
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+        self._open()
+
+    def _open(self):
+        self.segments.clear()
+        if not os.path.isfile(self.filename):
+            return
+
+        tables, infos = map_arrays(self.filename)
+        for prefix, table in tables.items():
+            self.segments[prefix] = [Segment(table["codes"], table["offsets"], table["columns"]), Segment()]
+
+        self.infos.clear()
+        self.infos.update(infos)
+
+    def reopen(self):
+        # Processes mapping the same file share its pages. Elements not saved yet are not seen.
+        storage = MMapStorage(self.keyprefix, self.root)
+        storage.name = getattr(self, "name", None)  # Set by `storage_factory`.
+        return storage
+
+    def merge(self):
+        self.save()
+
+    def save(self):
+        """
+        Writes the index file (i.e. every element stored so far) then maps it.
+        """
+        tables = {}
+        for prefix, (main, delta) in self.segments.items():
+            segment = main.merge(delta)
+            if len(segment) == 0:
+                continue
+
+            if any(column.dtype == object for column in segment.columns.values()):
+                raise ValueError("Only `NumpyData` attributes can be saved in an index file.")
+
+            tables[prefix] = {"codes": segment.codes, "offsets": segment.offsets, "columns": segment.columns}
+
+        write_arrays(self.filename, tables, self.infos)
+        self._open()
+
+    def clear(self, bucketkeys=None):
+        if bucketkeys is not None:
+            return self.remove(bucketkeys)
+
+        count = len(self.bucketkeys())
+        self.segments.clear()
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
+
+        return count
@@ -6,9 +6,10 @@ import shutil
 import rocksdb
 import os
 
-from collections import defaultdict
+import numpy as np
+
 from itertools import izip, takewhile
-from nearpy.storage.storage import Storage
+from nearpy.storage.storage import Storage, group_by_bucket, encode_bucketkeys
 from os.path import join as pjoin
 from nearpy.utils.utils import Timer
 
@@ -42,6 +43,9 @@ class AttributePrefix(rocksdb.interfaces.SliceTransform):
 class RocksDBStorage(Storage):
     """ Storage using RocksDB. """
 
+    # Retrieval can be done concurrently by many threads.
+    thread_safe = True
+
     def __init__(self, name, root="./", readonly=False):
         self.db_filename = pjoin(root, name)
 
@@ -59,77 +63,130 @@ class RocksDBStorage(Storage):
         with Timer("Opening RocksDB: {}".format(name)):
             self.db = rocksdb.DB(self.db_filename, options, read_only=readonly)
 
-    def store(self, bucketkeys, bucketvalues):
-        buckets = defaultdict(lambda: [])
+    def reopen(self):
+        # A database handle can't be shared between processes.
+        root, name = os.path.split(self.db_filename)
+        storage = RocksDBStorage(name, root, readonly=True)
+        storage.name = getattr(self, "name", None)  # Set by `storage_factory`.
+        return storage
+
+    def store(self, bucketcodes, bucketvalues, prefix=""):
         with Timer("  Bucketing"):
-            for attribute, values in bucketvalues.items():
-                prefix = str(attribute.name.ljust(PREFIX_LENGTH) + b":")
-                for key, value in izip(bucketkeys, attribute.dumps(values)):
-                    buckets[prefix + key].append(value)
+            order, unique_codes, bounds = group_by_bucket(bucketcodes)
 
         batch = rocksdb.WriteBatch()
         with Timer("  Batching"):
-            for key, value in buckets.items():
-                batch.merge(key, b"".join(value))
+            for attribute, values in bucketvalues.items():
+                keys = encode_bucketkeys(unique_codes, str(attribute.name.ljust(PREFIX_LENGTH) + b":" + prefix))
+                for key, value in izip(keys, attribute.dumps_buckets(values[order], bounds)):
+                    batch.merge(key, value)
 
         with Timer("  Writing"):
             self.db.write(batch, sync=True)
 
-        return len(bucketkeys)
+        return len(bucketcodes)
 
-    def retrieve(self, bucketkeys, attribute):
-        prefix = str(attribute.name.ljust(PREFIX_LENGTH) + b":")
-        keys = [prefix + bucketkey for bucketkey in bucketkeys]
+    def retrieve(self, bucketkeys, attribute, prefix=""):
+        keys = encode_bucketkeys(bucketkeys, str(attribute.name.ljust(PREFIX_LENGTH) + b":" + prefix))
 
         #with Timer("  Retrieving"):
         results = self.db.multi_get(keys)
         return [attribute.loads(results[key]) for key in keys]
 
-    def remove(self, bucketkeys):
+    def retrieve_rows(self, bucketkeys, attribute, rows, prefix=""):
+        if not hasattr(attribute, "dtype"):
+            return super(RocksDBStorage, self).retrieve_rows(bucketkeys, attribute, rows, prefix)
+
+        # Elements have a fixed size, only the ones needed are deserialized.
+        nbytes = int(np.prod(attribute.shape)) * attribute.dtype.itemsize
+        keys = encode_bucketkeys(bucketkeys, str(attribute.name.ljust(PREFIX_LENGTH) + b":" + prefix))
+        results = self.db.multi_get(keys)
+
+        buckets = []
+        for key, bucket_rows in izip(keys, rows):
+            value = results[key] or b""
+            buckets.append(attribute.loads(b"".join(value[row*nbytes:(row+1)*nbytes] for row in bucket_rows)))
+
+        return buckets
+
+    def _attribute_prefixes(self):
+        """ Returns the key prefixes of the stored attributes (i.e. padded name followed by ":"). """
+        prefixes = []
+        keys = self.db.iterkeys()
+        keys.seek_to_first()
+        key = next(keys, None)
+        while key is not None:
+            prefixes.append(key[:PREFIX_LENGTH+1])
+            keys.seek(prefixes[-1][:-1] + b";")  # First key of the next attribute.
+            key = next(keys, None)
+
+        return prefixes
+
+    def remove(self, bucketkeys, prefix=""):
         """
         Parameters
         ----------
-        bucket_keys: iterable of string
-            keys of the buckets to delete
+        bucketkeys: ndarray of uint64 or iterable of string
+            codes of the buckets to delete (every attributes), or keys
+            of a single attribute (see `bucketkeys_all_attributes`)
         prefix: string
-            if set, clear every buckets having this prefix
+            prefix of the codes (i.e. namespace)
 
         Return
         ------
         count: int
-            number of buckets cleared
+            number of buckets removed
         """
-        if (not isinstance(bucketkeys, types.ListType) and not isinstance(bucketkeys, types.GeneratorType)
-                and not hasattr(bucketkeys, "__iter__")):
-            bucketkeys = [bucketkeys]
+        if isinstance(bucketkeys, np.ndarray) and bucketkeys.dtype.kind in "ui":
+            # Keys of every attribute of each bucket.
+            keys = [encode_bucketkeys(bucketkeys, attribute_prefix + prefix)
+                    for attribute_prefix in self._attribute_prefixes()]
+            groups = izip(*keys) if len(keys) > 0 else []
+        else:
+            if (not isinstance(bucketkeys, types.ListType) and not isinstance(bucketkeys, types.GeneratorType)
+                    and not hasattr(bucketkeys, "__iter__")):
+                bucketkeys = [bucketkeys]
+
+            groups = ([bucketkey] for bucketkey in bucketkeys)
 
         count = 0
         batch = rocksdb.WriteBatch()
         with Timer("  Batching"):
-            for bucketkey in bucketkeys:
-                if self.db.key_may_exist(bucketkey)[0]:
-                    batch.delete(bucketkey)
-                    count += 1
+            for bucket_keys in groups:
+                found = False
+                for key in bucket_keys:
+                    if self.db.key_may_exist(key)[0]:
+                        batch.delete(key)
+                        found = True
+
+                count += found
 
         with Timer("  Writing"):
             self.db.write(batch, sync=True)
-            self.db.compact_range()
 
         return count
 
-    def count(self, bucketkeys=None):
+    def count(self, bucketkeys=None, prefix="", attribute=None):
         """
         Parameters
         ----------
-        bucketkeys: iterable of string
-            keys of buckets to count
+        bucketkeys: ndarray of uint64 or iterable of string
+            codes or keys of buckets to count (default: every buckets)
+        prefix: string
+            prefix of the keys (i.e. namespace)
+        attribute: NumpyData, optional
+            attribute whose elements are counted (default: "label", one byte each)
 
         Return
         ------
         counts: list of int
             size of each given bucket
         """
-        prefix = str("label".ljust(PREFIX_LENGTH) + b":")
+        name, nbytes = "label", 1  # We suppose each label fits in a byte.
+        if attribute is not None:
+            name, nbytes = attribute.name, int(np.prod(attribute.shape)) * attribute.dtype.itemsize
+
+        prefix = str(name.ljust(PREFIX_LENGTH) + b":" + prefix)
         counts = []
 
         items = self.db.iteritems()
@@ -138,13 +195,12 @@ class RocksDBStorage(Storage):
 
         if bucketkeys is None:  # Count every buckets
             for k, v in items:
-                counts.append(len(v))  # We suppose each label fits in a byte.
+                counts.append(len(v) // nbytes)
         else:
-            keys = [prefix + bucketkey for bucketkey in bucketkeys]
+            keys = encode_bucketkeys(bucketkeys, prefix)
             results = self.db.multi_get(keys)
             for key in keys:
-                # We suppose each label fits in a byte.
-                count = len(results[key]) if results[key] is not None else 0
+                count = len(results[key]) // nbytes if results[key] is not None else 0
                 counts.append(count)
 
         return counts
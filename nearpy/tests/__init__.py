@@ -21,12 +21,15 @@
 # THE SOFTWARE.
 from __future__ import absolute_import
 
-from nearpy.tests.hashes_tests import TestRandomBinaryProjections, \
-    TestRandomDiscretizedProjections, TestPCABinaryProjections, TestPCADiscretizedProjections
-from nearpy.tests.engine_tests import TestEngine
-from nearpy.tests.storage_tests import TestStorage
-from nearpy.tests.distances_tests import TestEuclideanDistance, TestCosineDistance, TestManhattanDistance
-from nearpy.tests.filters_tests import TestVectorFilters
+from nearpy.tests.hashes_tests import TestRandomBinaryProjections, TestRandomDiscretizedProjections, \
+    TestPCABinaryProjections, TestPCADiscretizedProjections, TestPCAHashing, TestSpectralHashing
+from nearpy.tests.engine_tests import TestEngine, TestMultiTableEngine, TestMultiProbe
+from nearpy.tests.storage_tests import TestStorage, TestBucketKeys, TestColumnarStorage, TestMMapStorage, TestFileStorage, TestCachedStorage
+from nearpy.tests.distances_tests import TestEuclideanDistance, TestCosineDistance, TestManhattanDistance, \
+    TestPairwiseDistances, TestHammingDistance, TestPQDistance, \
+    TestQuantizedDistances, TestBackend
+from nearpy.tests.data_tests import TestDataCodecs
+from nearpy.tests.filters_tests import TestVectorFilters, TestBatchVectorFilters
 from nearpy.tests.experiments_tests import TestRecallExperiment
 from nearpy.tests.hash_storage_tests import TestHashStorage
 from nearpy.tests.projection_trees_tests import TestRandomBinaryProjectionTree
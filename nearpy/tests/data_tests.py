@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 Ole Krause-Sparmann
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import numpy
+import shutil
+import tempfile
+import unittest
+
+from nearpy.data import Data, StringData, StructData, object_array, pack_record, unpack_record
+from nearpy.storage import storage_factory
+
+
+class TestDataCodecs(unittest.TestCase):
+
+    def setUp(self):
+        self.codes = numpy.array([3, 0, 3, 3, 0], dtype=numpy.uint64)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _round_trip(self, attribute, values):
+        storages = [storage_factory("memory"), storage_factory("columnar"),
+                    storage_factory("file", dir=tempfile.mkdtemp(dir=self.dir))]
+
+        for storage in storages:
+            storage.store(self.codes, {attribute: values})
+            buckets = storage.retrieve(numpy.array([3, 0, 1], dtype=numpy.uint64), attribute)
+            self.assertEqual(list(buckets[0]), [values[0], values[2], values[3]])
+            self.assertEqual(list(buckets[1]), [values[1], values[4]])
+            self.assertEqual(len(buckets[2]), 0)
+
+    def test_records(self):
+        scalars = [None, True, -2**40, 1.5, "bytes", u"unicode \xe9"]
+        for value in scalars + [scalars, tuple(scalars), {"key": scalars, 3: None}]:
+            self.assertEqual(unpack_record(pack_record(value)), (value, len(pack_record(value))))
+
+        array = numpy.arange(6, dtype=numpy.float32).reshape((2, 3))
+        decoded, _ = unpack_record(pack_record({"array": array}))
+        numpy.testing.assert_array_equal(decoded["array"], array)
+
+        self._round_trip(Data("record"), object_array([{"id": 1}, [2, "b"], None, u"\xe9", (4.5,)]))
+
+        # Buckets of Python literals written by older versions are still loaded.
+        self.assertEqual(list(Data("record").loads("[{'id': 1}, 'b']")), [{"id": 1}, "b"])
+        self.assertRaises(ValueError, Data("record").loads, "".join(Data("record").dumps([1])) + "[2]")
+
+        # Records appended to such a bucket are loaded after its values.
+        bucket = "[{'id': 1}, '\\x01']" + "".join(Data("record").dumps([2, "\x01"]))
+        self.assertEqual(list(Data("record").loads(bucket)), [{"id": 1}, "\x01", 2, "\x01"])
+
+    def test_strings(self):
+        self._round_trip(StringData("name"), object_array(["a", "", "ccc" * 100, "\x00\x01", "e"]))
+        self._round_trip(StringData("name", "utf-8"), object_array([u"\xe9", u"", u"c", u"d", u"€"]))
+
+        # A bucket is made of blocks of strings, appended one after the other.
+        attribute = StringData("name")
+        blocks = attribute.dumps_buckets(["a", "bb", "", "ccc"], [0, 3, 4]) + attribute.dumps(["d"])
+        self.assertEqual(list(attribute.loads("".join(blocks))), ["a", "bb", "", "ccc", "d"])
+
+    def test_structs(self):
+        attribute = StructData("info", [("x", "int32"), ("label", "S4")])
+        values = numpy.array([(1, "a"), (2, "bb"), (3, "ccc"), (4, ""), (5, "e")], dtype=attribute.dtype)
+        self._round_trip(attribute, values)
+
+        bucket = attribute.loads("".join(attribute.dumps([(7, "g"), (8, "h")])))
+        self.assertEqual(list(bucket["x"]), [7, 8])
+        self.assertEqual(list(bucket["label"]), ["g", "h"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -21,10 +21,14 @@
 # THE SOFTWARE.
 
 import numpy
-import scipy
+import scipy.sparse
 import unittest
 
-from nearpy.distances import EuclideanDistance, CosineDistance, ManhattanDistance
+from nearpy.distances import EuclideanDistance, CosineDistance, ManhattanDistance, \
+    CorrelationDistance, HammingDistance, PQDistance
+from nearpy.data import NumpyData, PQData, QuantizedData
+from nearpy.storage import storage_factory
+from nearpy.utils import pack_bits, popcount, chunk, set_backend, get_backend
 
 ########################################################################
 
@@ -33,21 +37,26 @@ from nearpy.distances import EuclideanDistance, CosineDistance, ManhattanDistanc
 def equal_with_tolerance(x, y, tolerance):
     return x > (y-tolerance) and x < (y+tolerance)
 
+def distance_of(distance, x, y):
+    """ Distance between two vectors, `y` being a bucket of one patch. """
+    return distance(x, y[None])[0]
+
 def test_distance_symmetry(test_obj, distance):
     for k in range(100):
         x = numpy.random.randn(10)
         y = numpy.random.randn(10)
-        d_xy = distance.distance(x, y)
-        d_yx = distance.distance(y, x)
+        d_xy = distance_of(distance, x, y)
+        d_yx = distance_of(distance, y, x)
 
         # I had precision issues with a local install. This test is more tolerant to that.
         test_obj.assertTrue(equal_with_tolerance(d_xy, d_yx, 0.00000000000001))
 
+    # Sparse vectors are stored as dense patches.
     for k in range(100):
-        x = scipy.sparse.rand(30, 1, density=0.3)
-        y = scipy.sparse.rand(30, 1, density=0.3)
-        d_xy = distance.distance(x, y)
-        d_yx = distance.distance(y, x)
+        x = scipy.sparse.rand(1, 30, density=0.3).toarray()[0]
+        y = scipy.sparse.rand(1, 30, density=0.3).toarray()[0]
+        d_xy = distance_of(distance, x, y)
+        d_yx = distance_of(distance, y, x)
 
         # I had precision issues with a local install. This test is more tolerant to that.
         test_obj.assertTrue(equal_with_tolerance(d_xy, d_yx, 0.00000000000001))
@@ -58,20 +67,20 @@ def test_distance_triangle_inequality(test_obj, distance):
         y = numpy.random.randn(10)
         z = numpy.random.randn(10)
 
-        d_xy = distance.distance(x, y)
-        d_xz = distance.distance(x, z)
-        d_yz = distance.distance(y, z)
+        d_xy = distance_of(distance, x, y)
+        d_xz = distance_of(distance, x, z)
+        d_yz = distance_of(distance, y, z)
 
         test_obj.assertTrue(d_xy <= d_xz + d_yz)
 
     for k in range(100):
-        x = scipy.sparse.rand(30, 1, density=0.3)
-        y = scipy.sparse.rand(30, 1, density=0.3)
-        z = scipy.sparse.rand(30, 1, density=0.3)
+        x = scipy.sparse.rand(1, 30, density=0.3).toarray()[0]
+        y = scipy.sparse.rand(1, 30, density=0.3).toarray()[0]
+        z = scipy.sparse.rand(1, 30, density=0.3).toarray()[0]
 
-        d_xy = distance.distance(x, y)
-        d_xz = distance.distance(x, z)
-        d_yz = distance.distance(y, z)
+        d_xy = distance_of(distance, x, y)
+        d_xz = distance_of(distance, x, z)
+        d_yz = distance_of(distance, y, z)
 
         test_obj.assertTrue(d_xy <= d_xz + d_yz)
 
@@ -81,7 +90,7 @@ def test_distance_triangle_inequality(test_obj, distance):
 class TestEuclideanDistance(unittest.TestCase):
 
     def setUp(self):
-        self.euclidean = EuclideanDistance()
+        self.euclidean = EuclideanDistance(NumpyData("patch", numpy.dtype("float64"), (10,)))
 
     def test_triangle_inequality(self):
         test_distance_triangle_inequality(self, self.euclidean)
@@ -92,15 +101,19 @@ class TestEuclideanDistance(unittest.TestCase):
 class TestCosineDistance(unittest.TestCase):
 
     def setUp(self):
-        self.cosine = CosineDistance()
+        self.cosine = CosineDistance(NumpyData("patch", numpy.dtype("float64"), (10,)))
 
     def test_symmetry(self):
         test_distance_symmetry(self, self.cosine)
 
+    def test_values(self):
+        patches = numpy.array([[1.0, 0.0], [0.0, 2.0], [-3.0, 0.0]])
+        numpy.testing.assert_allclose(self.cosine(numpy.array([2.0, 0.0]), patches), [0.0, 1.0, 2.0])
+
 class TestManhattanDistance(unittest.TestCase):
 
     def setUp(self):
-        self.manhattan = ManhattanDistance()
+        self.manhattan = ManhattanDistance(NumpyData("patch", numpy.dtype("float64"), (10,)))
 
     def test_triangle_inequality(self):
         test_distance_triangle_inequality(self, self.manhattan)
@@ -108,5 +121,173 @@ class TestManhattanDistance(unittest.TestCase):
     def test_symmetry(self):
         test_distance_symmetry(self, self.manhattan)
 
+    def test_values(self):
+        queries = numpy.random.randn(5, 10)
+        patches = numpy.random.randn(20, 10)
+        expected = numpy.abs(queries[:, None] - patches[None]).sum(axis=2)
+        numpy.testing.assert_allclose(self.manhattan.pairwise(queries, patches), expected)
+
+class TestPairwiseDistances(unittest.TestCase):
+
+    def setUp(self):
+        self.queries = numpy.random.randn(20, 3, 3).astype("float32")
+        self.patches = numpy.random.randn(100, 3, 3).astype("float32")
+
+    def _test_pairwise(self, distance):
+        distances = distance.pairwise(self.queries, self.patches)
+        self.assertEqual(distances.shape, (len(self.queries), len(self.patches)))
+        for query, row in zip(self.queries, distances):
+            self.assertTrue(numpy.allclose(row, distance(query, self.patches), atol=1e-5))
+
+    def test_euclidean(self):
+        self._test_pairwise(EuclideanDistance(None))
+        expected = numpy.sqrt(numpy.mean((self.queries[:, None] - self.patches[None]) ** 2, axis=(2, 3)))
+        self.assertTrue(numpy.allclose(EuclideanDistance(None).pairwise(self.queries, self.patches), expected,
+                                       atol=1e-5))
+        distances = EuclideanDistance(None).pairwise(self.patches, self.patches)
+        numpy.testing.assert_array_equal(numpy.diag(distances), 0)
+        numpy.testing.assert_array_equal(EuclideanDistance(None).pairwise(self.patches + 100, self.patches + 100)
+                                         .diagonal(), 0)
+
+    def test_correlation(self):
+        self._test_pairwise(CorrelationDistance(None))
+        queries = self.queries.reshape((len(self.queries), -1))
+        patches = self.patches.reshape((len(self.patches), -1))
+        expected = numpy.corrcoef(queries, patches)[:len(queries), len(queries):]
+        self.assertTrue(numpy.allclose(CorrelationDistance(None).pairwise(self.queries, self.patches), expected,
+                                       atol=1e-5))
+
+class TestBackend(unittest.TestCase):
+
+    def setUp(self):
+        # Enough patches for several blocks.
+        self.queries = numpy.random.randn(20, 9).astype("float32")
+        self.patches = numpy.random.randn(10000, 9).astype("float32")
+        self.expected = EuclideanDistance(None).pairwise(self.queries, self.patches)
+
+    def tearDown(self):
+        set_backend("numpy")
+
+    def _test_backend(self, name):
+        try:
+            backend = set_backend(name, nb_threads=2)
+        except ImportError:
+            self.skipTest("{} isn't installed".format(name))
+
+        self.assertIs(get_backend(), backend)
+        self.assertEqual(str(backend), "{} (2 threads)".format(name))
+        distances = EuclideanDistance(None).pairwise(self.queries, self.patches)
+        self.assertTrue(numpy.allclose(distances, self.expected, atol=1e-6))
+
+        # Kernels give the same results as NumPy (`sq_distances` writes over the dot products).
+        x = numpy.random.randn(50).astype("float32")
+        omegas = numpy.random.rand(3).astype("float32")
+        phases = numpy.random.rand(3).astype("float32")
+        self.assertTrue(numpy.allclose(backend.cos(x, omegas, phases), numpy.cos(x[:, None] * omegas - phases),
+                                       atol=1e-6))
+
+        X = numpy.random.randn(50, 9)
+        sq_norms = backend.sq_norms(X)
+        self.assertTrue(numpy.allclose(sq_norms, numpy.sum(X**2, axis=1)))
+
+        dots = numpy.dot(X[:5], X.T)
+        sq_distances = backend.sq_distances(dots, sq_norms[:5], sq_norms)
+        self.assertTrue(numpy.allclose(sq_distances, numpy.sum((X[:5, None] - X[None])**2, axis=2)))
+
+    def test_numpy(self):
+        self.assertEqual(str(get_backend()), "numpy (1 thread)")
+        self._test_backend("numpy")
+
+    def test_numexpr(self):
+        self._test_backend("numexpr")
+
+    def test_numba(self):
+        self._test_backend("numba")
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, set_backend, "theano")
+
+class TestHammingDistance(unittest.TestCase):
+
+    def setUp(self):
+        self.queries = numpy.random.rand(20, 150) > 0.5
+        self.bits = numpy.random.rand(100, 150) > 0.5
+
+    def test_pack_bits(self):
+        codes = pack_bits(self.bits)
+        self.assertEqual(codes.shape, (100, 3))
+        self.assertEqual(codes.dtype, numpy.uint64)
+
+        # The first word is the same integer as the one of `bits_to_int`.
+        bits_to_int = numpy.array([numpy.uint(2**i) for i in range(64)])
+        self.assertTrue(numpy.all(codes[:, 0] == numpy.dot(self.bits[:, :64], bits_to_int)))
+        self.assertTrue(numpy.all(popcount(codes).sum(axis=1) == self.bits.sum(axis=1)))
+
+    def test_pairwise(self):
+        distance = HammingDistance(None)
+        distances = distance.pairwise(pack_bits(self.queries), pack_bits(self.bits))
+        expected = (self.queries[:, None, :] != self.bits[None, :, :]).sum(axis=2)
+        self.assertTrue(numpy.all(distances == expected))
+        self.assertTrue(numpy.all(distance(pack_bits(self.queries)[0], pack_bits(self.bits)) == expected[0]))
+
+class TestPQDistance(unittest.TestCase):
+
+    def setUp(self):
+        self.V = numpy.random.randn(1000, 16).astype("float32")
+        self.queries = numpy.random.randn(20, 16).astype("float32")
+        self.pq = PQData("pq", 16, 4, lambda: chunk(self.V, 100), nb_centroids=32, rand_seed=0)
+
+    def test_encode(self):
+        codes = self.pq.encode(self.V)
+        self.assertEqual(codes.shape, (len(self.V), 4))
+        self.assertEqual(codes.dtype, numpy.uint8)
+        self.assertTrue(numpy.all(self.pq.encode(self.pq.decode(codes)) == codes))
+
+        # Vectors are approximated better than by their mean.
+        error = numpy.mean((self.pq.decode(codes) - self.V)**2)
+        self.assertTrue(error < 0.75 * numpy.mean((self.V - self.V.mean(axis=0))**2))
+
+    def test_pairwise(self):
+        codes = self.pq.encode(self.V)
+        distances = PQDistance(self.pq).pairwise(self.queries, codes)
+        expected = EuclideanDistance(None).pairwise(self.queries, self.pq.decode(codes))
+        self.assertTrue(numpy.allclose(distances, expected, atol=1e-4))
+        self.assertTrue(numpy.allclose(PQDistance(self.pq)(self.queries[0], codes), expected[0], atol=1e-4))
+
+class TestQuantizedDistances(unittest.TestCase):
+
+    def setUp(self):
+        # More patches than the distances convert at once.
+        self.patches = numpy.random.randn(5000, 3, 3).astype("float32")
+        self.queries = numpy.random.randn(20, 3, 3).astype("float32")
+
+    def _test_quantized(self, quantized):
+        codes = quantized.encode(self.patches)
+        self.assertEqual(codes.dtype, quantized.dtype)
+        self.assertTrue(numpy.allclose(quantized.decode(codes), self.patches, atol=0.05))
+
+        # Codes are scored as the vectors they approximate.
+        for distance_class in [EuclideanDistance, CorrelationDistance]:
+            distances = distance_class(quantized).pairwise(self.queries, codes)
+            expected = distance_class(None).pairwise(self.queries, quantized.decode(codes))
+            self.assertTrue(numpy.allclose(distances, expected, atol=1e-4))
+            self.assertTrue(numpy.allclose(distance_class(quantized)(self.queries[0], codes), expected[0], atol=1e-4))
+
+    def test_float16(self):
+        self._test_quantized(QuantizedData("patch", (3, 3), "float16"))
+
+    def test_int8(self):
+        quantized = QuantizedData("patch", (3, 3), "int8")
+        self.assertRaises(ValueError, quantized.encode, self.patches)
+        quantized.fit(lambda: chunk(self.patches, 1000))
+        self._test_quantized(quantized)
+
+        # Scale and offset are kept by the storage.
+        storage = storage_factory("memory")
+        quantized.save_info(storage)
+        loaded = QuantizedData("patch", (3, 3), "int8")
+        loaded.load_info(storage)
+        self.assertTrue(numpy.all(loaded.encode(self.patches) == quantized.encode(self.patches)))
+
 if __name__ == '__main__':
     unittest.main()
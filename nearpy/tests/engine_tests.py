@@ -23,42 +23,330 @@
 import numpy
 import scipy
 import unittest
+from itertools import islice
 
 from nearpy import Engine
+from nearpy.engine import probe_sequence
+from nearpy.data import Data, NumpyData, object_array
+from nearpy.filters import NearestFilter, DistanceThresholdFilter, SortedFilter
+from nearpy.storage import storage_factory
+from nearpy.storage.storage import Storage
+from nearpy.distances import EuclideanDistance, HammingDistance
+from nearpy.hashes import RandomDiscretizedProjections
+from nearpy.utils import pack_bits, set_backend
+
+
+class SignHashing(object):
+    """ Uses the signs of some of the vector's dimensions as hash code. """
+
+    def __init__(self, name, dimensions):
+        self.name = name
+        self.dimensions = dimensions
+        self.nbits = len(dimensions)
+        self.bits_to_int = numpy.array([numpy.uint(2**i) for i in range(min(self.nbits, 64))])
+
+    def project(self, V):
+        return V[:, self.dimensions]
+
+    def hash_vector(self, V):
+        return numpy.dot(self.project(V) > 0, self.bits_to_int).view("|S8")
+
+    def codes(self, V):
+        return pack_bits(self.project(V) > 0)
 
 
 class TestEngine(unittest.TestCase):
 
     def setUp(self):
-        self.engine = Engine(1000)
+        self.patch = NumpyData("patch", numpy.dtype("float32"), (1000,))
+        self.data = Data("data")
+        self.engine = Engine([RandomDiscretizedProjections('rdp', 1000, 4, 10.0, rand_seed=1)],
+                             distance=EuclideanDistance(self.patch), filters=[NearestFilter(1)],
+                             storage=storage_factory("memory"))
+
+    def test_lshashes(self):
+        self.assertRaises(TypeError, Engine, 1000)
 
     def test_retrieval(self):
         for k in range(100):
             self.engine.clean_all_buckets()
-            x = numpy.random.randn(1000)
-            x_data = 'data'
-            self.engine.store_vector(x, x_data)
-            n = self.engine.neighbours(x)
-            y = n[0][0]
-            y_data = n[0][1]
-            y_distance = n[0][2]
-            self.assertTrue((y == x).all())
-            self.assertEqual(y_data, x_data)
-            self.assertEqual(y_distance, 0.0)
+            x = numpy.random.randn(1, 1000).astype("float32")
+            self.engine.store_batch(x, {self.patch: x, self.data: object_array(['data'])})
+            n = dict(self.engine.neighbors_batch(x, x, self.data))[0]
+            self.assertTrue((n['patch'][0] == x[0]).all())
+            self.assertEqual(n['data'][0], 'data')
+            self.assertEqual(n['dist'][0], 0.0)
 
     def test_retrieval_sparse(self):
         for k in range(100):
             self.engine.clean_all_buckets()
-            x = scipy.sparse.rand(1000, 1, density=0.05)
-            x_data = 'data'
-            self.engine.store_vector(x, x_data)
-            n = self.engine.neighbours(x)
-            y = n[0][0]
-            y_data = n[0][1]
-            y_distance = n[0][2]
-            self.assertTrue((y - x).sum() == 0.0)
-            self.assertEqual(y_data, x_data)
-            self.assertEqual(y_distance, 0.0)
+            x = scipy.sparse.rand(1, 1000, density=0.05, format="csr")
+            patches = x.toarray().astype("float32")
+            self.engine.store_batch(x, {self.patch: patches, self.data: object_array(['data'])})
+            n = dict(self.engine.neighbors_batch(x, patches, self.data))[0]
+            self.assertTrue((n['patch'][0] == patches[0]).all())
+            self.assertEqual(n['data'][0], 'data')
+            self.assertEqual(n['dist'][0], 0.0)
+
+
+class TestMultiTableEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.patch = NumpyData("patch", numpy.dtype("float32"), (10,))
+        self.id = NumpyData("id", numpy.dtype("int64"), ())
+
+        self.V = numpy.random.randn(500, 10).astype("float32")
+        self.data = {self.patch: self.V,
+                     self.id: numpy.arange(len(self.V))}
+
+    def _engine(self, lshashes, K):
+        storage = storage_factory("memory", keyprefix="test")
+        return Engine(lshashes, distance=EuclideanDistance(self.patch),
+                      filters=[NearestFilter(K)], storage=storage, id_attribute=self.id)
+
+    def test_retrieval(self):
+        engine = self._engine([SignHashing('h1', [0, 1, 2, 3]), SignHashing('h2', [4, 5, 6, 7])], 1)
+        engine.store_batch(self.V, self.data)
+
+        for patch_id, neighbors in engine.neighbors_batch(self.V, self.V, self.id):
+            self.assertEqual(neighbors['id'][0], patch_id)
+            self.assertEqual(neighbors['dist'][0], 0.0)
+
+    def test_candidates_are_unique(self):
+        # Both tables share the same buckets, every candidate is retrieved twice.
+        engine = self._engine([SignHashing('h1', [0]), SignHashing('h2', [0])], len(self.V))
+        engine.store_batch(self.V, self.data)
+
+        self.assertEqual(engine.candidate_count_batch(self.V[:1])[0],
+                         2 * numpy.sum((self.V[:, 0] > 0) == (self.V[0, 0] > 0)))
+
+        # Buckets are too small for K, so every bucket is probed (i.e. every vector is a candidate).
+        for patch_id, neighbors in engine.neighbors_batch(self.V[:10], self.V[:10], self.id):
+            self.assertEqual(len(neighbors['id']), len(self.V))
+            self.assertEqual(len(numpy.unique(neighbors['id'])), len(self.V))
+
+    def test_fetch_window(self):
+        engine = self._engine([SignHashing('h1', [0, 1, 2, 3]), SignHashing('h2', [4, 5, 6, 7])], 5)
+        engine.store_batch(self.V, self.data)
+        expected = dict(engine.neighbors_batch(self.V, self.V, self.id))
+
+        # Buckets are now fetched by windows of 3 groups, in background.
+        engine.fetch_window = 3
+        for fetch_workers in [1, 4]:
+            engine.fetch_workers = fetch_workers
+            results = list(engine.neighbors_batch(self.V, self.V, self.id))
+            self.assertEqual(len(results), len(self.V))
+            self.assertEqual(len(dict(results)), len(self.V))
+            for patch_id, neighbors in results:
+                self.assertTrue(numpy.all(neighbors['id'] == expected[patch_id]['id']))
+
+    def test_neighbors_parallel(self):
+        engine = self._engine([SignHashing('h1', [0, 1, 2, 3]), SignHashing('h2', [4, 5, 6, 7])], 5)
+        engine.store_batch(self.V, self.data)
+        expected = dict(engine.neighbors_batch(self.V, self.V, self.id))
+
+        results = dict(engine.neighbors_parallel(self.V, self.V, self.id, n_workers=3))
+        self.assertEqual(sorted(results), range(len(self.V)))
+        for patch_id, neighbors in results.items():
+            self.assertTrue(numpy.all(neighbors['id'] == expected[patch_id]['id']))
+            self.assertTrue(numpy.allclose(neighbors['dist'], expected[patch_id]['dist']))
+
+    def test_clean_all_buckets(self):
+        engine = self._engine([SignHashing('h1', [0, 1, 2, 3]), SignHashing('h2', [4, 5, 6, 7])], 5)
+        engine.store_batch(self.V, self.data)
+
+        self.assertTrue(engine.clean_all_buckets() > 0)
+        self.assertEqual(max(engine.candidate_count_batch(self.V)), 0)
+
+    def test_neighbors_parallel_threads(self):
+        # Buckets of more than `BLOCK_SIZE` patches, so distances are computed by the threads of the backend.
+        V = numpy.random.randn(12000, 10).astype("float32")
+        engine = self._engine([SignHashing('h1', [0])], 5)
+        engine.store_batch(V, {self.patch: V, self.id: numpy.arange(len(V))})
+
+        set_backend("numpy", nb_threads=2)
+        try:
+            # The pool of the backend is created before forking the workers.
+            expected = dict(engine.neighbors_batch(V[:50], V[:50], self.id))
+            results = dict(engine.neighbors_parallel(V[:50], V[:50], self.id, n_workers=2))
+        finally:
+            set_backend("numpy")
+
+        self.assertEqual(len(results), 50)
+        for patch_id, neighbors in results.items():
+            self.assertTrue(numpy.all(neighbors['id'] == expected[patch_id]['id']))
+
+    def test_store_stream(self):
+        engine = self._engine([SignHashing('h1', [0, 1, 2, 3]), SignHashing('h2', [4, 5, 6, 7])], 5)
+        engine.store_batch(self.V, self.data)
+        expected = dict(engine.neighbors_batch(self.V, self.V, self.id))
+
+        # Store the same vectors by chunks of 50, flushing every 4,000 bytes.
+        engine = self._engine(engine.lshashes, 5)
+        chunks = ((self.V[i:i+50], {attribute: values[i:i+50] for attribute, values in self.data.items()})
+                  for i in range(0, len(self.V), 50))
+        self.assertEqual(engine.store_stream(chunks, n_workers=2, buffer_bytes=4000), len(self.V))
+
+        for patch_id, neighbors in engine.neighbors_batch(self.V, self.V, self.id):
+            self.assertEqual(sorted(neighbors['id']), sorted(expected[patch_id]['id']))
+
+    def test_filter_chain(self):
+        engine = self._engine([SignHashing('h1', [0, 1]), SignHashing('h2', [2, 3])], 10)
+        engine.store_batch(self.V, self.data)
+        expected = dict(engine.neighbors_batch(self.V[:50], self.V[:50], self.id))
+
+        # Thresholds and nearest filters commute.
+        threshold = numpy.median([neighbors['dist'][5] for neighbors in expected.values()])
+        for filters in [[DistanceThresholdFilter(threshold), NearestFilter(10)],
+                        [NearestFilter(10), DistanceThresholdFilter(threshold), SortedFilter()],
+                        [NearestFilter(20), NearestFilter(10), DistanceThresholdFilter(threshold)]]:
+            engine.filters = filters
+            for patch_id, neighbors in engine.neighbors_batch(self.V[:50], self.V[:50], self.id):
+                kept = expected[patch_id]['dist'] < threshold
+                self.assertEqual(list(neighbors['id']), list(expected[patch_id]['id'][kept]))
+                self.assertTrue(numpy.allclose(neighbors['dist'], expected[patch_id]['dist'][kept]))
+
+    def test_lazy(self):
+        lshashes = [SignHashing('h1', [0, 1, 2]), SignHashing('h2', [3, 4, 5, 6, 7])]
+        position = NumpyData("position", numpy.dtype("float64"), (2,))
+        data = dict(self.data)
+        data[position] = numpy.random.rand(len(self.V), 2)
+
+        engine = self._engine(lshashes, 10)
+        engine.store_batch(self.V, data)
+        expected = dict(engine.neighbors_batch(self.V, self.V, self.id, position))
+
+        # Positions are only retrieved for the 10 nearest (some of them in probed buckets).
+        for storage in [storage_factory("memory", keyprefix="test"), storage_factory("columnar", keyprefix="test")]:
+            engine = self._engine(lshashes, 10)
+            engine.storage = storage
+            engine.lazy = True
+            engine.store_batch(self.V, data)
+            for patch_id, neighbors in engine.neighbors_batch(self.V, self.V, self.id, position):
+                self.assertEqual(list(neighbors['id']), list(expected[patch_id]['id']))
+                self.assertTrue(numpy.all(neighbors['position'] == data[position][neighbors['id']]))
+
+    def test_prefilter(self):
+        lshashes = [SignHashing('h1', [0, 1]), SignHashing('h2', [2, 3])]
+        engine = self._engine(lshashes, 5)
+        engine.store_batch(self.V, self.data)
+        expected = dict(engine.neighbors_batch(self.V, self.V, self.id))
+
+        # Binary codes of 70 bits (i.e. two words) are stored with the vectors.
+        code_hashing = SignHashing('codes', range(10) * 7)
+        code = NumpyData("code", numpy.dtype("uint64"), (2,))
+        data = dict(self.data)
+        data[code] = code_hashing.codes(self.V)
+
+        engine = self._engine(lshashes, 5)
+        engine.prefilter_distance = HammingDistance(code, code_hashing)
+        engine.store_batch(self.V, data)
+
+        # The shortlist holds every candidate, the result is exact.
+        engine.shortlist = len(self.V)
+        for patch_id, neighbors in engine.neighbors_batch(self.V, self.V, self.id):
+            self.assertEqual(list(neighbors['id']), list(expected[patch_id]['id']))
+
+        # Only the 50 candidates having the closest codes are ranked.
+        engine.shortlist = 50
+        for patch_id, neighbors in engine.neighbors_batch(self.V, self.V, self.id):
+            self.assertEqual(neighbors['id'][0], patch_id)
+            self.assertTrue(numpy.all(neighbors['dist'] >= expected[patch_id]['dist'] - 1e-6))
+
+    def test_needs_id_attribute(self):
+        engine = self._engine([SignHashing('h1', [0]), SignHashing('h2', [1])], 1)
+        engine.id_attribute = None
+        self.assertRaises(ValueError, list, engine.neighbors_batch(self.V, self.V))
+
+
+class TestMultiProbe(unittest.TestCase):
+
+    def setUp(self):
+        self.patch = NumpyData("patch", numpy.dtype("float32"), (10,))
+        self.V = numpy.random.randn(1000, 10).astype("float32")
+        self.data = {self.patch: self.V}
+
+    def test_probe_sequence(self):
+        margins = numpy.array([0.5, 0.1, 2.0, 0.3, 1.2])
+        probes = list(probe_sequence(numpy.uint64(5), margins))
+
+        # Every other bucket is probed exactly once, by increasing score.
+        scores = [score for score, bucketcode in probes]
+        bucketcodes = [int(bucketcode) for score, bucketcode in probes]
+        self.assertEqual(sorted(bucketcodes), [code for code in range(32) if code != 5])
+        self.assertTrue(numpy.all(numpy.diff(scores) >= 0))
+
+        # First probes flip the bits having the smallest margins.
+        self.assertEqual(bucketcodes[:3], [5 ^ 2, 5 ^ 8, 5 ^ 2 ^ 8])
+
+        # Hash codes only keep the first 64 bits, the other ones are never flipped.
+        margins = numpy.linspace(1, 0, 100)
+        probes = list(islice(probe_sequence(numpy.uint64(0), margins), 100))
+        self.assertEqual([int(bucketcode) for score, bucketcode in probes[:2]], [2**63, 2**62])
+        self.assertEqual(len(set(int(bucketcode) for score, bucketcode in probes)), 100)
+        self.assertEqual(Engine([SignHashing('h1', range(100))]).max_probes, 64)
+
+    def test_probing(self):
+        lshash = SignHashing('h1', range(10))
+        storage = storage_factory("memory")
+        engine = Engine([lshash], distance=EuclideanDistance(self.patch),
+                        filters=[NearestFilter(20)], storage=storage, max_probes=2**10)
+        engine.store_batch(self.V, self.data)
+        queries = numpy.random.randn(50, 10).astype("float32")
+
+        # Buckets hold ~1 vector, probing is needed to get 20 neighbors.
+        for patch_id, neighbors in engine.neighbors_batch(queries, queries):
+            self.assertEqual(len(neighbors['patch']), 20)
+
+        # Without probing, only the content of the query's bucket is returned.
+        engine.max_probes = 0
+        counts = engine.candidate_count_batch(queries)
+        for patch_id, neighbors in engine.neighbors_batch(queries, queries):
+            self.assertEqual(len(neighbors['patch']), counts[patch_id])
+
+        # With few probes, not enough candidates are found.
+        engine.max_probes = 2
+        for patch_id, neighbors in engine.neighbors_batch(queries, queries):
+            self.assertTrue(len(neighbors['patch']) < 20)
+
+    def test_adaptive(self):
+        lshash = SignHashing('h1', range(10))
+        for storage in [storage_factory("memory"), storage_factory("columnar")]:
+            engine = Engine([lshash], distance=EuclideanDistance(self.patch), filters=[NearestFilter(1)],
+                            storage=storage, max_probes=0, max_bucket_size=100, min_bits=2)
+            engine.store_batch(self.V[:500], {self.patch: self.V[:500]})
+            engine.store_batch(self.V[500:], {self.patch: self.V[500:]})
+
+            # Big buckets were split, small ones kept their short codes.
+            counts, bucketkeys = engine.buckets_size()
+            self.assertEqual(sum(counts), len(self.V))
+            self.assertTrue(max(counts) <= 100)
+            self.assertTrue(len(bucketkeys) < 2**10)
+            self.assertTrue(max(engine.candidate_count_batch(self.V)) <= 100)
+
+            # Queries go to the deepest bucket, which holds them. The splits are kept by the storage.
+            for engine in [engine, Engine([lshash], distance=EuclideanDistance(self.patch), filters=[NearestFilter(1)],
+                                          storage=storage, max_probes=0, max_bucket_size=100, min_bits=2)]:
+                for patch_id, neighbors in engine.neighbors_batch(self.V, self.V):
+                    self.assertTrue(numpy.all(neighbors['patch'][0] == self.V[patch_id]))
+
+    def test_adaptive_any_attribute(self):
+        # Storages count a given attribute (e.g. "patch"), buckets are split whatever the stored attributes.
+        vector = NumpyData("vector", numpy.dtype("float32"), (10,))
+        for storage in [storage_factory("memory"), storage_factory("columnar")]:
+            engine = Engine([SignHashing('h1', range(10))], distance=EuclideanDistance(vector),
+                            filters=[NearestFilter(1)], storage=storage, max_probes=0, max_bucket_size=100,
+                            min_bits=2)
+            engine.store_batch(self.V, {vector: self.V})
+
+            self.assertTrue(len(engine._splits[0]) > 0)
+            counts = engine.candidate_count_batch(self.V)
+            self.assertTrue(0 < min(counts) and max(counts) <= 100)
+
+    def test_adaptive_needs_remove(self):
+        # Buckets are split by removing them, storages unable to do so are rejected at once.
+        self.assertRaises(ValueError, Engine, [SignHashing('h1', range(10))], storage=Storage(), max_bucket_size=100)
+
 
 if __name__ == '__main__':
     unittest.main()
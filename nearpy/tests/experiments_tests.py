@@ -24,29 +24,33 @@ from __future__ import print_function
 import numpy
 import unittest
 
+from nearpy.data import NumpyData
 from nearpy.experiments import RecallPrecisionExperiment
-from nearpy.hashes import UniBucket, RandomDiscretizedProjections, \
-    RandomBinaryProjections, PCABinaryProjections
-from nearpy.filters import NearestFilter, UniqueFilter
-from nearpy.distances import CosineDistance
+from nearpy.hashes import UniBucket, RandomDiscretizedProjections, LocalitySensitiveHashing
+from nearpy.filters import NearestFilter
+from nearpy.distances import EuclideanDistance
+from nearpy.storage import storage_factory
 
 from nearpy import Engine
 
 
 class TestRecallExperiment(unittest.TestCase):
 
+    def _engine(self, dim, lshash, K):
+        patch = NumpyData("patch", numpy.dtype("float32"), (dim,))
+        return Engine([lshash], distance=EuclideanDistance(patch), filters=[NearestFilter(K)],
+                      storage=storage_factory("memory"))
+
     def test_experiment_with_unibucket_1(self):
         dim = 50
         vector_count = 100
         vectors = numpy.random.randn(dim, vector_count)
-        unibucket = UniBucket('testHash')
-        nearest = NearestFilter(10)
-        engine = Engine(dim, lshashes=[unibucket],
-                        vector_filters=[nearest])
+        engine = self._engine(dim, UniBucket('testHash'), 11)
         exp = RecallPrecisionExperiment(10, vectors)
         result = exp.perform_experiment([engine])
 
         # Both recall and precision must be one in this case
+        # (the engine also returns the query vector, which is ignored).
         self.assertEqual(result[0][0], 1.0)
         self.assertEqual(result[0][1], 1.0)
 
@@ -54,10 +58,7 @@ class TestRecallExperiment(unittest.TestCase):
         dim = 50
         vector_count = 100
         vectors = numpy.random.randn(dim, vector_count)
-        unibucket = UniBucket('testHash')
-        nearest = NearestFilter(10)
-        engine = Engine(dim, lshashes=[unibucket],
-                        vector_filters=[nearest])
+        engine = self._engine(dim, UniBucket('testHash'), 11)
         exp = RecallPrecisionExperiment(5, vectors)
         result = exp.perform_experiment([engine])
 
@@ -71,10 +72,7 @@ class TestRecallExperiment(unittest.TestCase):
         dim = 50
         vector_count = 100
         vectors = numpy.random.randn(dim, vector_count)
-        unibucket = UniBucket('testHash')
-        nearest = NearestFilter(5)
-        engine = Engine(dim, lshashes=[unibucket],
-                        vector_filters=[nearest])
+        engine = self._engine(dim, UniBucket('testHash'), 6)
         exp = RecallPrecisionExperiment(10, vectors)
         result = exp.perform_experiment([engine])
 
@@ -90,10 +88,7 @@ class TestRecallExperiment(unittest.TestCase):
         vectors = []
         for index in range(vector_count):
             vectors.append(numpy.random.randn(dim))
-        unibucket = UniBucket('testHash')
-        nearest = NearestFilter(10)
-        engine = Engine(dim, lshashes=[unibucket],
-                        vector_filters=[nearest])
+        engine = self._engine(dim, UniBucket('testHash'), 11)
         exp = RecallPrecisionExperiment(10, vectors)
         result = exp.perform_experiment([engine])
 
@@ -101,73 +96,22 @@ class TestRecallExperiment(unittest.TestCase):
         self.assertEqual(result[0][0], 1.0)
         self.assertEqual(result[0][1], 1.0)
 
-    def test_experiment_with_list_2(self):
-        dim = 50
-        vector_count = 100
-        vectors = []
-        for index in range(vector_count):
-            vectors.append(numpy.random.randn(dim))
-        unibucket = UniBucket('testHash')
-        nearest = NearestFilter(10)
-        engine = Engine(dim, lshashes=[unibucket],
-                        vector_filters=[nearest])
-        exp = RecallPrecisionExperiment(5, vectors)
-        result = exp.perform_experiment([engine])
-
-        # In this case precision is only 0.5
-        # because the engine returns 10 nearest, but
-        # the experiment only looks for 5 nearest.
-        self.assertEqual(result[0][0], 1.0)
-        self.assertEqual(result[0][1], 0.5)
-
-    def test_experiment_with_list_3(self):
-        dim = 50
-        vector_count = 100
-        vectors = []
-        for index in range(vector_count):
-            vectors.append(numpy.random.randn(dim))
-        unibucket = UniBucket('testHash')
-        nearest = NearestFilter(5)
-        engine = Engine(dim, lshashes=[unibucket],
-                        vector_filters=[nearest])
-        exp = RecallPrecisionExperiment(10, vectors)
-        result = exp.perform_experiment([engine])
-
-        # In this case recall is only 0.5
-        # because the engine returns 5 nearest, but
-        # the experiment looks for 10 nearest.
-        self.assertEqual(result[0][0], 0.5)
-        self.assertEqual(result[0][1], 1.0)
-
     def test_random_discretized_projections(self):
         dim = 4
         vector_count = 5000
         vectors = numpy.random.randn(dim, vector_count)
-
-        # First get recall and precision for one 1-dim random hash
-        rdp = RandomDiscretizedProjections('rdp', 1, 0.01)
-        nearest = NearestFilter(10)
-        engine = Engine(dim, lshashes=[rdp],
-                        vector_filters=[nearest])
         exp = RecallPrecisionExperiment(10, vectors)
-        result = exp.perform_experiment([engine])
 
-        recall1 = result[0][0]
-        precision1 = result[0][1]
-        searchtime1 = result[0][2]
+        # First get recall and precision for one 1-dim random hash
+        engine = self._engine(dim, RandomDiscretizedProjections('rdp', dim, 1, 0.01, rand_seed=1), 11)
+        recall1, precision1, searchtime1 = exp.perform_experiment([engine])[0]
 
         print('\nRecall RDP: %f, Precision RDP: %f, SearchTime RDP: %f\n' % \
             (recall1, precision1, searchtime1))
 
-        # Then get recall and precision for one 4-dim random hash
-        rdp = RandomDiscretizedProjections('rdp', 2, 0.2)
-        engine = Engine(dim, lshashes=[rdp],
-                        vector_filters=[nearest])
-        result = exp.perform_experiment([engine])
-
-        recall2 = result[0][0]
-        precision2 = result[0][1]
-        searchtime2 = result[0][2]
+        # Then get recall and precision for one 2-dim random hash
+        engine = self._engine(dim, RandomDiscretizedProjections('rdp', dim, 2, 0.2, rand_seed=1), 11)
+        recall2, precision2, searchtime2 = exp.perform_experiment([engine])[0]
 
         print('\nRecall RDP: %f, Precision RDP: %f, SearchTime RDP: %f\n' % \
             (recall2, precision2, searchtime2))
@@ -180,21 +124,15 @@ class TestRecallExperiment(unittest.TestCase):
         dim = 4
         vector_count = 5000
         vectors = numpy.random.randn(dim, vector_count)
-
-        # First get recall and precision for one 1-dim random hash
-        rbp = RandomBinaryProjections('rbp', 32)
-        nearest = NearestFilter(10)
-        engine = Engine(dim, lshashes=[rbp],
-                        vector_filters=[nearest])
         exp = RecallPrecisionExperiment(10, vectors)
-        result = exp.perform_experiment([engine])
 
-        recall1 = result[0][0]
-        precision1 = result[0][1]
-        searchtime1 = result[0][2]
+        engine = self._engine(dim, LocalitySensitiveHashing('rbp', dim, 32, rand_seed=1), 11)
+        recall, precision, searchtime = exp.perform_experiment([engine])[0]
 
         print('\nRecall RBP: %f, Precision RBP: %f, SearchTime RBP: %f\n' % \
-            (recall1, precision1, searchtime1))
+            (recall, precision, searchtime))
+
+        self.assertTrue(0.0 < recall <= 1.0)
 
 if __name__ == '__main__':
     unittest.main()
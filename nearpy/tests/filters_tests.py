@@ -23,7 +23,7 @@
 import numpy
 import unittest
 
-from nearpy.filters import NearestFilter, DistanceThresholdFilter, UniqueFilter
+from nearpy.filters import NearestFilter, DistanceThresholdFilter, UniqueFilter, SortedFilter, TopK, FilterChain
 
 
 class TestVectorFilters(unittest.TestCase):
@@ -43,15 +43,18 @@ class TestVectorFilters(unittest.TestCase):
         self.nearest_filter = NearestFilter(5)
         self.unique = UniqueFilter()
 
+        # Filters select candidates from their distances.
+        self.distances = numpy.array([distance for _, _, distance in self.V])
+
     def test_thresholding(self):
-        result = self.threshold_filter.filter_vectors(self.V)
+        result = [self.V[i] for i in self.threshold_filter(self.distances)]
         self.assertEqual(len(result), 3)
         self.assertTrue(self.V[0] in result)
         self.assertTrue(self.V[1] in result)
         self.assertTrue(self.V[4] in result)
 
     def test_nearest(self):
-        result = self.nearest_filter.filter_vectors(self.V)
+        result = [self.V[i] for i in self.nearest_filter(self.distances)]
         self.assertEqual(len(result), 5)
         self.assertTrue(self.V[0] in result)
         self.assertTrue(self.V[1] in result)
@@ -70,5 +73,72 @@ class TestVectorFilters(unittest.TestCase):
         self.assertEqual(len(result), 8)
 
 
+class TestBatchVectorFilters(unittest.TestCase):
+
+    def setUp(self):
+        self.distances = numpy.random.rand(10, 50)
+
+    def test_nearest(self):
+        for K in [1, 5, 50, 100]:
+            nearest_filter = NearestFilter(K)
+            indices = nearest_filter.filter_batch(self.distances)
+            for row, indices_to_keep in zip(self.distances, indices):
+                self.assertTrue(numpy.all(indices_to_keep == nearest_filter(row)))
+                self.assertTrue(numpy.all(indices_to_keep == numpy.argsort(row)[:K]))
+
+    def test_sorted(self):
+        indices = SortedFilter().filter_batch(self.distances)
+        for row, indices_to_keep in zip(self.distances, indices):
+            self.assertTrue(numpy.all(indices_to_keep == numpy.argsort(row)))
+
+    def test_topk(self):
+        # Candidates come by parts, some of them many times (same key).
+        keys = numpy.random.randint(0, 30, size=self.distances.shape[1])
+        distances = self.distances.copy()
+        for i in range(len(distances)):
+            for key in numpy.unique(keys):
+                distances[i, keys == key] = distances[i, keys == key][0]
+
+        for K in [1, 5, 50]:
+            topk = TopK(K, len(distances))
+            for part in numpy.array_split(numpy.arange(distances.shape[1]), 7):
+                topk.push(distances[:, part], keys[part])
+
+            topk_distances, indices = topk.result()
+            for row, row_distances, row_indices in zip(distances, topk_distances, indices):
+                _, first = numpy.unique(keys, return_index=True)
+                expected = numpy.sort(row[first])[:K]
+                row_indices = row_indices[row_indices >= 0]
+                self.assertTrue(numpy.allclose(row[row_indices], expected))
+                self.assertTrue(numpy.allclose(row_distances[:len(expected)], expected))
+                self.assertEqual(len(numpy.unique(keys[row_indices])), len(row_indices))
+
+    def test_thresholding(self):
+        threshold_filter = DistanceThresholdFilter(0.5)
+        indices = threshold_filter.filter_batch(self.distances)
+        for row, indices_to_keep in zip(self.distances, indices):
+            self.assertTrue(numpy.all(row[indices_to_keep] < 0.5))
+            self.assertEqual(len(indices_to_keep), numpy.sum(row < 0.5))
+
+    def test_filter_chain(self):
+        chains = [[],
+                  [DistanceThresholdFilter(0.5)],
+                  [SortedFilter(), DistanceThresholdFilter(0.5)],
+                  [DistanceThresholdFilter(0.5), NearestFilter(5)],
+                  [NearestFilter(20), DistanceThresholdFilter(0.3), NearestFilter(10)]]
+        for filters in chains:
+            chain = FilterChain(filters)
+            self.assertTrue(chain.fused)
+            for row, indices_to_keep in zip(self.distances, chain.filter_batch(self.distances)):
+                # Same as applying the filters one after the other.
+                expected = numpy.arange(len(row))
+                for f in filters:
+                    expected = expected[f(row[expected])]
+
+                self.assertEqual(list(indices_to_keep), list(expected))
+
+        self.assertFalse(FilterChain([NearestFilter(5), UniqueFilter()]).fused)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -21,168 +21,60 @@
 # THE SOFTWARE.
 
 import numpy
-import scipy
+import os
+import pickle
+import shutil
+import tempfile
 import unittest
 
-from redis import Redis
-
-from nearpy.storage import MemoryStorage, RedisStorage
-
-from nearpy.hashes import RandomBinaryProjections, \
-    RandomDiscretizedProjections, \
-    PCABinaryProjections, PCADiscretizedProjections
+from nearpy.hashes import LocalitySensitiveHashing, RandomDiscretizedProjections, \
+    PCAHashing, PCADiscretizedProjections
+from nearpy.storage import storage_factory
 
 
 class TestHashStorage(unittest.TestCase):
+    """ Hashes are kept in the storage infos, pickled. """
 
     def setUp(self):
-        self.memory = MemoryStorage()
-        self.redis_object = Redis(host='localhost',
-                                  port=6379, db=0)
-        self.redis_storage = RedisStorage(self.redis_object)
-
-    def test_hash_memory_storage_rbp(self):
-        hash1 = RandomBinaryProjections('testRBPHash', 10)
-        hash1.reset(100)
-
-        self.memory.store_hash_configuration(hash1)
-
-        hash2 = RandomBinaryProjections(None, None)
-        hash2.apply_config(self.memory.load_hash_configuration('testRBPHash'))
-
-        self.assertEqual(hash1.dim, hash2.dim)
-        self.assertEqual(hash1.hash_name, hash2.hash_name)
-        self.assertEqual(hash1.projection_count, hash2.projection_count)
-
-        for i in range(hash1.normals.shape[0]):
-            for j in range(hash1.normals.shape[1]):
-                self.assertEqual(hash1.normals[i, j], hash2.normals[i, j])
-
-    def test_hash_memory_storage_rdp(self):
-        hash1 = RandomDiscretizedProjections('testRDPHash', 10, 0.1)
-        hash1.reset(100)
-
-        self.memory.store_hash_configuration(hash1)
-
-        hash2 = RandomDiscretizedProjections(None, None, None)
-        hash2.apply_config(self.memory.load_hash_configuration('testRDPHash'))
-
-        self.assertEqual(hash1.dim, hash2.dim)
-        self.assertEqual(hash1.hash_name, hash2.hash_name)
-        self.assertEqual(hash1.bin_width, hash2.bin_width)
-        self.assertEqual(hash1.projection_count, hash2.projection_count)
-
-        for i in range(hash1.normals.shape[0]):
-            for j in range(hash1.normals.shape[1]):
-                self.assertEqual(hash1.normals[i, j], hash2.normals[i, j])
-
-    def test_hash_memory_storage_pcabp(self):
-        train_vectors = numpy.random.randn(10, 100)
-        hash1 = PCABinaryProjections('testPCABPHash', 4, train_vectors)
-
-        self.memory.store_hash_configuration(hash1)
-
-        hash2 = PCABinaryProjections(None, None, None)
-        hash2.apply_config(self.memory.load_hash_configuration('testPCABPHash'))
-
-        self.assertEqual(hash1.dim, hash2.dim)
-        self.assertEqual(hash1.hash_name, hash2.hash_name)
-        self.assertEqual(hash1.projection_count, hash2.projection_count)
-
-        for i in range(hash1.components.shape[0]):
-            for j in range(hash1.components.shape[1]):
-                self.assertEqual(hash1.components[i, j], hash2.components[i, j])
-
-
-    def test_hash_memory_storage_pcadp(self):
-        train_vectors = numpy.random.randn(10, 100)
-        hash1 = PCADiscretizedProjections('testPCADPHash', 4, train_vectors, 0.1)
-
-        self.memory.store_hash_configuration(hash1)
-
-        hash2 = PCADiscretizedProjections(None, None, None, None)
-        hash2.apply_config(self.memory.load_hash_configuration('testPCADPHash'))
-
-        self.assertEqual(hash1.dim, hash2.dim)
-        self.assertEqual(hash1.hash_name, hash2.hash_name)
-        self.assertEqual(hash1.bin_width, hash2.bin_width)
-        self.assertEqual(hash1.projection_count, hash2.projection_count)
-
-        for i in range(hash1.components.shape[0]):
-            for j in range(hash1.components.shape[1]):
-                self.assertEqual(hash1.components[i, j], hash2.components[i, j])
-
-
-    def test_hash_redis_storage_rbp(self):
-        hash1 = RandomBinaryProjections('testRBPHash', 10)
-        hash1.reset(100)
-
-        self.redis_storage.store_hash_configuration(hash1)
-
-        hash2 = RandomBinaryProjections(None, None)
-        hash2.apply_config(self.redis_storage.load_hash_configuration('testRBPHash'))
-
-        self.assertEqual(hash1.dim, hash2.dim)
-        self.assertEqual(hash1.hash_name, hash2.hash_name)
-        self.assertEqual(hash1.projection_count, hash2.projection_count)
-
-        for i in range(hash1.normals.shape[0]):
-            for j in range(hash1.normals.shape[1]):
-                self.assertEqual(hash1.normals[i, j], hash2.normals[i, j])
-
-    def test_hash_redis_storage_rdp(self):
-        hash1 = RandomDiscretizedProjections('testRDPHash', 10, 0.1)
-        hash1.reset(100)
-
-        self.redis_storage.store_hash_configuration(hash1)
-
-        hash2 = RandomDiscretizedProjections(None, None, None)
-        hash2.apply_config(self.redis_storage.load_hash_configuration('testRDPHash'))
-
-        self.assertEqual(hash1.dim, hash2.dim)
-        self.assertEqual(hash1.hash_name, hash2.hash_name)
-        self.assertEqual(hash1.bin_width, hash2.bin_width)
-        self.assertEqual(hash1.projection_count, hash2.projection_count)
-
-        for i in range(hash1.normals.shape[0]):
-            for j in range(hash1.normals.shape[1]):
-                self.assertEqual(hash1.normals[i, j], hash2.normals[i, j])
-
-    def test_hash_redis_storage_pcabp(self):
-        train_vectors = numpy.random.randn(10, 100)
-        hash1 = PCABinaryProjections('testPCABPHash', 4, train_vectors)
-
-        self.redis_storage.store_hash_configuration(hash1)
-
-        hash2 = PCABinaryProjections(None, None, None)
-        hash2.apply_config(self.redis_storage.load_hash_configuration('testPCABPHash'))
-
-        self.assertEqual(hash1.dim, hash2.dim)
-        self.assertEqual(hash1.hash_name, hash2.hash_name)
-        self.assertEqual(hash1.projection_count, hash2.projection_count)
-
-        for i in range(hash1.components.shape[0]):
-            for j in range(hash1.components.shape[1]):
-                self.assertEqual(hash1.components[i, j], hash2.components[i, j])
-
-
-    def test_hash_redis_storage_pcadp(self):
-        train_vectors = numpy.random.randn(10, 100)
-        hash1 = PCADiscretizedProjections('testPCADPHash', 4, train_vectors, 0.1)
-
-        self.redis_storage.store_hash_configuration(hash1)
-
-        hash2 = PCADiscretizedProjections(None, None, None, None)
-        hash2.apply_config(self.redis_storage.load_hash_configuration('testPCADPHash'))
-
-        self.assertEqual(hash1.dim, hash2.dim)
-        self.assertEqual(hash1.hash_name, hash2.hash_name)
-        self.assertEqual(hash1.bin_width, hash2.bin_width)
-        self.assertEqual(hash1.projection_count, hash2.projection_count)
-
-        for i in range(hash1.components.shape[0]):
-            for j in range(hash1.components.shape[1]):
-                self.assertEqual(hash1.components[i, j], hash2.components[i, j])
+        self.dir = tempfile.mkdtemp()
+        self.vectors = numpy.random.randn(100, 10).astype(numpy.float32)
+        self.storages = [storage_factory("memory", keyprefix="test"),
+                         storage_factory("file", keyprefix="test", dir=self.dir)]
+
+        # PCAHashing saves its principal components in the working directory.
+        self.cwd = os.getcwd()
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def _test_hash_storage(self, hash1, arrays):
+        for storage in self.storages:
+            # Protocol 0 is ASCII, i.e. fits the JSON infos of the file storage.
+            storage.set_info(hash1.name, pickle.dumps(hash1, 0))
+            hash2 = pickle.loads(str(storage.get_info(hash1.name)))
+
+            self.assertEqual(hash1.name, hash2.name)
+            self.assertEqual(hash1.nbits, hash2.nbits)
+            for name in arrays:
+                numpy.testing.assert_array_equal(getattr(hash1, name), getattr(hash2, name))
+            numpy.testing.assert_array_equal(hash1.hash_vector(self.vectors), hash2.hash_vector(self.vectors))
+
+    def test_hash_storage_lsh(self):
+        self._test_hash_storage(LocalitySensitiveHashing('testLSHHash', 10, 16, rand_seed=1), ["normals"])
+
+    def test_hash_storage_rdp(self):
+        rdp = RandomDiscretizedProjections('testRDPHash', 10, 4, 0.1, rand_seed=1)
+        self._test_hash_storage(rdp, ["normals", "offsets", "bin_width", "projection_count"])
+
+    def test_hash_storage_pca(self):
+        pca = PCAHashing('testPCAHash', 10, lambda: [self.vectors], 4)
+        self._test_hash_storage(pca, ["components", "offsets"])
+
+    def test_hash_storage_pcadp(self):
+        pcadp = PCADiscretizedProjections('testPCADPHash', 10, 4, lambda: [self.vectors], 0.1)
+        self._test_hash_storage(pcadp, ["components", "mean_projections", "bin_width", "projection_count"])
 
 
 if __name__ == '__main__':
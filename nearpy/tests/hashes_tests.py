@@ -20,139 +20,298 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import itertools
 import numpy
-import scipy
+import os
+import pickle
+import scipy.sparse
+import shutil
+import tempfile
 import unittest
 
-from nearpy.hashes import RandomBinaryProjections, \
-    RandomDiscretizedProjections, \
-    PCABinaryProjections, PCADiscretizedProjections
+from nearpy import Engine
+from nearpy.data import NumpyData
+from nearpy.distances import EuclideanDistance
+from nearpy.filters import NearestFilter
+from nearpy.hashes import LocalitySensitiveHashing, RandomDiscretizedProjections, PCADiscretizedProjections, \
+    PCAHashing, SpectralHashing
+from nearpy.hashes import pca_hashing
+from nearpy.storage import storage_factory
+from nearpy.utils import pack_bits
 
 
 class TestRandomBinaryProjections(unittest.TestCase):
 
     def setUp(self):
-        self.rbp = RandomBinaryProjections('testHash', 10)
-        self.rbp.reset(100)
+        self.rbp = LocalitySensitiveHashing('testHash', 100, 10, rand_seed=1)
 
     def test_hash_format(self):
-        h = self.rbp.hash_vector(numpy.random.randn(100))
-        self.assertEqual(len(h), 1)
-        self.assertEqual(type(h[0]), type(''))
-        self.assertEqual(len(h[0]), 10)
-        for c in h[0]:
-            self.assertTrue(c == '1' or c == '0')
+        V = numpy.random.randn(20, 100)
+        h = self.rbp.hash_vector(V)
+        self.assertEqual(h.shape, (20,))
+        self.assertEqual(h.dtype, numpy.dtype("|S8"))
+
+        # Bit i of a bucket code is the sign of the i-th projection.
+        bits = self.rbp.project(V) > 0
+        self.assertEqual(bits.shape, (20, 10))
+        numpy.testing.assert_array_equal(h.view(numpy.uint64), numpy.dot(bits, 2**numpy.arange(10)))
+        numpy.testing.assert_array_equal(self.rbp.codes(V)[:, 0], h.view(numpy.uint64))
+
+    def test_codes(self):
+        # Full codes keep every bit, bucket codes only the first 64.
+        rbp = LocalitySensitiveHashing('testHash', 100, 80, rand_seed=1)
+        V = numpy.random.randn(20, 100)
+        codes = rbp.codes(V)
+        self.assertEqual(codes.shape, (20, 2))
+        numpy.testing.assert_array_equal(codes, pack_bits(rbp.project(V) > 0))
+        numpy.testing.assert_array_equal(codes[:, 0], rbp.hash_vector(V).view(numpy.uint64))
 
     def test_hash_deterministic(self):
-        x = numpy.random.randn(100)
-        first_hash = self.rbp.hash_vector(x)[0]
-        for k in range(100):
-            self.assertEqual(first_hash, self.rbp.hash_vector(x)[0])
-
-    def test_hash_format_sparse(self):
-        h = self.rbp.hash_vector(scipy.sparse.rand(100, 1, density=0.1))
-        self.assertEqual(len(h), 1)
-        self.assertEqual(type(h[0]), type(''))
-        self.assertEqual(len(h[0]), 10)
-        for c in h[0]:
-            self.assertTrue(c == '1' or c == '0')
-
-    def test_hash_deterministic_sparse(self):
-        x = scipy.sparse.rand(100, 1, density=0.1)
-        first_hash = self.rbp.hash_vector(x)[0]
-        for k in range(100):
-            self.assertEqual(first_hash, self.rbp.hash_vector(x)[0])
+        V = numpy.random.randn(20, 100)
+        first_hash = self.rbp.hash_vector(V)
+        for k in range(10):
+            numpy.testing.assert_array_equal(first_hash, self.rbp.hash_vector(V))
+
+    def test_hash_sparse(self):
+        X = scipy.sparse.rand(20, 100, density=0.1)
+        numpy.testing.assert_array_equal(self.rbp.hash_vector(X), self.rbp.hash_vector(X.toarray()))
+        numpy.testing.assert_array_equal(self.rbp.codes(X), self.rbp.codes(X.toarray()))
+
 
 class TestRandomDiscretizedProjections(unittest.TestCase):
 
     def setUp(self):
-        self.rbp = RandomDiscretizedProjections('testHash', 10, 0.1)
-        self.rbp.reset(100)
+        self.rdp = RandomDiscretizedProjections('testHash', 100, 8, 2.0, rand_seed=1)
 
     def test_hash_format(self):
-        h = self.rbp.hash_vector(numpy.random.randn(100))
-        self.assertEqual(len(h), 1)
-        self.assertEqual(type(h[0]), type(''))
+        V = numpy.random.randn(20, 100)
+        h = self.rdp.hash_vector(V)
+        self.assertEqual(h.shape, (20,))
+        self.assertEqual(h.dtype, numpy.dtype("|S8"))
+
+        # Each projection takes 8 bits of the code.
+        bins = numpy.floor(self.rdp.project(V)).astype(numpy.int64) % 2**8
+        codes = h.view(numpy.uint64)
+        for i in range(8):
+            numpy.testing.assert_array_equal((codes >> numpy.uint64(8*i)) & numpy.uint64(2**8 - 1), bins[:, i])
+
+        # A single projection takes the 64 bits.
+        rdp = RandomDiscretizedProjections('testHash', 100, 1, 0.1, rand_seed=1)
+        bins = numpy.floor(rdp.project(V)[:, 0]).astype(numpy.int64)
+        numpy.testing.assert_array_equal(rdp.hash_vector(V).view(numpy.int64), bins)
+
+    def test_codes(self):
+        # Bins don't make binary codes (e.g. for HammingDistance).
+        self.assertRaises(TypeError, self.rdp.codes, numpy.random.randn(20, 100))
 
     def test_hash_deterministic(self):
-        x = numpy.random.randn(100)
-        first_hash = self.rbp.hash_vector(x)[0]
-        for k in range(100):
-            self.assertEqual(first_hash, self.rbp.hash_vector(x)[0])
-
-    def test_hash_format_sparse(self):
-        h = self.rbp.hash_vector(scipy.sparse.rand(100, 1, density=0.1))
-        self.assertEqual(len(h), 1)
-        self.assertEqual(type(h[0]), type(''))
-
-    def test_hash_deterministic_sparse(self):
-        x = scipy.sparse.rand(100, 1, density=0.1)
-        first_hash = self.rbp.hash_vector(x)[0]
-        for k in range(100):
-            self.assertEqual(first_hash, self.rbp.hash_vector(x)[0])
+        V = numpy.random.randn(20, 100)
+        first_hash = self.rdp.hash_vector(V)
+        for k in range(10):
+            numpy.testing.assert_array_equal(first_hash, self.rdp.hash_vector(V))
+
+    def test_hash_sparse(self):
+        X = scipy.sparse.rand(20, 100, density=0.1)
+        numpy.testing.assert_array_equal(self.rdp.hash_vector(X), self.rdp.hash_vector(X.toarray()))
+
+    def test_probes(self):
+        v = numpy.random.randn(100)
+        bins = numpy.floor(self.rdp.project(v[None])[0])
+        bucketcode = self.rdp.hash_vector(v[None]).view(numpy.uint64)[0]
+
+        probes = list(itertools.islice(self.rdp.probes(v[None], bucketcode), 50))
+        scores = [score for score, _ in probes]
+        self.assertEqual(scores, sorted(scores))
+        self.assertEqual(len(set(code for _, code in probes)), 50)
+        self.assertNotIn(bucketcode, [code for _, code in probes])
+
+        # The first probe is the bin closest to the vector.
+        positions = self.rdp.project(v[None])[0] - bins
+        self.assertAlmostEqual(scores[0], numpy.minimum(positions, 1 - positions).min()**2, places=5)
+
+    def test_engine(self):
+        V = numpy.random.randn(2000, 20).astype("float32")
+        patch = NumpyData("patch", numpy.dtype("float32"), (20,))
+        rdp = RandomDiscretizedProjections('testHash', 20, 4, 4.0, rand_seed=1)
+        engine = Engine([rdp], distance=EuclideanDistance(patch), filters=[NearestFilter(10)],
+                        storage=storage_factory("memory"), max_probes=2**10)
+        engine.store_batch(V, {patch: V})
+
+        # Neighboring bins are probed until there are enough candidates.
+        for patch_id, neighbors in engine.neighbors_batch(V[:20], V[:20]):
+            self.assertEqual(len(neighbors['patch']), 10)
+            self.assertAlmostEqual(neighbors['dist'][0], 0.0, places=5)
+
+    def test_engine_sparse(self):
+        X = scipy.sparse.rand(2000, 20, density=0.3, format="csr", random_state=0)
+        V = X.toarray().astype("float32")
+        patch = NumpyData("patch", numpy.dtype("float32"), (20,))
+        rdp = RandomDiscretizedProjections('testHash', 20, 4, 1.0, rand_seed=1)
+        engine = Engine([rdp], distance=EuclideanDistance(patch), filters=[NearestFilter(10)],
+                        storage=storage_factory("memory"), max_probes=2**10)
+        engine.store_batch(X, {patch: V})
+
+        # Sparse queries probe the same bins as dense ones.
+        expected = dict(engine.neighbors_batch(V[:20], V[:20]))
+        for patch_id, neighbors in engine.neighbors_batch(X[:20], V[:20]):
+            self.assertEqual(len(neighbors['patch']), 10)
+            numpy.testing.assert_array_equal(neighbors['dist'], expected[patch_id]['dist'])
+
 
 class TestPCABinaryProjections(unittest.TestCase):
 
     def setUp(self):
-        self.vectors = numpy.random.randn(10, 100)
-        self.pbp = PCABinaryProjections('pbp', 4, self.vectors)
+        # The principal components are saved in the working directory.
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+
+        self.vectors = numpy.random.randn(100, 10)
+        self.pbp = PCAHashing('pbp', 10, lambda: [self.vectors[:50], self.vectors[50:]], 4)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
 
     def test_hash_format(self):
-        h = self.pbp.hash_vector(numpy.random.randn(10))
-        self.assertEqual(len(h), 1)
-        self.assertEqual(type(h[0]), type(''))
-        self.assertEqual(len(h[0]), 4)
-        for c in h[0]:
-            self.assertTrue(c == '1' or c == '0')
+        V = numpy.random.randn(20, 10)
+        h = self.pbp.hash_vector(V)
+        self.assertEqual(h.shape, (20,))
+        self.assertEqual(h.dtype, numpy.dtype("|S8"))
+
+        bits = self.pbp.project(V) > 0
+        self.assertEqual(bits.shape, (20, 4))
+        numpy.testing.assert_array_equal(h.view(numpy.uint64), numpy.dot(bits, 2**numpy.arange(4)))
+        numpy.testing.assert_array_equal(self.pbp.codes(V)[:, 0], h.view(numpy.uint64))
 
     def test_hash_deterministic(self):
-        x = numpy.random.randn(10)
-        first_hash = self.pbp.hash_vector(x)[0]
-        for k in range(100):
-            self.assertEqual(first_hash, self.pbp.hash_vector(x)[0])
-
-    def test_hash_format_sparse(self):
-        h = self.pbp.hash_vector(scipy.sparse.rand(10, 1, density=0.6))
-        self.assertEqual(len(h), 1)
-        self.assertEqual(type(h[0]), type(''))
-        self.assertEqual(len(h[0]), 4)
-        for c in h[0]:
-            self.assertTrue(c == '1' or c == '0')
-
-    def test_hash_deterministic_sparse(self):
-        x = scipy.sparse.rand(10, 1, density=0.6)
-        first_hash = self.pbp.hash_vector(x)[0]
-        for k in range(100):
-            self.assertEqual(first_hash, self.pbp.hash_vector(x)[0])
+        V = numpy.random.randn(20, 10)
+        first_hash = self.pbp.hash_vector(V)
+        for k in range(10):
+            numpy.testing.assert_array_equal(first_hash, self.pbp.hash_vector(V))
+
+    def test_hash_sparse(self):
+        X = scipy.sparse.rand(20, 10, density=0.6)
+        numpy.testing.assert_array_equal(self.pbp.hash_vector(X), self.pbp.hash_vector(X.toarray()))
+        numpy.testing.assert_allclose(self.pbp.project(X), self.pbp.project(X.toarray()), rtol=1e-5)
 
 
 class TestPCADiscretizedProjections(unittest.TestCase):
 
     def setUp(self):
-        self.vectors = numpy.random.randn(10, 100)
-        self.pdp = PCADiscretizedProjections('pdp', 4, self.vectors, 0.1)
+        self.vectors = numpy.random.randn(100, 10)
+        self.pdp = PCADiscretizedProjections('pdp', 10, 4, lambda: [self.vectors[:50], self.vectors[50:]], 0.5)
 
     def test_hash_format(self):
-        h = self.pdp.hash_vector(numpy.random.randn(10))
-        self.assertEqual(len(h), 1)
-        self.assertEqual(type(h[0]), type(''))
+        h = self.pdp.hash_vector(numpy.random.randn(20, 10))
+        self.assertEqual(h.shape, (20,))
+        self.assertEqual(h.dtype, numpy.dtype("|S8"))
 
     def test_hash_deterministic(self):
-        x = numpy.random.randn(10)
-        first_hash = self.pdp.hash_vector(x)[0]
-        for k in range(100):
-            self.assertEqual(first_hash, self.pdp.hash_vector(x)[0])
-
-    def test_hash_format_sparse(self):
-        h = self.pdp.hash_vector(scipy.sparse.rand(10, 1, density=0.6))
-        self.assertEqual(len(h), 1)
-        self.assertEqual(type(h[0]), type(''))
-
-    def test_hash_deterministic_sparse(self):
-        x = scipy.sparse.rand(10, 1, density=0.6)
-        first_hash = self.pdp.hash_vector(x)[0]
-        for k in range(100):
-            self.assertEqual(first_hash, self.pdp.hash_vector(x)[0])
+        V = numpy.random.randn(20, 10)
+        first_hash = self.pdp.hash_vector(V)
+        for k in range(10):
+            numpy.testing.assert_array_equal(first_hash, self.pdp.hash_vector(V))
+
+    def test_hash_sparse(self):
+        X = scipy.sparse.rand(20, 10, density=0.6)
+        numpy.testing.assert_array_equal(self.pdp.hash_vector(X), self.pdp.hash_vector(X.toarray()))
+
+    def test_projections(self):
+        # Projections on the principal components of the centered vectors.
+        centered = self.vectors - self.vectors.mean(axis=0)
+        projections = self.pdp.project(self.vectors) * self.pdp.bin_width
+        numpy.testing.assert_allclose(projections.mean(axis=0), 0, atol=1e-5)
+        variances = projections.var(axis=0)
+        self.assertTrue(numpy.all(numpy.diff(variances) <= 1e-5))
+        self.assertAlmostEqual(variances[0], numpy.linalg.svd(centered, compute_uv=False)[0]**2 / len(centered),
+                               places=3)
+
+
+class TestPCAHashing(unittest.TestCase):
+
+    def setUp(self):
+        # The principal components are saved in the working directory.
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+
+        rand = numpy.random.RandomState(0)
+        self.vectors = (rand.randn(4000, 16) * numpy.linspace(4, 1, 16)).astype("float32")
+        self.trainset = lambda: [self.vectors[:2000], self.vectors[2000:]]
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def test_hash_format(self):
+        pca = PCAHashing('pca', 16, self.trainset, 8)
+        h = pca.hash_vector(self.vectors)
+        self.assertEqual(h.shape, (len(self.vectors),))
+        self.assertEqual(h.dtype, numpy.dtype("|S8"))
+
+        bits = pca.project(self.vectors) > 0
+        numpy.testing.assert_array_equal(h.view(numpy.uint64), numpy.dot(bits, 2**numpy.arange(8)))
+
+    def test_itq(self):
+        pca = PCAHashing('pca', 16, self.trainset, 8)
+        itq = PCAHashing('itq', 16, self.trainset, 8, itq_iterations=20, rand_seed=1)
+        numpy.testing.assert_allclose(numpy.dot(itq.rotation.T, itq.rotation), numpy.eye(8), atol=1e-5)
+
+        # The rotation lowers the quantization error and balances the variance across bits.
+        def quantization_error(projections):
+            return numpy.sum((numpy.where(projections > 0, 1, -1) - projections)**2)
+
+        pca_projections = pca.project(self.vectors)
+        itq_projections = itq.project(self.vectors)
+        scale = numpy.abs(pca_projections).mean()
+        self.assertLess(quantization_error(itq_projections / scale), quantization_error(pca_projections / scale))
+        self.assertLess(itq_projections.var(axis=0).std(), pca_projections.var(axis=0).std())
+
+    def test_pickle(self):
+        itq = PCAHashing('itq', 16, self.trainset, 8, itq_iterations=5, rand_seed=1)
+        itq2 = pickle.loads(pickle.dumps(itq, pickle.HIGHEST_PROTOCOL))
+        numpy.testing.assert_array_equal(itq.hash_vector(self.vectors), itq2.hash_vector(self.vectors))
+
+
+class TestSpectralHashing(unittest.TestCase):
+
+    def setUp(self):
+        # The principal components and the bounds are saved in the working directory.
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+
+        rand = numpy.random.RandomState(0)
+        self.vectors = (rand.randn(4000, 16) * numpy.linspace(4, 1, 16)).astype("float32")
+        self.sh = SpectralHashing('sh', dimension=16, trainset=lambda: [self.vectors], nbits=12)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def test_formula(self):
+        # Product over the components of the sines of [Weiss2008b], as computed before the factors were precomputed.
+        projV = numpy.dot(self.vectors, self.sh.eigenvectors[:, :self.sh.npca])[:, None, :]
+        omegas = numpy.pi / (self.sh.bounds[1] - self.sh.bounds[0]) * self.sh.modes
+        expected = numpy.prod(numpy.sin(omegas * (projV - self.sh.bounds[0]) + numpy.pi/2), axis=2)
+
+        projections = self.sh.project(self.vectors)
+        numpy.testing.assert_allclose(projections, expected, atol=1e-4)
+        # Same bits, except maybe where the rounding errors change the sign.
+        codes = self.sh.hash_vector(self.vectors).view(numpy.uint64)
+        bits = (codes[:, None] >> numpy.arange(12, dtype=numpy.uint64)) & 1
+        sure = numpy.abs(expected) > 1e-4
+        numpy.testing.assert_array_equal(bits[sure], (expected > 0)[sure])
+
+    def test_chunks(self):
+        expected = self.sh.project(self.vectors)
+        chunk_size = pca_hashing.CHUNK_SIZE
+        pca_hashing.CHUNK_SIZE = 300  # Not a divisor of the number of vectors.
+        try:
+            numpy.testing.assert_array_equal(self.sh.project(self.vectors), expected)
+        finally:
+            pca_hashing.CHUNK_SIZE = chunk_size
 
 
 if __name__ == '__main__':
@@ -21,119 +21,61 @@
 # THE SOFTWARE.
 
 import numpy
-import scipy
+import pickle
 import unittest
-import json
 
 from nearpy import Engine
+from nearpy.data import NumpyData
+from nearpy.distances import EuclideanDistance
 from nearpy.filters import NearestFilter
 from nearpy.hashes import RandomBinaryProjectionTree
+from nearpy.storage import storage_factory
 
-from redis import Redis
-from nearpy.storage import MemoryStorage, RedisStorage
 
 class TestRandomBinaryProjectionTree(unittest.TestCase):
 
     def setUp(self):
-        self.memory = MemoryStorage()
-        self.redis_object = Redis(host='localhost',
-                                  port=6379, db=0)
-        self.redis_storage = RedisStorage(self.redis_object)
+        self.V = numpy.random.randn(2000, 20).astype("float32")
+        self.queries = numpy.random.randn(50, 20).astype("float32")
 
-    def test_retrieval(self):
+    def test_guarantee(self):
         # We want 12 projections, 20 results at least
-        rbpt = RandomBinaryProjectionTree('testHash', 12, 20)
-
-        # Create engine for 100 dimensional feature space, do not forget to set
-        # nearest filter to 20, because default is 10
-        self.engine = Engine(100, lshashes=[rbpt], vector_filters=[NearestFilter(20)])
-
-        # First insert 200000 random vectors
-        print 'Indexing...'
-        for k in range(200000):
-            x = numpy.random.randn(100)
-            x_data = 'data'
-            self.engine.store_vector(x, x_data)
-
-        # Now do random queries and check result set size
-        print 'Querying...'
-        for k in range(10):
-            x = numpy.random.randn(100)
-            n = self.engine.neighbours(x)
-            print "Candidate count = %d" % self.engine.candidate_count(x)
-            print "Result size = %d" % len(n)
-            self.assertEqual(len(n), 20)
-
-    def test_storage_memory(self):
-        # We want 10 projections, 20 results at least
-        rbpt = RandomBinaryProjectionTree('testHash', 10, 20)
-
-        # Create engine for 100 dimensional feature space
-        self.engine = Engine(100, lshashes=[rbpt], vector_filters=[NearestFilter(20)])
-
-        # First insert 2000 random vectors
-        for k in range(2000):
-            x = numpy.random.randn(100)
-            x_data = 'data'
-            self.engine.store_vector(x, x_data)
-
-        self.memory.store_hash_configuration(rbpt)
-
-        rbpt2 = RandomBinaryProjectionTree(None, None, None)
-        rbpt2.apply_config(self.memory.load_hash_configuration('testHash'))
-
-        self.assertEqual(rbpt.dim, rbpt2.dim)
-        self.assertEqual(rbpt.hash_name, rbpt2.hash_name)
-        self.assertEqual(rbpt.projection_count, rbpt2.projection_count)
-
-        for i in range(rbpt.normals.shape[0]):
-            for j in range(rbpt.normals.shape[1]):
-                self.assertEqual(rbpt.normals[i, j], rbpt2.normals[i, j])
-
-        # Now do random queries and check result set size
-        for k in range(10):
-            x = numpy.random.randn(100)
-            keys1 = rbpt.hash_vector(x, querying=True)
-            keys2 = rbpt2.hash_vector(x, querying=True)
-            self.assertEqual(len(keys1), len(keys2))
-            for k in range(len(keys1)):
-                self.assertEqual(keys1[k], keys2[k])
-
-    def test_storage_redis(self):
-        # We want 10 projections, 20 results at least
-        rbpt = RandomBinaryProjectionTree('testHash', 10, 20)
-
-        # Create engine for 100 dimensional feature space
-        self.engine = Engine(100, lshashes=[rbpt], vector_filters=[NearestFilter(20)])
-
-        # First insert 2000 random vectors
-        for k in range(2000):
-            x = numpy.random.randn(100)
-            x_data = 'data'
-            self.engine.store_vector(x, x_data)
-
-
-        self.redis_storage.store_hash_configuration(rbpt)
-
-        rbpt2 = RandomBinaryProjectionTree(None, None, None)
-        rbpt2.apply_config(self.redis_storage.load_hash_configuration('testHash'))
-
-        self.assertEqual(rbpt.dim, rbpt2.dim)
-        self.assertEqual(rbpt.hash_name, rbpt2.hash_name)
-        self.assertEqual(rbpt.projection_count, rbpt2.projection_count)
-
-        for i in range(rbpt.normals.shape[0]):
-            for j in range(rbpt.normals.shape[1]):
-                self.assertEqual(rbpt.normals[i, j], rbpt2.normals[i, j])
-
-        # Now do random queries and check result set size
-        for k in range(10):
-            x = numpy.random.randn(100)
-            keys1 = rbpt.hash_vector(x, querying=True)
-            keys2 = rbpt2.hash_vector(x, querying=True)
-            self.assertEqual(len(keys1), len(keys2))
-            for k in range(len(keys1)):
-                self.assertEqual(keys1[k], keys2[k])
+        rbpt = RandomBinaryProjectionTree('testHash', 20, 12, 20, rand_seed=1)
+        rbpt.insert(rbpt.hash_vector(self.V).view(numpy.uint64))
+
+        codes = rbpt.hash_vector(self.V).view(numpy.uint64)
+        sizes = dict(zip(*numpy.unique(codes, return_counts=True)))
+        for bucketcodes in rbpt.bucket_codes_to_guarantee(self.queries):
+            self.assertTrue(sum(sizes[code] for code in bucketcodes) >= 20)
+
+            # The buckets are the ones of a subtree (i.e. they share their first bits).
+            depth = 0
+            while depth < rbpt.nbits and len(numpy.unique(bucketcodes & numpy.uint64(2**(depth+1) - 1))) == 1:
+                depth += 1
+            self.assertEqual(len(bucketcodes), len(set(code for code in sizes
+                                                       if (code ^ bucketcodes[0]) & numpy.uint64(2**depth - 1) == 0)))
+
+    def test_engine(self):
+        patch = NumpyData("patch", numpy.dtype("float32"), (20,))
+        rbpt = RandomBinaryProjectionTree('testHash', 20, 12, 20)
+        engine = Engine([rbpt], distance=EuclideanDistance(patch), filters=[NearestFilter(20)],
+                        storage=storage_factory("memory"))
+        engine.store_batch(self.V, {patch: self.V})
+
+        # The tree gives the buckets to probe, there are always 20 results.
+        for patch_id, neighbors in engine.neighbors_batch(self.queries, self.queries):
+            self.assertEqual(len(neighbors['patch']), 20)
+
+    def test_pickle(self):
+        rbpt = RandomBinaryProjectionTree('testHash', 20, 10, 20)
+        rbpt.insert(rbpt.hash_vector(self.V).view(numpy.uint64))
+        rbpt2 = pickle.loads(pickle.dumps(rbpt, pickle.HIGHEST_PROTOCOL))
+
+        numpy.testing.assert_array_equal(rbpt.normals, rbpt2.normals)
+        for keys1, keys2 in zip(rbpt.bucket_codes_to_guarantee(self.queries),
+                                rbpt2.bucket_codes_to_guarantee(self.queries)):
+            numpy.testing.assert_array_equal(keys1, keys2)
+
 
 if __name__ == '__main__':
     unittest.main()
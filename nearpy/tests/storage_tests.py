@@ -20,86 +20,433 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import os
 import numpy
-import scipy
+import shutil
+import tempfile
 import unittest
 
-from redis import Redis
-
-from nearpy.storage import MemoryStorage, RedisStorage
+from nearpy.data import Data, NumpyData, object_array
+from nearpy.storage import storage_factory
+from nearpy.storage.storage import group_by_bucket, encode_bucketkeys
 
 
 class TestStorage(unittest.TestCase):
 
     def setUp(self):
-        self.memory = MemoryStorage()
-        self.redis_object = Redis(host='localhost',
-                                  port=6379, db=0)
-        self.redis_storage = RedisStorage(self.redis_object)
+        self.codes = numpy.array([7, 3, 7], dtype=numpy.uint64)
+        self.patch = NumpyData("patch", numpy.dtype(numpy.float32), (100,))
+        self.x = numpy.random.randn(3, 100).astype(numpy.float32)
+        self.data = Data("data")
+        self.x_data = object_array([['one', 'two', 'three'], {'id': 1}, None])
+
+    def _test_storage(self, storage, prefix):
+        storage.store(self.codes, {self.patch: self.x, self.data: self.x_data}, prefix=prefix)
+        codes = numpy.array([7, 3, 5], dtype=numpy.uint64)
+        buckets = storage.retrieve(codes, self.patch, prefix=prefix)
+        numpy.testing.assert_array_equal(buckets[0], self.x[[0, 2]])
+        numpy.testing.assert_array_equal(buckets[1], self.x[[1]])
+        self.assertEqual(len(buckets[2]), 0)
+        self.assertEqual(list(storage.count(codes, prefix=prefix)), [2, 1, 0])
+
+        buckets = storage.retrieve(codes, self.data, prefix=prefix)
+        self.assertEqual(list(buckets[0]), [['one', 'two', 'three'], None])
+        self.assertEqual(list(buckets[1]), [{'id': 1}])
+        self.assertEqual(len(buckets[2]), 0)
+
+        storage.remove(codes, prefix=prefix)
+        self.assertEqual(list(storage.count(codes, prefix=prefix)), [0, 0, 0])
+        self.assertEqual(len(storage.retrieve(codes, self.data, prefix=prefix)[0]), 0)
 
     def test_memory_storage(self):
-        x = numpy.random.randn(100, 1)
-        bucket_key = '23749283743928748'
-        x_data = ['one', 'two', 'three']
-        self.memory.store_vector('testHash', bucket_key, x, x_data)
-        X = self.memory.get_bucket('testHash', bucket_key)
-        self.assertEqual(len(X), 1)
-        y = X[0][0]
-        y_data = X[0][1]
-        self.assertEqual(len(y), len(x))
-        self.assertEqual(type(x), type(y))
-        for k in range(100):
-            self.assertEqual(y[k], x[k])
-        self.assertEqual(type(y_data), type(x_data))
-        self.assertEqual(len(y_data), len(x_data))
-        for k in range(3):
-            self.assertEqual(y_data[k], x_data[k])
-        self.memory.clean_all_buckets()
-        self.assertEqual(self.memory.get_bucket('testHash', bucket_key), [])
+        storage = storage_factory("memory", keyprefix="test")
+        self._test_storage(storage, "testHash")
+
+        storage.store(self.codes, {self.patch: self.x, self.data: self.x_data}, prefix="testHash")
+        storage.remove(numpy.array([7], dtype=numpy.uint64), prefix="testHash")
+        self.assertEqual(list(storage.count(numpy.array([7, 3], dtype=numpy.uint64), prefix="testHash")), [0, 1])
 
     def test_redis_storage(self):
-        self.redis_storage.clean_all_buckets()
-        x = numpy.random.randn(100, 1)
-        bucket_key = '23749283743928748'
-        x_data = ['one', 'two', 'three']
-        self.redis_storage.store_vector('testHash', bucket_key, x, x_data)
-        X = self.redis_storage.get_bucket('testHash', bucket_key)
-        self.assertEqual(len(X), 1)
-        y = X[0][0]
-        y_data = X[0][1]
-        self.assertEqual(len(y), len(x))
-        self.assertEqual(type(x), type(y))
-        for k in range(100):
-            self.assertEqual(y[k], x[k])
-        self.assertEqual(type(y_data), type(x_data))
-        self.assertEqual(len(y_data), len(x_data))
-        for k in range(3):
-            self.assertEqual(y_data[k], x_data[k])
-        self.redis_storage.clean_all_buckets()
-        self.assertEqual(self.redis_storage.get_bucket('testHash',
-                                                       bucket_key), [])
-
-    def test_redis_storage_sparse(self):
-        self.redis_storage.clean_all_buckets()
-        x = scipy.sparse.rand(100, 1, density=0.1)
-        bucket_key = '23749283743928748'
-        x_data = ['one', 'two', 'three']
-        self.redis_storage.store_vector('testHash', bucket_key, x, x_data)
-        X = self.redis_storage.get_bucket('testHash', bucket_key)
-        self.assertEqual(len(X), 1)
-        y = X[0][0]
-        y_data = X[0][1]
-        self.assertEqual(type(x), type(y))
-        self.assertEqual(x.shape[0], y.shape[0])
-        self.assertEqual(x.shape[1], y.shape[1])
-        self.assertTrue((y - x).sum() == 0.0)
-        self.assertEqual(type(y_data), type(x_data))
-        self.assertEqual(len(y_data), len(x_data))
-        for k in range(3):
-            self.assertEqual(y_data[k], x_data[k])
-        self.redis_storage.clean_all_buckets()
-        self.assertEqual(self.redis_storage.get_bucket('testHash',
-                                                       bucket_key), [])
+        try:
+            storage = storage_factory("redis", keyprefix="test")
+            storage.count(numpy.array([7], dtype=numpy.uint64))
+        except Exception as e:  # Missing client library or no server.
+            self.skipTest("Redis isn't available: {}".format(e))
+
+        # Buckets of previous runs aren't removed, each run uses its own prefix.
+        self._test_storage(storage, "testHash{}".format(os.getpid()))
+
+
+class TestBucketKeys(unittest.TestCase):
+
+    def setUp(self):
+        self.codes = numpy.array([3, 0, 2**63, 3, 0, 3], dtype=numpy.uint64)
+        self.patch = NumpyData("patch", numpy.dtype(numpy.float32), (2,))
+        self.label = NumpyData("label", numpy.dtype(numpy.uint8), ())
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_group_by_bucket(self):
+        order, unique_codes, bounds = group_by_bucket(self.codes)
+        self.assertEqual(list(unique_codes), [0, 3, 2**63])
+        self.assertEqual(list(bounds), [0, 2, 5, 6])
+        self.assertEqual(list(order), [1, 4, 0, 3, 5, 2])
+
+    def test_encode_bucketkeys(self):
+        keys = encode_bucketkeys(self.codes[:3], "h_", "_patch")
+        self.assertEqual(keys[0], "h_\x03" + "\x00"*7 + "_patch")
+        self.assertEqual(keys[1], "h_" + "\x00"*8 + "_patch")
+        self.assertEqual(keys[2], "h_" + "\x00"*7 + "\x80" + "_patch")
+
+        # Already encoded keys are only prefixed.
+        self.assertEqual(encode_bucketkeys(["\x03" + "\x00"*7], "h_", "_patch"), keys[:1])
+
+    def test_store_retrieve(self):
+        storages = [storage_factory("memory", keyprefix="test"),
+                    storage_factory("file", keyprefix="test", dir=self.dir)]
+
+        patches = numpy.arange(2*len(self.codes), dtype=numpy.float32).reshape((-1, 2))
+        labels = numpy.arange(len(self.codes), dtype=numpy.uint8)
+        for storage in storages + [storage_factory("columnar")]:
+            storage.store(self.codes, {self.patch: patches, self.label: labels}, prefix="h_")
+            storage.store(self.codes[:1], {self.patch: patches[:1], self.label: labels[:1]}, prefix="h_")
+
+            buckets = storage.retrieve(numpy.array([3, 1], dtype=numpy.uint64), self.label, prefix="h_")
+            self.assertEqual(list(buckets[0]), [0, 3, 5, 0])
+            self.assertEqual(len(buckets[1]), 0)
+
+            buckets = storage.retrieve(numpy.array([2**63], dtype=numpy.uint64), self.patch, prefix="h_")
+            numpy.testing.assert_array_equal(buckets[0], patches[[2]])
+
+            self.assertEqual(storage.count(numpy.array([0, 1], dtype=numpy.uint64), prefix="h_"), [2, 0])
+
+            # Other namespaces are not affected.
+            self.assertEqual(storage.count(self.codes[:1]), [0])
+
+            # Keys listed by the storage can be given back to it.
+            bucketkeys = sorted(storage.bucketkeys())
+            self.assertEqual(bucketkeys, sorted(encode_bucketkeys(numpy.unique(self.codes), "h_")))
+            self.assertEqual(sorted(storage.count(bucketkeys)), [1, 2, 4])
+
+    def test_retrieve_rows(self):
+        columnar = storage_factory("columnar")
+        storages = [storage_factory("memory", keyprefix="test"), columnar,
+                    storage_factory("file", keyprefix="test", dir=self.dir),
+                    storage_factory("memory", keyprefix="test", cache_bytes=2**20)]
+
+        patches = numpy.arange(2*len(self.codes), dtype=numpy.float32).reshape((-1, 2))
+        for storage in storages:
+            storage.store(self.codes, {self.patch: patches}, prefix="h_")
+            if storage is columnar:
+                columnar.merge()  # Bucket 3 spans the main and delta segments.
+            storage.store(self.codes[:1], {self.patch: patches[:1]}, prefix="h_")
+
+            codes = numpy.array([3, 1, 2**63], dtype=numpy.uint64)
+            expected = storage.retrieve(codes, self.patch, prefix="h_")
+            rows = [numpy.array([3, 0, 2]), numpy.array([], dtype=int), numpy.array([0])]
+            buckets = storage.retrieve_rows(codes, self.patch, rows, prefix="h_")
+            for bucket, bucket_rows, expected_bucket in zip(buckets, rows, expected):
+                numpy.testing.assert_array_equal(bucket, expected_bucket[bucket_rows])
+
+
+class TestColumnarStorage(unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(42)
+        self.patch = NumpyData("patch", numpy.dtype(numpy.float32), (3,))
+        self.label = NumpyData("label", numpy.dtype(numpy.uint8), ())
+
+    def _store(self, storages, n):
+        codes = numpy.random.randint(0, 50, size=n).astype(numpy.uint64)
+        patches = numpy.random.randn(n, 3).astype(numpy.float32)
+        labels = numpy.random.randint(0, 255, size=n).astype(numpy.uint8)
+        for storage in storages:
+            storage.store(codes, {self.patch: patches, self.label: labels}, prefix="h_")
+
+    def test_same_as_memory(self):
+        memory = storage_factory("memory")
+        columnar = storage_factory("columnar")
+
+        codes = numpy.arange(60, dtype=numpy.uint64)
+        for i in range(5):
+            self._store([memory, columnar], 100)
+
+            # Elements are retrieved in insertion order, whether they are in the delta segment or not.
+            for attribute in [self.patch, self.label]:
+                expected = memory.retrieve(codes, attribute, prefix="h_")
+                for bucket, expected_bucket in zip(columnar.retrieve(codes, attribute, prefix="h_"), expected):
+                    numpy.testing.assert_array_equal(bucket, expected_bucket)
+
+            self.assertEqual(columnar.count(codes, prefix="h_"), memory.count(codes, prefix="h_"))
+            if i == 2:
+                columnar.merge()
+
+        self.assertEqual(sorted(columnar.bucketkeys()), sorted(memory.bucketkeys()))
+
+    def test_zero_copy(self):
+        columnar = storage_factory("columnar")
+        self._store([columnar], 100)
+        columnar.merge()
+
+        main, delta = columnar.segments["h_"]
+        self.assertEqual(len(delta), 0)
+        buckets = columnar.retrieve(main.codes[:3], self.patch, prefix="h_")
+        for bucket in buckets:
+            self.assertTrue(numpy.may_share_memory(bucket, main.columns["patch"]))
+
+    def test_remove(self):
+        columnar = storage_factory("columnar")
+        self._store([columnar], 100)
+        columnar.merge()
+        self._store([columnar], 10)
+
+        codes = numpy.array([0, 1, 2, 1000], dtype=numpy.uint64)
+        nb_removed = sum(count > 0 for count in columnar.count(codes, prefix="h_"))
+        self.assertEqual(columnar.remove(codes, prefix="h_"), nb_removed)
+        self.assertEqual(columnar.count(codes, prefix="h_"), [0, 0, 0, 0])
+        self.assertEqual(len(columnar.retrieve(codes, self.label, prefix="h_")[0]), 0)
+
+    def test_missing_attribute(self):
+        columnar = storage_factory("columnar")
+        self._store([columnar], 10)
+
+        # Columns must stay aligned, every element has every attribute.
+        codes = numpy.zeros(10, dtype=numpy.uint64)
+        with self.assertRaises(ValueError):
+            columnar.store(codes, {self.patch: numpy.zeros((10, 3), dtype=numpy.float32)}, prefix="h_")
+
+
+class TestMMapStorage(unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(42)
+        self.patch = NumpyData("patch", numpy.dtype(numpy.float32), (3,))
+        self.label = NumpyData("label", numpy.dtype(numpy.uint8), ())
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _store(self, storages, n, prefix):
+        codes = numpy.random.randint(0, 50, size=n).astype(numpy.uint64)
+        patches = numpy.random.randn(n, 3).astype(numpy.float32)
+        labels = numpy.random.randint(0, 255, size=n).astype(numpy.uint8)
+        for storage in storages:
+            storage.store(codes, {self.patch: patches, self.label: labels}, prefix=prefix)
+
+    def test_save_and_open(self):
+        memory = storage_factory("memory")
+        mmap = storage_factory("mmap", keyprefix="index", dir=self.dir)
+        self._store([memory, mmap], 100, "h1_")
+        self._store([memory, mmap], 100, "h2_")
+        mmap.set_info("nb_patches", 200)
+        mmap.save()
+        self._store([memory, mmap], 10, "h1_")  # Not saved yet.
+
+        codes = numpy.arange(60, dtype=numpy.uint64)
+        reopened = storage_factory("mmap", keyprefix="index", dir=self.dir)
+        self.assertEqual(reopened.get_info("nb_patches"), 200)
+
+        for prefix in ["h1_", "h2_"]:
+            for attribute in [self.patch, self.label]:
+                expected = memory.retrieve(codes, attribute, prefix=prefix)
+                for bucket, expected_bucket in zip(mmap.retrieve(codes, attribute, prefix=prefix), expected):
+                    numpy.testing.assert_array_equal(bucket, expected_bucket)
+
+            self.assertEqual(mmap.count(codes, prefix=prefix), memory.count(codes, prefix=prefix))
+
+        # Buckets are views on the file.
+        main, _ = reopened.segments["h2_"]
+        bucket = reopened.retrieve(main.codes[:1], self.patch, prefix="h2_")[0]
+        self.assertTrue(isinstance(bucket, numpy.memmap))
+        self.assertEqual(reopened.count(codes, prefix="h2_"), memory.count(codes, prefix="h2_"))
+        self.assertEqual(sum(reopened.count(codes, prefix="h1_")), 100)
+
+        mmap.save()
+        self.assertEqual(sum(mmap.reopen().count(codes, prefix="h1_")), 110)
+
+        mmap.clear()
+        self.assertEqual(storage_factory("mmap", keyprefix="index", dir=self.dir).bucketkeys(), [])
+
+    def test_attribute_names(self):
+        # Attributes can have the names used to describe the arrays in the files.
+        codes = numpy.array([1, 2, 1], dtype=numpy.uint64)
+        attributes = [NumpyData(name, numpy.dtype(numpy.int64), ()) for name in ["position", "array", "dict"]]
+        for storage in [storage_factory("mmap", keyprefix="index", dir=self.dir),
+                        storage_factory("file", keyprefix="segments", dir=self.dir)]:
+            storage.store(codes, {attribute: numpy.arange(3) for attribute in attributes})
+            if hasattr(storage, "save"):
+                storage.save()
+
+            reopened = storage.reopen()
+            for attribute in attributes:
+                self.assertEqual([list(bucket) for bucket in reopened.retrieve(codes[:2], attribute)], [[0, 2], [1]])
+
+
+class TestFileStorage(unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(42)
+        self.patch = NumpyData("patch", numpy.dtype(numpy.float32), (3,))
+        self.label = NumpyData("label", numpy.dtype(numpy.uint8), ())
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _store(self, storages, n, prefix):
+        codes = numpy.random.randint(0, 50, size=n).astype(numpy.uint64)
+        patches = numpy.random.randn(n, 3).astype(numpy.float32)
+        labels = numpy.random.randint(0, 255, size=n).astype(numpy.uint8)
+        for storage in storages:
+            storage.store(codes, {self.patch: patches, self.label: labels}, prefix=prefix)
+
+    def _assert_same(self, storage, expected_storage, prefix):
+        codes = numpy.arange(60, dtype=numpy.uint64)
+        for attribute in [self.patch, self.label]:
+            expected = expected_storage.retrieve(codes, attribute, prefix=prefix)
+            for bucket, expected_bucket in zip(storage.retrieve(codes, attribute, prefix=prefix), expected):
+                numpy.testing.assert_array_equal(bucket, expected_bucket)
+
+        self.assertEqual(storage.count(codes, prefix=prefix), expected_storage.count(codes, prefix=prefix))
+
+    def test_segments(self):
+        memory = storage_factory("memory")
+        storage = storage_factory("file", keyprefix="test", dir=self.dir, max_segments=4)
+        for i in range(10):
+            self._store([memory, storage], 50, "h{}_".format(i % 2))
+
+        storage.wait_compaction()
+        self.assertTrue(len(storage.segments) <= 5)
+        self.assertEqual(len(os.listdir(storage.buckets_dir)), len(storage.segments) + 1)  # With the manifest.
+
+        for prefix in ["h0_", "h1_"]:
+            self._assert_same(storage, memory, prefix)
+            self._assert_same(storage.reopen(), memory, prefix)
+
+        storage.compact()
+        self.assertEqual(len(storage.segments), 1)
+        self._assert_same(storage, memory, "h0_")
+        self.assertEqual(sorted(storage.bucketkeys()), sorted(memory.bucketkeys()))
+
+    def test_remove(self):
+        storage = storage_factory("file", keyprefix="test", dir=self.dir)
+        self._store([storage], 100, "h_")
+        self._store([storage], 100, "h_")
+
+        codes = numpy.array([0, 1, 2, 1000], dtype=numpy.uint64)
+        counts = storage.count(codes, prefix="h_")
+        self.assertEqual(storage.remove(codes, prefix="h_"), sum(count > 0 for count in counts))
+        self.assertEqual(storage.count(codes, prefix="h_"), [0, 0, 0, 0])
+        self.assertEqual(len(storage.segments), 3)  # Removing only writes a tombstone.
+        self.assertEqual(len(set(storage.bucketkeys()) & set(encode_bucketkeys(codes, "h_"))), 0)
+
+        # Other buckets are kept.
+        all_codes = numpy.arange(50, dtype=numpy.uint64)
+        self.assertEqual(sum(storage.reopen().count(all_codes, prefix="h_")), 200 - sum(counts))
+
+        # Elements stored after the removal are kept, including by the compaction.
+        storage.store(numpy.array([1, 1, 3], dtype=numpy.uint64),
+                      {self.patch: numpy.ones((3, 3), dtype=numpy.float32),
+                       self.label: numpy.ones(3, dtype=numpy.uint8)}, prefix="h_")
+        expected = storage.count(all_codes, prefix="h_")
+        self.assertEqual(expected[1], 2)
+        patches = storage.retrieve(all_codes, self.patch, prefix="h_")
+
+        storage.compact()
+        self.assertEqual(len(storage.segments), 1)
+        self.assertEqual(storage.count(all_codes, prefix="h_"), expected)
+        for bucket, expected_bucket in zip(storage.retrieve(all_codes, self.patch, prefix="h_"), patches):
+            numpy.testing.assert_array_equal(bucket, expected_bucket)
+
+        storage.clear()
+        self.assertEqual(storage.bucketkeys(), [])
+
+    def test_missing_attribute(self):
+        storage = storage_factory("file", keyprefix="test", dir=self.dir)
+        self._store([storage], 10, "h_")
+        codes = numpy.zeros(2, dtype=numpy.uint64)
+        patches = numpy.ones((2, 3), dtype=numpy.float32)
+        self.assertRaises(ValueError, storage.store, codes, {self.patch: patches}, prefix="h_")
+        self.assertEqual(len(storage.segments), 1)
+
+        # Other prefixes may hold other attributes.
+        storage.store(codes, {self.patch: patches}, prefix="g_")
+        storage.compact()
+        self.assertEqual(storage.count(codes[:1], prefix="g_"), [2])
+
+
+class TestCachedStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.label = NumpyData("label", numpy.dtype(numpy.uint8), ())
+        self.codes = numpy.arange(10, dtype=numpy.uint64)
+        self.labels = numpy.arange(10, dtype=numpy.uint8)
+
+    def test_hits_and_invalidation(self):
+        for policy in ["lru", "lfu"]:
+            storage = storage_factory("columnar", cache_bytes=1000, cache_policy=policy)
+            storage.store(self.codes, {self.label: self.labels}, prefix="h_")
+
+            storage.retrieve(self.codes[:5], self.label, prefix="h_")
+            buckets = storage.retrieve(self.codes[:5], self.label, prefix="h_")
+            self.assertEqual([list(bucket) for bucket in buckets], [[0], [1], [2], [3], [4]])
+            self.assertEqual(storage.cache_stats()["hits"], 5)
+            self.assertEqual(storage.cache_stats()["misses"], 5)
+            self.assertEqual(storage.cache_stats()["hit_rate"], 0.5)
+
+            # Storing in a bucket invalidates it.
+            storage.store(self.codes[:1], {self.label: self.labels[9:]}, prefix="h_")
+            self.assertEqual(list(storage.retrieve(self.codes[:1], self.label, prefix="h_")[0]), [0, 9])
+            self.assertEqual(storage.cache_stats()["misses"], 6)
+
+            # Other namespaces are distinct buckets.
+            self.assertEqual(len(storage.retrieve(self.codes[:1], self.label)[0]), 0)
+
+            storage.remove(self.codes[:1], prefix="h_")
+            self.assertEqual(len(storage.retrieve(self.codes[:1], self.label, prefix="h_")[0]), 0)
+
+            # Rows are taken from the cached buckets (3 and 4) or read by the storage (5).
+            rows = [numpy.array([0])] * 3
+            buckets = storage.retrieve_rows(self.codes[3:6], self.label, rows, prefix="h_")
+            self.assertEqual([list(bucket) for bucket in buckets], [[3], [4], [5]])
+
+    def test_concurrent_retrieve(self):
+        storage = storage_factory("columnar", cache_bytes=1000)
+        storage.store(self.codes, {self.label: self.labels})
+
+        # A bucket retrieved while it is being stored to isn't kept in the cache.
+        store = storage.storage.store
+        def store_while_retrieving(*args, **kwargs):
+            storage.retrieve(self.codes[:1], self.label)
+            return store(*args, **kwargs)
+
+        storage.storage.store = store_while_retrieving
+        storage.store(self.codes[:1], {self.label: self.labels[9:]})
+        self.assertEqual(list(storage.retrieve(self.codes[:1], self.label)[0]), [0, 9])
+
+    def test_eviction(self):
+        # Each bucket takes 1 byte, the cache holds 3 of them.
+        storage = storage_factory("columnar", cache_bytes=3, cache_policy="lru")
+        storage.store(self.codes, {self.label: self.labels})
+        storage.retrieve(self.codes[[0, 1, 2]], self.label)
+        storage.retrieve(self.codes[[0]], self.label)  # 1 is now the least recently used.
+        storage.retrieve(self.codes[[3]], self.label)
+        self.assertEqual(storage.cache_stats()["evictions"], 1)
+        self.assertEqual(storage.cache_stats()["nbytes"], 3)
+        storage.retrieve(self.codes[[0, 2, 3]], self.label)
+        self.assertEqual(storage.cache_stats()["hits"], 4)
+
+        storage = storage_factory("columnar", cache_bytes=3, cache_policy="lfu")
+        storage.store(self.codes, {self.label: self.labels})
+        storage.retrieve(self.codes[[0, 1, 2]], self.label)
+        storage.retrieve(self.codes[[0, 2]], self.label)  # 1 is now the least frequently used.
+        storage.retrieve(self.codes[[3]], self.label)
+        storage.retrieve(self.codes[[0, 2, 3]], self.label)
+        self.assertEqual(storage.cache_stats()["hits"], 5)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -22,3 +22,4 @@
 from __future__ import absolute_import
 
 from nearpy.utils.utils import *
+from nearpy.utils.backend import set_backend, get_backend
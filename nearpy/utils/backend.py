@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import numpy as np
+
+from multiprocessing.pool import ThreadPool
+
+
+class NumpyBackend(object):
+    """
+    Computes the kernels of the hashes and distances with NumPy (default).
+
+    Arrays are evaluated by chunks, in parallel by `nb_threads` threads (the
+    kernels release the GIL and every chunk writes its own part of the output).
+    """
+
+    name = "numpy"
+
+    def __init__(self, nb_threads=1):
+        self.nb_threads = nb_threads
+        self._pool = None
+        self._pool_pid = None
+
+    @property
+    def pool(self):
+        """ Pool of threads of the current process (None if single-threaded). """
+        if self.nb_threads <= 1:
+            return None
+
+        # Threads don't survive a fork, forked processes (e.g. the workers of
+        # `Engine.neighbors_parallel`) create their own pool.
+        if self._pool is None or self._pool_pid != os.getpid():
+            self._pool = ThreadPool(self.nb_threads)
+            self._pool_pid = os.getpid()
+
+        return self._pool
+
+    def close(self):
+        """ Stops the threads of the pool (if created by this process). """
+        if self._pool is not None and self._pool_pid == os.getpid():
+            self._pool.close()
+
+        self._pool = None
+
+    def __str__(self):
+        return "{} ({} thread{})".format(self.name, self.nb_threads, "s" if self.nb_threads > 1 else "")
+
+    def map_chunks(self, func, size, chunk_size):
+        """ Calls `func(start, end)` for each chunk of [0, size). """
+        bounds = [(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+        if self.nb_threads <= 1 or len(bounds) <= 1:
+            for start, end in bounds:
+                func(start, end)
+        else:
+            self.pool.map(lambda bound: func(*bound), bounds)
+
+    def cos(self, x, omegas, phases):
+        """ Returns cos(x * omegas - phases), one row per element of `x`. """
+        return np.cos(x[:, None] * omegas - phases)
+
+    def sq_norms(self, X):
+        """ Returns the squared norm of every row of `X`. """
+        return np.einsum("ij,ij->i", X, X)
+
+    def sq_distances(self, dots, queries_sq_norms, patches_sq_norms):
+        """
+        Turns in place the dot products between queries (rows) and patches
+        (columns) into squared Euclidean distances.
+        """
+        dots *= -2
+        dots += queries_sq_norms[:, None]
+        dots += patches_sq_norms[None, :]
+        return dots
+
+
+class NumexprBackend(NumpyBackend):
+    """ Evaluates the element-wise kernels with numexpr (single pass, no temporaries). """
+
+    name = "numexpr"
+
+    def __init__(self, nb_threads=1):
+        import numexpr
+        super(NumexprBackend, self).__init__(nb_threads)
+        self.numexpr = numexpr
+        numexpr.set_num_threads(1)  # Chunks are already evaluated in parallel.
+
+    def cos(self, x, omegas, phases):
+        x = x[:, None]
+        return self.numexpr.evaluate("cos(x * omegas - phases)")
+
+    def sq_distances(self, dots, queries_sq_norms, patches_sq_norms):
+        queries_sq_norms = queries_sq_norms[:, None]
+        patches_sq_norms = patches_sq_norms[None, :]
+        return self.numexpr.evaluate("queries_sq_norms - 2 * dots + patches_sq_norms", out=dots)
+
+
+class NumbaBackend(NumpyBackend):
+    """ Evaluates the element-wise kernels with functions compiled by numba. """
+
+    name = "numba"
+
+    def __init__(self, nb_threads=1):
+        import numba
+        super(NumbaBackend, self).__init__(nb_threads)
+
+        @numba.njit(nogil=True)
+        def cos(x, omegas, phases):
+            out = np.empty((len(x), len(omegas)), dtype=x.dtype)
+            for i in range(len(x)):
+                for j in range(len(omegas)):
+                    out[i, j] = np.cos(x[i] * omegas[j] - phases[j])
+            return out
+
+        @numba.njit(nogil=True)
+        def sq_norms(X):
+            out = np.zeros(X.shape[0], dtype=X.dtype)
+            for i in range(X.shape[0]):
+                for j in range(X.shape[1]):
+                    out[i] += X[i, j] * X[i, j]
+            return out
+
+        @numba.njit(nogil=True)
+        def sq_distances(dots, queries_sq_norms, patches_sq_norms):
+            for i in range(dots.shape[0]):
+                for j in range(dots.shape[1]):
+                    dots[i, j] = queries_sq_norms[i] - 2 * dots[i, j] + patches_sq_norms[j]
+            return dots
+
+        self.cos = cos
+        self.sq_norms = sq_norms
+        self.sq_distances = sq_distances
+
+
+BACKENDS = {"numpy": NumpyBackend, "numexpr": NumexprBackend, "numba": NumbaBackend}
+
+_backend = NumpyBackend()
+
+
+def set_backend(name, nb_threads=1):
+    """
+    Selects the backend computing the hashes and distances: "numpy" (default),
+    "numexpr" or "numba". Raises an ImportError if its library isn't installed
+    (there is no fallback). Returns the backend.
+    """
+    global _backend
+    if name.lower() not in BACKENDS:
+        raise ValueError("Unknown backend: {}".format(name))
+
+    backend = BACKENDS[name.lower()](nb_threads)
+    _backend.close()
+    _backend = backend
+    return _backend
+
+
+def get_backend():
+    """ Returns the active backend (see `set_backend`), e.g. `str(get_backend())`. """
+    return _backend
@@ -7,6 +7,7 @@ import numpy
 import numpy as np
 from time import time
 from itertools import islice
+from collections import deque
 
 
 def numpy_array_from_list_or_numpy_array(vectors):
@@ -62,6 +63,79 @@ def perform_online_pca(data, dimension=None):
     return mean, (eigenvalues, eigenvectors)
 
 
+def perform_online_kmeans(trainset, nb_centroids, nb_subspaces=1, nb_passes=5, rand_seed=None):
+    """
+    Clusters the vectors yielded by `trainset()` (chunks of vectors, one per
+    row) with mini-batch k-means, i.e. without keeping them all in memory.
+    Each chunk moves the centroids toward the mean of the vectors assigned to
+    them, with a learning rate decreasing with the number of vectors seen.
+
+    Vectors are split in `nb_subspaces` contiguous parts clustered separately
+    (as for product quantization). Returns the centroids, with shape
+    (nb_subspaces, nb_centroids, dimension / nb_subspaces).
+    """
+    rand = np.random.RandomState(rand_seed)
+    centroids = None
+    counts = np.zeros((nb_subspaces, nb_centroids), dtype=np.float64)
+
+    for _ in range(nb_passes):
+        for chunk in trainset():
+            chunk = np.asarray(chunk, dtype=np.float64)
+            chunk = chunk.reshape((len(chunk), nb_subspaces, -1))
+            if centroids is None:
+                indices = rand.choice(len(chunk), nb_centroids, replace=len(chunk) < nb_centroids)
+                centroids = chunk[indices].transpose((1, 0, 2)).copy()
+
+            for subspace in range(nb_subspaces):
+                vectors = chunk[:, subspace]
+                sq_distances = np.sum(centroids[subspace]**2, axis=1) - 2 * np.dot(vectors, centroids[subspace].T)
+                assignments = np.argmin(sq_distances, axis=1)
+
+                sizes = np.bincount(assignments, minlength=nb_centroids).astype(np.float64)
+                sums = np.zeros_like(centroids[subspace])
+                np.add.at(sums, assignments, vectors)
+
+                counts[subspace] += sizes
+                updated = sizes > 0
+                centroids[subspace][updated] += (sums[updated] - sizes[updated, None] * centroids[subspace][updated]) \
+                    / counts[subspace][updated, None]
+
+    return centroids
+
+
+def perform_online_itq(trainset, project, nb_iterations=50, rand_seed=None):
+    """
+    Learns the rotation of iterative quantization [Gong2011]_, i.e. the
+    orthogonal matrix R minimizing the quantization error ||B - PR|| of the
+    projections P (given by `project`) of the vectors yielded by `trainset()`,
+    where B = sign(PR). Each iteration goes once through the chunks of vectors
+    and only keeps the (c x c) correlation between projections and codes, so
+    vectors aren't kept in memory.
+
+    References
+    ----------
+    .. [Gong2011] Gong, Y., & Lazebnik, S. (2011). Iterative quantization:
+                  A procrustean approach to learning binary codes. CVPR.
+    """
+    rand = np.random.RandomState(rand_seed)
+    rotation = None
+    for _ in range(nb_iterations):
+        correlation = 0
+        for chunk in trainset():
+            projections = np.asarray(project(chunk), dtype=np.float64)
+            if rotation is None:
+                rotation, _ = np.linalg.qr(rand.randn(projections.shape[1], projections.shape[1]))
+
+            codes = np.where(np.dot(projections, rotation) > 0, 1., -1.)
+            correlation = correlation + np.dot(projections.T, codes)
+
+        # Orthogonal Procrustes problem: R = UV^T where P^T B = USV^T.
+        U, _, Vt = np.linalg.svd(correlation)
+        rotation = np.dot(U, Vt)
+
+    return rotation.astype(np.float32)
+
+
 PY2 = sys.version_info[0] == 2
 if PY2:
     bytes_type = str
@@ -92,6 +166,58 @@ def ichunk(sequence, n):
         chunk = list(islice(sequence, n))
 
 
+def bounded_imap(pool, func, iterable, max_pending):
+    """
+    Same as `pool.imap(func, iterable)` (results are yielded in order) but no
+    more than `max_pending` elements of `iterable` are consumed ahead, which
+    bounds the memory used when the elements or the results are big.
+    """
+    iterable = iter(iterable)
+    pending = deque(pool.apply_async(func, (element,)) for element in islice(iterable, max(1, max_pending)))
+    while len(pending) > 0:
+        result = pending.popleft().get()
+
+        for element in islice(iterable, 1):
+            pending.append(pool.apply_async(func, (element,)))
+
+        yield result
+
+
+def pack_bits(bits):
+    """
+    Packs boolean codes (one row per code) into uint64 words, bit i of a code
+    being bit i % 64 of word i // 64 (i.e. the first 64 bits give the same
+    integer as `Hashing.bits_to_int`). Codes are padded with zeros.
+    """
+    bits = np.asarray(bits, dtype=bool)
+    nb_words = -(-bits.shape[1] // 64)
+    padded = np.zeros((len(bits), nb_words * 64), dtype=bool)
+    padded[:, :bits.shape[1]] = bits
+
+    # `packbits` puts the first bit in the most significant position of each byte.
+    packed = np.packbits(padded.reshape((len(bits), nb_words * 8, 8))[:, :, ::-1], axis=-1)
+    packed = packed.reshape((len(bits), nb_words * 8))
+    return np.ascontiguousarray(packed).view("<u8").astype(np.uint64)
+
+
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+_H01 = np.uint64(0x0101010101010101)
+
+
+def popcount(words):
+    """
+    Returns the number of bits set in each uint64 word (SWAR bit counting,
+    i.e. no per-bit unpacking).
+    """
+    words = np.asarray(words, dtype=np.uint64)
+    counts = words - ((words >> np.uint64(1)) & _M1)
+    counts = (counts & _M2) + ((counts >> np.uint64(2)) & _M2)
+    counts = (counts + (counts >> np.uint64(4))) & _M4
+    return ((counts * _H01) >> np.uint64(56)).astype(np.uint8)
+
+
 def load_dict_from_json(path):
     try:
         with open(path, "r") as json_file:
@@ -7,6 +7,26 @@ suite = unittest.TestLoader().loadTestsFromTestCase(
     tests.TestStorage)
 unittest.TextTestRunner(verbosity=2).run(suite)
 
+suite = unittest.TestLoader().loadTestsFromTestCase(
+    tests.TestBucketKeys)
+unittest.TextTestRunner(verbosity=2).run(suite)
+
+suite = unittest.TestLoader().loadTestsFromTestCase(
+    tests.TestColumnarStorage)
+unittest.TextTestRunner(verbosity=2).run(suite)
+
+suite = unittest.TestLoader().loadTestsFromTestCase(
+    tests.TestMMapStorage)
+unittest.TextTestRunner(verbosity=2).run(suite)
+
+suite = unittest.TestLoader().loadTestsFromTestCase(
+    tests.TestFileStorage)
+unittest.TextTestRunner(verbosity=2).run(suite)
+
+suite = unittest.TestLoader().loadTestsFromTestCase(
+    tests.TestCachedStorage)
+unittest.TextTestRunner(verbosity=2).run(suite)
+
 suite = unittest.TestLoader().loadTestsFromTestCase(
     tests.TestRandomBinaryProjections)
 unittest.TextTestRunner(verbosity=2).run(suite)
@@ -19,6 +39,14 @@ suite = unittest.TestLoader().loadTestsFromTestCase(
     tests.TestEngine)
 unittest.TextTestRunner(verbosity=2).run(suite)
 
+suite = unittest.TestLoader().loadTestsFromTestCase(
+    tests.TestMultiTableEngine)
+unittest.TextTestRunner(verbosity=2).run(suite)
+
+suite = unittest.TestLoader().loadTestsFromTestCase(
+    tests.TestMultiProbe)
+unittest.TextTestRunner(verbosity=2).run(suite)
+
 suite = unittest.TestLoader().loadTestsFromTestCase(
     tests.TestEuclideanDistance)
 unittest.TextTestRunner(verbosity=2).run(suite)
@@ -31,10 +59,38 @@ suite = unittest.TestLoader().loadTestsFromTestCase(
     tests.TestManhattanDistance)
 unittest.TextTestRunner(verbosity=2).run(suite)
 
+suite = unittest.TestLoader().loadTestsFromTestCase(
+    tests.TestPairwiseDistances)
+unittest.TextTestRunner(verbosity=2).run(suite)
+
+suite = unittest.TestLoader().loadTestsFromTestCase(
+    tests.TestHammingDistance)
+unittest.TextTestRunner(verbosity=2).run(suite)
+
+suite = unittest.TestLoader().loadTestsFromTestCase(
+    tests.TestPQDistance)
+unittest.TextTestRunner(verbosity=2).run(suite)
+
+suite = unittest.TestLoader().loadTestsFromTestCase(
+    tests.TestQuantizedDistances)
+unittest.TextTestRunner(verbosity=2).run(suite)
+
+suite = unittest.TestLoader().loadTestsFromTestCase(
+    tests.TestBackend)
+unittest.TextTestRunner(verbosity=2).run(suite)
+
+suite = unittest.TestLoader().loadTestsFromTestCase(
+    tests.TestDataCodecs)
+unittest.TextTestRunner(verbosity=2).run(suite)
+
 suite = unittest.TestLoader().loadTestsFromTestCase(
     tests.TestVectorFilters)
 unittest.TextTestRunner(verbosity=2).run(suite)
 
+suite = unittest.TestLoader().loadTestsFromTestCase(
+    tests.TestBatchVectorFilters)
+unittest.TextTestRunner(verbosity=2).run(suite)
+
 suite = unittest.TestLoader().loadTestsFromTestCase(
     tests.TestPCABinaryProjections)
 unittest.TextTestRunner(verbosity=2).run(suite)
@@ -43,6 +99,14 @@ suite = unittest.TestLoader().loadTestsFromTestCase(
     tests.TestPCADiscretizedProjections)
 unittest.TextTestRunner(verbosity=2).run(suite)
 
+suite = unittest.TestLoader().loadTestsFromTestCase(
+    tests.TestPCAHashing)
+unittest.TextTestRunner(verbosity=2).run(suite)
+
+suite = unittest.TestLoader().loadTestsFromTestCase(
+    tests.TestSpectralHashing)
+unittest.TextTestRunner(verbosity=2).run(suite)
+
 suite = unittest.TestLoader().loadTestsFromTestCase(
     tests.TestHashStorage)
 unittest.TextTestRunner(verbosity=2).run(suite)
@@ -51,7 +115,6 @@ suite = unittest.TestLoader().loadTestsFromTestCase(
     tests.TestRandomBinaryProjectionTree)
 unittest.TextTestRunner(verbosity=2).run(suite)
 
-# TODO: Experiment tests are out of date!
-#suite = unittest.TestLoader().loadTestsFromTestCase(
-#    tests.TestRecallExperiment)
-#unittest.TextTestRunner(verbosity=2).run(suite)
+suite = unittest.TestLoader().loadTestsFromTestCase(
+    tests.TestRecallExperiment)
+unittest.TextTestRunner(verbosity=2).run(suite)